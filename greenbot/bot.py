@@ -8,14 +8,24 @@ import datetime
 import time
 
 from greenbot.models.action import ActionParser
+from greenbot.models.action import ActionRegistry
+from greenbot.models.action import get_message_parts
 from greenbot.models.user import User
 from greenbot.models.module import ModuleManager
 from greenbot.managers.sock import SocketManager
+from greenbot.managers.sock import SocketClientManager
 from greenbot.managers.schedule import ScheduleManager
 from greenbot.managers.db import DBManager
 from greenbot.managers.redis import RedisManager
 from greenbot.managers.handler import HandlerManager
 from greenbot.managers.discord_bot import DiscordBotManager
+from greenbot.managers.cooldown import CooldownManager
+from greenbot.managers.executor import ExecutorManager
+from greenbot.managers.metrics import MetricsManager
+from greenbot.managers.message_buffer import MessageBuffer
+from greenbot.managers.message_partition import MessagePartitionManager
+from greenbot.managers.user_cache import UserCache
+from greenbot.managers.urlfetch import URLFetchManager
 from greenbot.managers.command import CommandManager
 from greenbot.migration.db import DatabaseMigratable
 from greenbot.migration.migrate import Migration
@@ -46,7 +56,15 @@ class Bot:
 
         ScheduleManager.init()
         DBManager.init(self.config["main"]["db"])
+        ExecutorManager.init(self.config["main"].getint("worker_threads", 8))
 
+        if "metrics" in config and config["metrics"].getint("port", 0):
+            MetricsManager.start_server(
+                host=config["metrics"].get("host", "127.0.0.1"),
+                port=config["metrics"].getint("port"),
+            )
+
+        self.action_registry = ActionRegistry(self)
         ActionParser.bot = self
 
         # redis
@@ -67,9 +85,39 @@ class Bot:
         except ValueError as error:
             log.error(error)
 
-        HandlerManager.init_handlers()
+        HandlerManager.init_handlers(loop=self.private_loop)
         HandlerManager.add_handler("discord_message", self.discord_message)
+
+        self.message_buffer = MessageBuffer(
+            batch_size=self.config["main"].getint("message_batch_size", 500),
+            flush_interval=self.config["main"].getint("message_flush_interval", 2),
+            max_pending=self.config["main"].getint("message_max_pending", 10000),
+        )
+        HandlerManager.add_handler("on_quit", self.message_buffer.quit)
+        MessagePartitionManager.init(
+            retention_months=self.config["main"].getint("message_retention_months", 0),
+            retention_mode=self.config["main"].get("message_retention_mode", "detach"),
+        )
         self.bot_name = self.config["main"]["bot_name"]
+        self.user_agent = f"greenbot ({self.bot_name})"
+        ScheduleManager.execute_every(
+            60, HandlerManager.publish_stats, args=[self.bot_name]
+        )
+        SocketClientManager.init(self.bot_name)
+        CooldownManager.init(
+            backend=self.config["main"].get("cooldown_backend", "memory"),
+            maxsize=self.config["main"].getint("cooldown_cache_size", 100000),
+            redis_prefix=f"{self.bot_name}:cooldown:",
+        )
+        URLFetchManager.init(
+            self.private_loop,
+            self.user_agent,
+            connect_timeout=self.config["main"].getint("urlfetch_connect_timeout", 2),
+            read_timeout=self.config["main"].getint("urlfetch_read_timeout", 5),
+            max_bytes=self.config["main"].getint("urlfetch_max_bytes", 16384),
+            cache_size=self.config["main"].getint("urlfetch_cache_size", 256),
+            cache_ttl=self.config["main"].getint("urlfetch_cache_ttl", 60),
+        )
         self.command_prefix = self.config["discord"]["command_prefix"]
         self.settings = {
             "discord_token": self.discord_token,
@@ -92,7 +140,12 @@ class Bot:
         return self.discord_bot.client.user.id
 
     def wait_discord_load(self):
-        self.socket_manager = SocketManager(self.bot_name, self.execute_now)
+        self.socket_manager = SocketManager(self.bot_name)
+        UserCache.init(
+            maxsize=self.config["main"].getint("user_cache_size", 10000),
+            ttl=self.config["main"].getint("user_cache_ttl", 300),
+            socket_manager=self.socket_manager,
+        )
         self.module_manager = ModuleManager(self.socket_manager, bot=self).load()
 
         self.commands = CommandManager(
@@ -103,14 +156,14 @@ class Bot:
         HandlerManager.trigger("manager_loaded")
 
         # promote the admin to level 2000
-        owner = self.config["main"].get("owner_id", None)
-        if owner is None:
+        owner_id = self.config["main"].get("owner_id", None)
+        if owner_id is None:
             log.warning(
                 "No admin user specified. See the [main] section in the example config for its usage."
             )
         else:
             with DBManager.create_session_scope() as db_session:
-                owner = User._create_or_get_by_discord_id(db_session, str(owner))
+                owner = User._create_or_get_by_discord_id(db_session, str(owner_id))
                 if owner is None:
                     log.warning(
                         "The login name you entered for the admin user does not exist on twitch. "
@@ -118,6 +171,7 @@ class Bot:
                     )
                 else:
                     owner.level = 2000
+            UserCache.invalidate(owner_id)
 
     def execute_now(self, function, *args, **kwargs):
         self.execute_delayed(0, function, *args, **kwargs)
@@ -135,9 +189,18 @@ class Bot:
             ScheduleManager.base_scheduler.shutdown(wait=False)
         except:
             log.exception("Error while shutting down the apscheduler")
-        self.private_loop.call_soon_threadsafe(self.private_loop.stop)
+        ExecutorManager.shutdown(wait=False)
+        MetricsManager.stop_server()
+        asyncio.run_coroutine_threadsafe(self.stop_loop(), self.private_loop)
         self.socket_manager.quit()
 
+    async def stop_loop(self):
+        try:
+            await URLFetchManager.close()
+        except:
+            log.exception("Error while closing the urlfetch session")
+        self.private_loop.stop()
+
     def connect(self):
         self.discord_bot.connect()
 
@@ -224,15 +287,10 @@ class Bot:
         member = self.get_member(args[0][3:][:-1])
         if not member:
             return "Member not found", None
-        with DBManager.create_session_scope() as db_session:
-            author_user = User._create_or_get_by_discord_id(
-                db_session, str(author.id), user_name=str(author)
-            )
-            member_user = User._create_or_get_by_discord_id(
-                db_session, str(member.id), user_name=str(member)
-            )
-            if author_user.level <= member_user.level:
-                return "You cannot kick someone who has the same level as you :)", None
+        author_user = UserCache.get(author.id)
+        member_user = UserCache.get(member.id)
+        if author_user.level <= member_user.level:
+            return "You cannot kick someone who has the same level as you :)", None
         reason = args[1] if len(args) > 1 else ""
         message = f"Member {member} has been kicked!"
         self.kick(member, f"{reason}\nKicked by {author}")
@@ -245,19 +303,14 @@ class Bot:
         author = extra["author"]
         if not member:
             return "Member not found", None
-        with DBManager.create_session_scope() as db_session:
-            author_user = User._create_or_get_by_discord_id(
-                db_session, str(author.id), user_name=str(author)
-            )
-            member_user = User._create_or_get_by_discord_id(
-                db_session, str(member.id), user_name=str(member)
-            )
-            if author.id == member.id:
-                return "You cannot ban yourself :)", None
-            if author_user.level == member_user.level:
-                return "You cannot ban someone who has the same level as you :)", None
-            elif author_user.level < member_user.level:
-                return "You cannot ban someone who is a higher level than you :)", None
+        if author.id == member.id:
+            return "You cannot ban yourself :)", None
+        author_user = UserCache.get(author.id)
+        member_user = UserCache.get(member.id)
+        if author_user.level == member_user.level:
+            return "You cannot ban someone who has the same level as you :)", None
+        elif author_user.level < member_user.level:
+            return "You cannot ban someone who is a higher level than you :)", None
         timeout_in_seconds = int(args[1] if len(args) > 2 and args[1] != "" else 0)
         delete_message_days = int(args[2] if len(args) > 3 and args[2] != "" else 0)
         reason = args[3] if len(args) == 4 else ""
@@ -336,6 +389,7 @@ class Bot:
             if user.level >= extra["user_level"]:
                 return "You cannot set a level of a user with a higher then your own!", None
             user.level = level
+        UserCache.invalidate(member_id)
         return f"Level, {level}, set for <@!{member_id}>", None
 
     def func_set_balance(self, args, extra={}):
@@ -349,6 +403,7 @@ class Bot:
         with DBManager.create_session_scope() as db_session:
             user = User._create_or_get_by_discord_id(db_session, str(user_id))
             user.points = amount
+        UserCache.invalidate(user_id)
         currency = self._get_currency().get("name").capitalize()
         return f"{currency} balance for <@!{user_id}> set to {amount}", None
 
@@ -363,6 +418,7 @@ class Bot:
         with DBManager.create_session_scope() as db_session:
             user = User._create_or_get_by_discord_id(db_session, str(user_id))
             user.points += amount
+        UserCache.invalidate(user_id)
         action = "added to" if amount > 0 else "removed from"
         currency = self._get_currency().get("name")
         return f"{amount} {currency} {action} <@!{user_id}> ", None
@@ -371,31 +427,15 @@ class Bot:
         self.quit_bot()
 
     def apply_filter(self, resp, f):
-        available_filters = {
-            "strftime": _filter_strftime,
-            "timezone": _filter_timezone,
-            "lower": lambda var, args: var.lower(),
-            "upper": lambda var, args: var.upper(),
-            "title": lambda var, args: var.title(),
-            "capitalize": lambda var, args: var.capitalize(),
-            "swapcase": lambda var, args: var.swapcase(),
-            "time_since_minutes": lambda var, args: "no time"
-            if var == 0
-            else utils.time_since(var * 60, 0, time_format="long"),
-            "time_since": lambda var, args: "no time"
-            if var == 0
-            else utils.time_since(var, 0, time_format="long"),
-            "time_since_dt": _filter_time_since_dt,
-            "urlencode": _filter_urlencode,
-            "join": _filter_join,
-            "number_format": _filter_number_format,
-            "add": _filter_add,
-            "or_else": _filter_or_else,
-        }
-        if f.name in available_filters:
-            return available_filters[f.name](resp, f.arguments)
+        cb = self.get_filter(f.name)
+        if cb is not None:
+            return cb(resp, f.arguments)
         return resp
 
+    @staticmethod
+    def get_filter(name):
+        return available_filters.get(name, None)
+
     def get_time_value(self, key, extra={}):
         try:
             tz = timezone(key)
@@ -405,7 +445,7 @@ class Bot:
 
         return None
 
-    def get_strictargs_value(self, key, extra={}):
+    def get_strictargs_value(self, key, extra=None):
         ret = self.get_args_value(key, extra)
         if not ret:
             return None
@@ -613,23 +653,23 @@ class Bot:
         )
         if not user:
             user = extra["author"]
-        with DBManager.create_session_scope() as db_session:
-            db_user = User._create_or_get_by_discord_id(db_session, user.id)
-            return getattr(db_user, key) if db_user else None
+        return getattr(UserCache.get(user.id), key, None)
 
     def func_output(self, args, extra={}):
         return f"args: {args}\nextra: {extra}", None
 
-    def rest(self, key, extra={}):
-        return " ".join(extra["message"].split(" ")[int(key):])
+    def rest(self, key, extra=None):
+        if extra is None:
+            extra = {}
+        return " ".join(get_message_parts(extra)[int(key) :])
 
     @staticmethod
-    def get_args_value(key, extra={}):
+    def get_args_value(key, extra=None):
+        # get_message_parts caches the parts in extra, so it must not be a shared default
+        if extra is None:
+            extra = {}
         r = None
-        try:
-            msg_parts = extra["message"].split(" ")
-        except (KeyError, AttributeError):
-            msg_parts = [""]
+        msg_parts = get_message_parts(extra)
 
         try:
             if "-" in key:
@@ -732,3 +772,26 @@ def _filter_or_else(var, args):
         return args[0]
     else:
         return var
+
+
+available_filters = {
+    "strftime": _filter_strftime,
+    "timezone": _filter_timezone,
+    "lower": lambda var, args: var.lower(),
+    "upper": lambda var, args: var.upper(),
+    "title": lambda var, args: var.title(),
+    "capitalize": lambda var, args: var.capitalize(),
+    "swapcase": lambda var, args: var.swapcase(),
+    "time_since_minutes": lambda var, args: "no time"
+    if var == 0
+    else utils.time_since(var * 60, 0, time_format="long"),
+    "time_since": lambda var, args: "no time"
+    if var == 0
+    else utils.time_since(var, 0, time_format="long"),
+    "time_since_dt": _filter_time_since_dt,
+    "urlencode": _filter_urlencode,
+    "join": _filter_join,
+    "number_format": _filter_number_format,
+    "add": _filter_add,
+    "or_else": _filter_or_else,
+}
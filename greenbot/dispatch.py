@@ -291,7 +291,6 @@ class Dispatch:
                     already_used_aliases.append(alias)
                 else:
                     added_aliases.append(alias)
-                    bot.commands[alias] = command
 
             if len(added_aliases) > 0:
                 new_aliases = f"{command.command}|{'|'.join(added_aliases)}"
@@ -352,7 +351,6 @@ class Dispatch:
                 bot.commands.edit_command(command, command=new_aliases)
 
                 num_removed += 1
-                del bot.commands[alias]
                 log_msg = f"The alias {alias} has been removed from {new_aliases.split('|')[0]}"
                 AdminLogManager.add_entry("Alias removed", str(author.id), log_msg)
 
@@ -1,13 +1,15 @@
 import argparse
 import logging
+import threading
 from collections import UserDict
 
 from sqlalchemy.orm import joinedload
 
+from greenbot.managers.command_catalog import CommandCatalog
 from greenbot.managers.db import DBManager
+from greenbot.managers.schedule import ScheduleManager
 from greenbot.models.command import Command
 from greenbot.models.command import CommandData
-from greenbot.utils import find
 from greenbot.models.command import parse_command_for_web
 
 log = logging.getLogger(__name__)
@@ -20,6 +22,10 @@ class CommandManager(UserDict):
      - internal_commands = Commands that are added in source
      - db_commands = Commands that are loaded from the database
      - module_commands = Commands that are loaded from enabled modules
+
+    Later sources override earlier ones, except that multi-commands with the same alias
+    are merged. The alias index in `data` is patched in place when a database command
+    changes, only merges and module changes rebuild it from scratch.
     """
 
     def __init__(self, socket_manager=None, module_manager=None, bot=None):
@@ -28,61 +34,87 @@ class CommandManager(UserDict):
 
         self.internal_commands = {}
         self.db_commands = {}
+        # command id => database command
+        self.db_commands_by_id = {}
+        # command id => aliases the database command is stored under in db_commands
+        self.db_aliases_by_id = {}
         self.module_commands = {}
         self.data = {}
+        # Aliases whose multi-command was merged with another one in the last rebuild
+        self.merged_aliases = set()
 
         self.bot = bot
         self.module_manager = module_manager
 
+        self.catalog_lock = threading.Lock()
+        self.catalog_scheduled = False
+        self.catalog_uses = None
+        if self.bot is not None:
+            ScheduleManager.execute_every(
+                CommandCatalog.refresh_interval, self.refresh_catalog
+            )
+
         if socket_manager:
-            socket_manager.add_handler("module.update", self.on_module_reload)
-            socket_manager.add_handler("command.update", self.on_command_update)
-            socket_manager.add_handler("command.remove", self.on_command_remove)
+            socket_manager.add_handler(
+                "module.update", self.on_module_reload, batch=True
+            )
+            socket_manager.add_handler(
+                "command.update", self.on_command_update, batch=True
+            )
+            socket_manager.add_handler(
+                "command.remove", self.on_command_remove, batch=True
+            )
 
-    def on_module_reload(self, _data):
+    @staticmethod
+    def get_command_ids(messages, handler_name):
+        command_ids = set()
+        for data in messages:
+            try:
+                command_ids.add(int(data["command_id"]))
+            except (KeyError, ValueError):
+                log.warning(f"No command ID found in {handler_name}")
+        return command_ids
+
+    def on_module_reload(self, _messages):
         log.debug("Rebuilding commands...")
         self.rebuild()
         log.debug("Done rebuilding commands")
 
-    def on_command_update(self, data):
-        try:
-            command_id = int(data["command_id"])
-        except (KeyError, ValueError):
-            log.warning("No command ID found in on_command_update")
+    def on_command_update(self, messages):
+        command_ids = self.get_command_ids(messages, "on_command_update")
+        if not command_ids:
             return
 
-        command = find(
-            lambda command: command.id == command_id, self.db_commands.values()
-        )
-        if command is not None:
-            self.remove_command_aliases(command)
+        aliases = set()
+        for command_id in command_ids:
+            command = self.db_commands_by_id.get(command_id, None)
+            if command is not None:
+                aliases.update(self.remove_command_aliases(command))
 
-        self.load_by_id(command_id)
+        for command in self.load_by_ids(command_ids):
+            aliases.update(self.db_aliases_by_id[command.id])
 
-        log.debug(f"Reloaded command with id {command_id}")
+        log.debug(f"Reloaded commands with ids {command_ids}")
 
-        self.rebuild()
+        self.update_aliases(aliases)
 
-    def on_command_remove(self, data):
-        try:
-            command_id = int(data["command_id"])
-        except (KeyError, ValueError):
-            log.warning("No command ID found in on_command_update")
-            return
+    def on_command_remove(self, messages):
+        command_ids = self.get_command_ids(messages, "on_command_remove")
 
-        command = find(
-            lambda command: command.id == command_id, self.db_commands.values()
-        )
-        if command is None:
-            log.warning("Invalid ID sent to on_command_update")
-            return
+        aliases = set()
+        for command_id in command_ids:
+            command = self.db_commands_by_id.get(command_id, None)
+            if command is None:
+                log.warning("Invalid ID sent to on_command_remove")
+                continue
 
-        self.db_session.expunge(command.data)
-        self.remove_command_aliases(command)
+            self.db_session.expunge(command.data)
+            aliases.update(self.remove_command_aliases(command))
 
-        log.debug(f"Remove command with id {command_id}")
+            log.debug(f"Remove command with id {command_id}")
 
-        self.rebuild()
+        if aliases:
+            self.update_aliases(aliases)
 
     def __del__(self):
         self.db_session.close()
@@ -179,17 +211,17 @@ class CommandManager(UserDict):
 
         command = Command(command=alias_str, **options)
         command.data = CommandData(command.id, **options)
-        self.add_db_command_aliases(command)
         with DBManager.create_session_scope(expire_on_commit=False) as db_session:
             db_session.add(command)
             db_session.add(command.data)
             db_session.commit()
             db_session.expunge(command)
             db_session.expunge(command.data)
+        self.add_db_command_aliases(command)
         self.db_session.add(command.data)
         self.commit()
 
-        self.rebuild()
+        self.update_aliases(self.db_aliases_by_id[command.id])
         return command, True, ""
 
     def edit_command(self, command_to_edit, **options):
@@ -198,8 +230,17 @@ class CommandManager(UserDict):
         DBManager.session_add_expunge(command_to_edit)
         self.commit()
 
+        if "command" in options:
+            # The aliases changed, swap them in the index
+            aliases = self.remove_command_aliases(command_to_edit)
+            self.add_db_command_aliases(command_to_edit)
+            self.update_aliases(aliases | self.db_aliases_by_id[command_to_edit.id])
+
     def remove_command_aliases(self, command):
-        aliases = command.command.split("|")
+        """ Returns the aliases the command was stored under """
+        self.db_commands_by_id.pop(command.id, None)
+        # The aliases it was added with, command.command may have been edited since
+        aliases = self.db_aliases_by_id.pop(command.id, set(command.command.split("|")))
         for alias in aliases:
             if alias in self.db_commands:
                 del self.db_commands[alias]
@@ -207,21 +248,25 @@ class CommandManager(UserDict):
                 log.warning(
                     f"For some reason, {alias} was not in the list of commands when we removed it."
                 )
+        return aliases
 
     def remove_command(self, command):
-        self.remove_command_aliases(command)
+        aliases = self.remove_command_aliases(command)
 
         with DBManager.create_session_scope() as db_session:
             self.db_session.expunge(command.data)
             db_session.delete(command.data)
             db_session.delete(command)
 
-        self.rebuild()
+        self.update_aliases(aliases)
 
     def add_db_command_aliases(self, command):
         aliases = command.command.split("|")
         for alias in aliases:
             self.db_commands[alias] = command
+        if command.id is not None:
+            self.db_commands_by_id[command.id] = command
+            self.db_aliases_by_id[command.id] = set(aliases)
 
         return len(aliases)
 
@@ -252,6 +297,38 @@ class CommandManager(UserDict):
 
         return self.db_commands
 
+    @staticmethod
+    def is_multi(command):
+        return command.action is not None and command.action.type == "multi"
+
+    def get_sources(self):
+        """ The command dictionaries in order of precedence, lowest first """
+        yield self.internal_commands
+        yield {
+            alias: command
+            for alias, command in self.db_commands.items()
+            if command.enabled is True
+        }
+        if self.module_manager is not None:
+            for enabled_module in self.module_manager.modules:
+                yield enabled_module.commands
+
+    def get_candidates(self, alias):
+        """ The commands that are stored under the alias, in order of precedence """
+        candidates = []
+        command = self.internal_commands.get(alias, None)
+        if command is not None:
+            candidates.append(command)
+        command = self.db_commands.get(alias, None)
+        if command is not None and command.enabled is True:
+            candidates.append(command)
+        if self.module_manager is not None:
+            for enabled_module in self.module_manager.modules:
+                command = enabled_module.commands.get(alias, None)
+                if command is not None:
+                    candidates.append(command)
+        return candidates
+
     def rebuild(self):
         """ Rebuild the internal commands list from all sources.
 
@@ -266,30 +343,73 @@ class CommandManager(UserDict):
                     command.action.reset()
 
                 if alias in out:
-                    if (
-                        command.action
-                        and command.action.type == "multi"
-                        and out[alias].action
-                        and out[alias].action.type == "multi"
-                    ):
+                    if self.is_multi(command) and self.is_multi(out[alias]):
                         out[alias].action += command.action
+                        merged_aliases.add(alias)
                     else:
                         out[alias] = command
                 else:
                     out[alias] = command
 
-        self.data = {}
-        db_commands = {
-            alias: command
-            for alias, command in self.db_commands.items()
-            if command.enabled is True
+        data = {}
+        merged_aliases = set()
+        for source in self.get_sources():
+            merge_commands(source, data)
+
+        self.data = data
+        self.merged_aliases = merged_aliases
+        self.schedule_catalog_publish()
+
+    def update_aliases(self, aliases):
+        """ Patch the given aliases in the index after the database commands have changed """
+        patches = {}
+        for alias in aliases:
+            candidates = self.get_candidates(alias)
+            needs_merge = any(
+                self.is_multi(a) and self.is_multi(b)
+                for a, b in zip(candidates, candidates[1:])
+            )
+            if needs_merge or alias in self.merged_aliases:
+                # Merged multi-commands are modified in place, only a rebuild can undo that
+                self.rebuild()
+                return
+            patches[alias] = candidates[-1] if candidates else None
+
+        for alias, command in patches.items():
+            if command is None:
+                self.data.pop(alias, None)
+            else:
+                self.data[alias] = command
+        self.schedule_catalog_publish()
+
+    def schedule_catalog_publish(self):
+        """ Publish the command catalog for the web interface, changes within a second are published once """
+        if self.bot is None:
+            return
+
+        with self.catalog_lock:
+            if self.catalog_scheduled:
+                return
+            self.catalog_scheduled = True
+        ScheduleManager.execute_delayed(1, self.publish_catalog)
+
+    def publish_catalog(self):
+        with self.catalog_lock:
+            self.catalog_scheduled = False
+        self.catalog_uses = self.get_catalog_uses()
+        CommandCatalog.publish(self.bot.bot_name, self)
+
+    def get_catalog_uses(self):
+        """ The usage data of the database commands, the only part of the catalog that changes by itself """
+        return {
+            command_id: (command.data.num_uses, command.data.last_date_used)
+            for command_id, command in list(self.db_commands_by_id.items())
+            if command.data is not None
         }
 
-        merge_commands(self.internal_commands, self.data)
-        merge_commands(db_commands, self.data)
-        if self.module_manager is not None:
-            for enabled_module in self.module_manager.modules:
-                merge_commands(enabled_module.commands, self.data)
+    def refresh_catalog(self):
+        if self.get_catalog_uses() != self.catalog_uses:
+            self.publish_catalog()
 
     def load(self, **options):
         self.load_internal_commands()
@@ -300,19 +420,26 @@ class CommandManager(UserDict):
         return self
 
     def load_by_id(self, command_id):
+        commands = self.load_by_ids([command_id])
+        return commands[0] if commands else None
+
+    def load_by_ids(self, command_ids):
+        """ Loads the enabled commands with the given ids in one query """
         self.db_session.commit()
-        command = (
+        commands = (
             self.db_session.query(Command)
-            .filter_by(id=command_id, enabled=True)
-            .one_or_none()
+            .filter(Command.id.in_(command_ids))
+            .filter_by(enabled=True)
+            .all()
         )
-        if command:
+        for command in commands:
             self.add_db_command_aliases(command)
             self.db_session.expunge(command)
             if command.data is None:
                 log.info(f"Creating command data for {command.command}")
                 command.data = CommandData(command.id)
             self.db_session.add(command.data)
+        return commands
 
     def parse_for_web(self):
         commands = []
@@ -0,0 +1,126 @@
+import copy
+import hashlib
+import json
+import logging
+
+from greenbot.managers.redis import RedisManager
+
+log = logging.getLogger(__name__)
+
+
+class CommandCatalog:
+    """
+    The command list of the web interface, published to redis by the bot whenever the
+    commands change, so web requests never have to build it themselves.
+
+    The catalog is a redis hash with the JSON encoded command list (commands), the
+    body of /api/v1/commands (api), an ETag of the content (etag) and a version that is
+    bumped whenever the content changes (version).
+    """
+
+    # Check every so often whether num_uses or last_date_used changed
+    refresh_interval = 60
+
+    # The parsed command list of the web process, as (version, commands)
+    cached = (None, None)
+
+    @staticmethod
+    def redis_key(bot_name):
+        return f"{bot_name}:commands:catalog"
+
+    @staticmethod
+    def jsonify(bot_commands_list):
+        bot_commands_list.sort(key=lambda x: (x.id or -1, x.main_alias))
+        return [c.jsonify() for c in bot_commands_list]
+
+    @staticmethod
+    def build():
+        """ Load all commands like the web interface sees them, returns the jsonified list """
+        from greenbot.managers.command import CommandManager
+        from greenbot.models.module import ModuleManager
+
+        bot_commands = CommandManager(
+            socket_manager=None, module_manager=ModuleManager(None).load(), bot=None
+        ).load(load_examples=False)
+        return CommandCatalog.jsonify(bot_commands.parse_for_web())
+
+    @staticmethod
+    def detach(command, copies):
+        """ parse_command_for_web sets attributes on the commands, so it gets copies of the live ones """
+        copied = copies.get(id(command), None)
+        if copied is None:
+            copied = copies[id(command)] = copy.copy(command)
+            if command.action is not None and command.action.type == "multi":
+                copied.action = copy.copy(command.action)
+                copied.action.commands = {
+                    alias: CommandCatalog.detach(inner_command, copies)
+                    for alias, inner_command in command.action.commands.items()
+                }
+        return copied
+
+    @staticmethod
+    def serialize(command_manager):
+        """ The jsonified list of the commands in the index of a running CommandManager """
+        from greenbot.models.command import parse_command_for_web
+
+        copies = {}
+        bot_commands_list = []
+        for alias, command in list(command_manager.data.items()):
+            parse_command_for_web(
+                alias, CommandCatalog.detach(command, copies), bot_commands_list
+            )
+        return CommandCatalog.jsonify(bot_commands_list)
+
+    @staticmethod
+    def publish(bot_name, command_manager):
+        try:
+            commands = CommandCatalog.serialize(command_manager)
+        except:
+            log.exception("Unable to build the command catalog")
+            return
+
+        body = json.dumps(commands, separators=(",", ":"))
+        api_body = json.dumps(
+            {"commands": [c for c in commands if c["id"] is not None]},
+            separators=(",", ":"),
+        )
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+        redis = RedisManager.get()
+        key = CommandCatalog.redis_key(bot_name)
+        if redis.hget(key, "etag") == etag:
+            return
+
+        pipeline = redis.pipeline()
+        pipeline.hmset(key, {"commands": body, "api": api_body, "etag": etag})
+        pipeline.hincrby(key, "version", 1)
+        pipeline.execute()
+        log.debug(f"Published the command catalog with {len(commands)} commands")
+
+    @staticmethod
+    def get_api_body(bot_name):
+        """ Returns (etag, body) of /api/v1/commands, (None, None) if no catalog has been published """
+        etag, body = RedisManager.get().hmget(
+            CommandCatalog.redis_key(bot_name), "etag", "api"
+        )
+        return etag, body
+
+    @staticmethod
+    def get_commands(bot_name):
+        """ Returns the jsonified command list, None if no catalog has been published """
+        redis = RedisManager.get()
+        key = CommandCatalog.redis_key(bot_name)
+
+        cached_version, cached_commands = CommandCatalog.cached
+        version = redis.hget(key, "version")
+        if version is None:
+            return None
+        if version == cached_version:
+            return cached_commands
+
+        version, body = redis.hmget(key, "version", "commands")
+        if body is None:
+            return None
+        commands = json.loads(body)
+        CommandCatalog.cached = (version, commands)
+        return commands
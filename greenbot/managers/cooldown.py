@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+
+from greenbot.managers.redis import RedisManager
+from greenbot.utils import TTLCache
+
+log = logging.getLogger(__name__)
+
+
+class Cooldown:
+    """ A cooldown that was acquired, can be released to restore the previous run time """
+
+    __slots__ = ("key", "run_at", "previous", "ttl")
+
+    def __init__(self, key, run_at, previous, ttl):
+        self.key = key
+        self.run_at = run_at
+        self.previous = previous
+        self.ttl = ttl
+
+
+class MemoryCooldownStore:
+    """
+    Last run times (in milliseconds) in a bounded LRU cache.
+    Entries expire when their longest cooldown is over.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.runs = TTLCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+
+    def acquire(self, key, now, window, ttl):
+        with self.lock:
+            previous = self.runs.get(key)
+            if previous is not None and now - previous < window:
+                return False, previous
+            self.runs.set(key, now, ttl / 1000)
+            return True, previous
+
+    def release(self, key, run_at, previous, ttl):
+        with self.lock:
+            if self.runs.get(key) != run_at:
+                # Someone else has run the command since
+                return
+            remaining = 0 if previous is None else previous + ttl - run_at
+            if remaining > 0:
+                self.runs.set(key, previous, remaining / 1000)
+            else:
+                self.runs.pop(key)
+
+
+class RedisCooldownStore:
+    """
+    Last run times (in milliseconds) in redis, shared by all bot instances and kept across restarts.
+    Every key expires when its longest cooldown is over.
+    """
+
+    # The window depends on the level of the user, so a plain SET NX can't be used
+    acquire_script = """
+    local previous = redis.call("GET", KEYS[1])
+    if previous and tonumber(ARGV[1]) - tonumber(previous) < tonumber(ARGV[2]) then
+        return {0, previous}
+    end
+    redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[3])
+    return {1, previous or ""}
+    """
+
+    release_script = """
+    if redis.call("GET", KEYS[1]) ~= ARGV[1] then
+        return 0
+    end
+    if tonumber(ARGV[3]) > 0 then
+        redis.call("SET", KEYS[1], ARGV[2], "PX", ARGV[3])
+    else
+        redis.call("DEL", KEYS[1])
+    end
+    return 1
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        redis = RedisManager.get()
+        self.acquire_command = redis.register_script(self.acquire_script)
+        self.release_command = redis.register_script(self.release_script)
+
+    def acquire(self, key, now, window, ttl):
+        acquired, previous = self.acquire_command(
+            keys=[self.prefix + key], args=[now, window, ttl]
+        )
+        return acquired == 1, int(previous) if previous else None
+
+    def release(self, key, run_at, previous, ttl):
+        remaining = 0 if previous is None else previous + ttl - run_at
+        self.release_command(
+            keys=[self.prefix + key], args=[run_at, previous or 0, max(0, remaining)]
+        )
+
+
+class CooldownManager:
+    """
+    Global and per-user command cooldowns.
+
+    `acquire` checks and sets a cooldown in one step. If the command does not run after all,
+    the cooldown is released again, so only successful runs count.
+    """
+
+    store = MemoryCooldownStore()
+
+    @staticmethod
+    def init(backend="memory", maxsize=100000, redis_prefix=None):
+        if backend == "redis":
+            CooldownManager.store = RedisCooldownStore(redis_prefix)
+        elif backend == "memory":
+            CooldownManager.store = MemoryCooldownStore(maxsize)
+        else:
+            raise ValueError(f"Unknown cooldown backend: {backend}")
+
+    @staticmethod
+    def acquire(key, window, ttl=None):
+        """
+        Returns a Cooldown if `key` was not used in the last `window` seconds, None otherwise.
+        The run is remembered for `ttl` seconds (defaults to `window`).
+        """
+        now = int(time.time() * 1000)
+        window = int(window * 1000)
+        ttl = max(window if ttl is None else int(ttl * 1000), window, 1)
+        try:
+            acquired, previous = CooldownManager.store.acquire(key, now, window, ttl)
+        except:
+            # Don't block commands if the store is unreachable
+            log.exception(f"Unable to check cooldown {key}")
+            return Cooldown(key, now, None, ttl)
+
+        if not acquired:
+            log.debug(
+                f"{key} was used {(now - previous) / 1000:.2f} seconds ago, waiting..."
+            )
+            return None
+        return Cooldown(key, now, previous, ttl)
+
+    @staticmethod
+    def release(cooldowns):
+        for cooldown in cooldowns:
+            try:
+                CooldownManager.store.release(
+                    cooldown.key, cooldown.run_at, cooldown.previous, cooldown.ttl
+                )
+            except:
+                log.exception(f"Unable to release cooldown {cooldown.key}")
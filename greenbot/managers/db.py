@@ -9,10 +9,21 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 
+from greenbot.managers.metrics import MetricsManager
+
 Base = declarative_base()
 
 log = logging.getLogger("greenbot")
 
+session_duration = MetricsManager.histogram(
+    "greenbot_db_session_duration_seconds",
+    "Time from opening to closing a database session or cursor scope",
+    ["scope"],
+)
+pool_checkouts = MetricsManager.counter(
+    "greenbot_db_pool_checkouts_total", "Connections checked out of the pool"
+)
+
 
 class ServerNoticeLogger:
     def append(self, notice):
@@ -42,6 +53,15 @@ class DBManager:
             # This replaces the list object with a logger that logs the incoming notices
             dbapi_connection.notices = ServerNoticeLogger()
 
+        @event.listens_for(DBManager.engine, "checkout")
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            pool_checkouts.inc()
+
+        MetricsManager.gauge(
+            "greenbot_db_pool_checked_out",
+            "Connections currently checked out of the pool",
+        ).set_function(DBManager.engine.pool.checkedout)
+
         DBManager.Session = sessionmaker(bind=DBManager.engine, autoflush=False)
         DBManager.ScopedSession = scoped_session(sessionmaker(bind=DBManager.engine))
 
@@ -91,15 +111,16 @@ class DBManager:
     @staticmethod
     @contextmanager
     def create_session_scope(**options):
-        session = DBManager.create_session(**options)
-        try:
-            yield session
-            session.commit()
-        except:
-            session.rollback()
-            raise
-        finally:
-            session.close()
+        with session_duration.time(["session"]):
+            session = DBManager.create_session(**options)
+            try:
+                yield session
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
 
     @staticmethod
     @contextmanager
@@ -193,7 +214,9 @@ class DBManager:
     def create_dbapi_cursor_scope(autocommit=False):
         # The create_dbapi_connection_scope context manager just does basic setup/cleanup of resources,
         # not transaction control
-        with DBManager.create_dbapi_connection_scope(autocommit=autocommit) as sql_conn:
+        with session_duration.time(["dbapi"]), DBManager.create_dbapi_connection_scope(
+            autocommit=autocommit
+        ) as sql_conn:
             if autocommit:
                 # Using the cursor as a context manager just does cleanup on the resources of the cursor,
                 # it does not perform transaction control with BEGIN/COMMIT/ROLLBACK.
@@ -3,18 +3,24 @@ import logging
 import discord
 import traceback
 import asyncio
-import json
-from datetime import datetime, timedelta
+from datetime import timedelta
 
-from greenbot.models.user import User
-from greenbot.models.message import Message
-from greenbot.managers.db import DBManager
+from greenbot.managers.executor import ExecutorManager
 from greenbot.managers.schedule import ScheduleManager
 from greenbot.managers.handler import HandlerManager
+from greenbot.managers.metrics import MetricsManager
+from greenbot.managers.timeout import TimeoutStore
+from greenbot.managers.user_cache import UserCache
 import greenbot.utils as utils
 
 log = logging.getLogger("greenbot")
 
+send_duration = MetricsManager.histogram(
+    "greenbot_discord_send_duration_seconds",
+    "Time until Discord accepted a sent message",
+    ["target"],
+)
+
 
 class CustomClient(discord.Client):
     def __init__(self, bot):
@@ -27,47 +33,50 @@ class CustomClient(discord.Client):
             log.error("Discord Guild not found!")
             return
         log.info(f"Discord Bot has started with id {self.user.id}")
-        HandlerManager.trigger("discord_ready")
+        await ExecutorManager.run_async(
+            self.bot.private_loop, HandlerManager.trigger, "discord_ready"
+        )
 
     async def on_message(self, message):
-        member = self.bot.guild.get_member(message.author.id)
         if isinstance(message.author, discord.Member) and (
             message.guild != self.bot.guild
         ):
             return
-        with DBManager.create_session_scope() as db_session:
-            user = User._create_or_get_by_discord_id(
-                db_session,
-                message.author.id,
-                user_name=str(member) if member else str(message.author),
-            )
-            Message._create(
-                db_session,
-                message.id,
-                message.author.id,
-                message.channel.id
-                if isinstance(message.author, discord.Member)
-                else None,
-                message.content,
-            )
-            db_session.commit()
-            HandlerManager.trigger(
-                "discord_message",
-                message_raw=message,
-                message=message.content,
-                author=message.author,
-                user_level=user.level if user else 50,
-                channel=message.channel
-                if isinstance(message.author, discord.Member)
-                else None,
-                whisper=not isinstance(message.author, discord.Member),
-            )
+        # Everything below queries the database, so it must not run on the event loop
+        await ExecutorManager.run_async(
+            self.bot.private_loop, self.process_message, message
+        )
+
+    def process_message(self, message):
+        member = self.bot.guild.get_member(message.author.id)
+        self.bot.bot.message_buffer.add(
+            message.id,
+            message.author.id,
+            message.channel.id if isinstance(message.author, discord.Member) else None,
+            message.content,
+            user_name=str(member) if member else str(message.author),
+        )
+        user_level = UserCache.get(message.author.id).level
+        HandlerManager.trigger(
+            "discord_message",
+            message_raw=message,
+            message=message.content,
+            author=message.author,
+            user_level=user_level,
+            channel=message.channel
+            if isinstance(message.author, discord.Member)
+            else None,
+            whisper=not isinstance(message.author, discord.Member),
+        )
 
     async def on_error(self, event, *args, **kwargs):
         log.error(traceback.format_exc())
 
 
 class DiscordBotManager:
+    # Seconds until a failed timed unban is tried again
+    unban_retry_delay = 60
+
     def __init__(self, bot, settings, redis, private_loop):
         self.bot = bot
         self.settings = settings
@@ -77,39 +86,75 @@ class DiscordBotManager:
         self.redis = redis
 
         self.guild = None
-        if not self.redis.get("timeouts-discord") or not json.loads(self.redis.get("timeouts-discord")):
-            self.redis.set("timeouts-discord", json.dumps({}))
-        
+        self.timeouts = TimeoutStore(self.redis, self.settings["bot_name"])
+        self.unban_job = None
+
         HandlerManager.add_handler("discord_ready", self.initial_unbans)
 
     def initial_unbans(self):
         try:
-            data = json.loads(self.redis.get("timeouts-discord"))
-            for user in data:
-                unban_date = data[user]["unban_date"]
-                if ":" in unban_date[-5:]:
-                    unban_date = f"{unban_date[:-5]}{unban_date[-5:-3]}{unban_date[-2:]}"
-                unban_date = datetime.strptime(unban_date, "%Y-%m-%d %H:%M:%S.%f%z")
-                time_now = utils.now()
-                if unban_date < time_now:
-                    ScheduleManager.execute_now(method=self.unban, args=[data[user]["discord_id"], "Unbanned by timer"])
-                    continue
-                ScheduleManager.execute_delayed(delay=(unban_date - time_now).seconds, method=self.unban, args=[data[user]["discord_id"], "Unbanned by timer"])
-        except Exception as e:
-            log.exception(e)
-            self.redis.set("timeouts-discord", json.dumps({}))
+            self.timeouts.migrate_legacy()
+        except:
+            log.exception("Unable to migrate the legacy timeouts")
+
+        # on_ready is fired again after reconnecting
+        if self.unban_job is None:
+            self.unban_job = ScheduleManager.execute_every(1, self.unban_due_timeouts)
+
+    def unban_due_timeouts(self):
+        try:
+            while True:
+                timeouts = self.timeouts.pop_due(limit=100)
+                for user_id, data in timeouts:
+                    future = self.run_coroutine(
+                        self._unban(
+                            user_id=user_id, reason="Unbanned by timer", timed=True
+                        )
+                    )
+                    future.add_done_callback(
+                        lambda f, user_id=user_id, data=data: self.on_timed_unban(
+                            user_id, data, f
+                        )
+                    )
+                if len(timeouts) < 100:
+                    break
+        except:
+            log.exception("Unable to process the timed unbans")
+
+    def on_timed_unban(self, user_id, data, future):
+        """ The timeout was popped before the unban, put it back if the unban failed """
+        if not future.cancelled() and future.exception() is None and future.result():
+            return
+
+        log.warning(
+            f"Timed unban of {user_id} failed, retrying in {self.unban_retry_delay} seconds"
+        )
+        # Called on the bot loop, keep redis off it. An unban added in the meantime is kept
+        ExecutorManager.submit(
+            self.timeouts.add,
+            user_id,
+            utils.now() + timedelta(seconds=self.unban_retry_delay),
+            data.get("reason", None),
+            only_new=True,
+        )
+
+    def run_coroutine(self, coro):
+        """ Schedule the coroutine on the bot's event loop. Safe to call from any thread """
+        future = asyncio.run_coroutine_threadsafe(coro, self.private_loop)
+        future.add_done_callback(lambda f: ExecutorManager.log_exception(coro, f))
+        return future
 
     def private_message(self, user, message, embed=None):
-        self.private_loop.create_task(self._private_message(user, message, embed))
+        self.run_coroutine(self._private_message(user, message, embed))
 
     def remove_role(self, user, role, reason=None):
-        self.private_loop.create_task(self._remove_role(user, role, reason))
+        self.run_coroutine(self._remove_role(user, role, reason))
 
     def add_role(self, user, role, reason=None):
-        self.private_loop.create_task(self._add_role(user, role, reason))
+        self.run_coroutine(self._add_role(user, role, reason))
 
     def ban(self, user, timeout_in_seconds=0, reason=None, delete_message_days=0):
-        self.private_loop.create_task(
+        self.run_coroutine(
             self._ban(
                 user=user,
                 timeout_in_seconds=timeout_in_seconds,
@@ -119,10 +164,10 @@ class DiscordBotManager:
         )
 
     def unban(self, user_id, reason=None):
-        self.private_loop.create_task(self._unban(user_id=user_id, reason=reason))
+        self.run_coroutine(self._unban(user_id=user_id, reason=reason))
 
     def kick(self, user, reason=None):
-        self.private_loop.create_task(self._kick(user=user, reason=reason))
+        self.run_coroutine(self._kick(user=user, reason=reason))
 
     def get_role_id(self, role_name):
         for role in self.guild.roles:
@@ -143,14 +188,13 @@ class DiscordBotManager:
             return None
 
     def say(self, channel, message, embed=None):
-        self.private_loop.create_task(
-            self._say(channel=channel, message=message, embed=embed)
-        )
+        self.run_coroutine(self._say(channel=channel, message=message, embed=embed))
 
     async def _say(self, channel, message, embed=None):
         message = discord.utils.escape_markdown(message)
         if channel and (message or embed):
-            await channel.send(content=message, embed=embed)
+            with send_duration.time(["channel"]):
+                await channel.send(content=message, embed=embed)
 
     async def _ban(
         self, user, timeout_in_seconds=0, reason=None, delete_message_days=0
@@ -173,32 +217,40 @@ class DiscordBotManager:
             pass
         if timeout_in_seconds > 0:
             reason = f"{reason} for {timeout_in_seconds} seconds"
-            timeouts = json.loads(self.redis.get("timeouts-discord"))
-            timeouts[str(user.id)] = {
-                "discord_id": str(user.id),
-                "unban_date": str(utils.now() + timedelta(seconds=timeout_in_seconds)),
-                "reason": str(reason)
-            }
-            self.redis.set("timeouts-discord", json.dumps(timeouts))
-            ScheduleManager.execute_delayed(delay=timeout_in_seconds, method=self.unban, args=[user.id, "Unbanned by timer"])
+            await ExecutorManager.run_async(
+                self.private_loop,
+                self.timeouts.add,
+                user.id,
+                utils.now() + timedelta(seconds=timeout_in_seconds),
+                reason,
+            )
         await self.guild.ban(
             user=user, reason=reason, delete_message_days=delete_message_days
         )
 
-    async def _unban(self, user_id, reason=None):
+    async def _unban(self, user_id, reason=None, timed=False):
+        """
+        Returns False if the user could not be unbanned.
+        Timed unbans were already popped from the store, a ban added since then is kept.
+        """
         if not self.guild:
-            return
-        user = await self.client.fetch_user(int(user_id))
-        timeouts = json.loads(self.redis.get("timeouts-discord"))
-        if str(user_id) in timeouts:
-            del timeouts[str(user_id)]
-            self.redis.set("timeouts-discord", json.dumps(timeouts))
+            return False
         try:
-            ban = await self.guild.fetch_ban(user)
-            if ban:
-                await self.guild.unban(user=user, reason=reason)
-        except:
+            user = await self.client.fetch_user(int(user_id))
+            await self.guild.fetch_ban(user)
+            await self.guild.unban(user=user, reason=reason)
+        except discord.NotFound:
+            # The account was deleted, or the user is not banned (anymore)
             pass
+        except:
+            log.exception(f"Unable to unban {user_id}")
+            return False
+
+        if not timed:
+            await ExecutorManager.run_async(
+                self.private_loop, self.timeouts.remove, user_id
+            )
+        return True
 
     async def _kick(self, user, reason=None):
         if not self.guild:
@@ -212,7 +264,8 @@ class DiscordBotManager:
             message = None
         if not message and not embed:
             return
-        await user.dm_channel.send(content=message, embed=embed)
+        with send_duration.time(["private"]):
+            await user.dm_channel.send(content=message, embed=embed)
 
     async def _remove_role(self, user, role, reason=None):
         if not self.guild:
@@ -234,19 +287,15 @@ class DiscordBotManager:
                     log.error(e)
 
     def schedule_task_periodically(self, wait_time, func, *args):
-        return self.private_loop.create_task(
-            self.run_periodically(wait_time, func, *args)
-        )
+        """ Returns a concurrent.futures.Future, cancel it with cancel_scheduled_task """
+        return self.run_coroutine(self.run_periodically(wait_time, func, *args))
 
-    async def cancel_scheduled_task(self, task):
+    def cancel_scheduled_task(self, task):
+        # Cancelling the future cancels the task on the loop
         task.cancel()
-        try:
-            await task
-        except asyncio.CancelledError:
-            pass
 
     def connect(self):
-        self.private_loop.create_task(self._connect())
+        self.run_coroutine(self._connect())
 
     async def _connect(self):
         try:
@@ -255,7 +304,7 @@ class DiscordBotManager:
             log.error(e)
 
     def stop(self):
-        self.private_loop.create_task(self._stop())
+        self.run_coroutine(self._stop())
 
     async def _stop(self):
         log.info("Discord closing")
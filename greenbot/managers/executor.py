@@ -0,0 +1,102 @@
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from greenbot.managers.metrics import MetricsManager
+
+log = logging.getLogger(__name__)
+
+
+class ExecutorManager:
+    """
+    Bounded thread pool for blocking work (database queries, handlers that query the database)
+    that must not run on the discord.py event loop.
+    """
+
+    executor = None
+
+    # Work items that were submitted and are not finished yet
+    pending = 0
+    pending_lock = threading.Lock()
+
+    @staticmethod
+    def init(max_workers=8):
+        if not ExecutorManager.executor:
+            ExecutorManager.executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="WorkerThread"
+            )
+
+            MetricsManager.gauge(
+                "greenbot_executor_queue_depth",
+                "Work items that are queued or running in the worker threads",
+            ).set_function(ExecutorManager.queue_depth)
+
+    @staticmethod
+    def submit(method, *args, **kwargs):
+        """ Run the method in the pool without waiting for it. Exceptions are logged """
+        if ExecutorManager.executor is None:
+            raise ValueError("No executor available")
+
+        ExecutorManager.add_pending(1)
+        try:
+            future = ExecutorManager.executor.submit(
+                ExecutorManager.run_tracked, method, *args, **kwargs
+            )
+        except:
+            ExecutorManager.add_pending(-1)
+            raise
+        future.add_done_callback(
+            functools.partial(ExecutorManager.log_exception, method)
+        )
+        return future
+
+    @staticmethod
+    def run_async(loop, method, *args, **kwargs):
+        """ Run the method in the pool, returns an awaitable that resolves on the given loop """
+        if ExecutorManager.executor is None:
+            raise ValueError("No executor available")
+
+        ExecutorManager.add_pending(1)
+        try:
+            return loop.run_in_executor(
+                ExecutorManager.executor,
+                functools.partial(ExecutorManager.run_tracked, method, *args, **kwargs),
+            )
+        except:
+            ExecutorManager.add_pending(-1)
+            raise
+
+    @staticmethod
+    def add_pending(amount):
+        with ExecutorManager.pending_lock:
+            ExecutorManager.pending += amount
+
+    @staticmethod
+    def run_tracked(method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        finally:
+            ExecutorManager.add_pending(-1)
+
+    @staticmethod
+    def queue_depth():
+        return ExecutorManager.pending
+
+    @staticmethod
+    def log_exception(method, future):
+        if future.cancelled():
+            return
+
+        exception = future.exception()
+        if exception is not None:
+            log.error(
+                f"Unhandled exception in {method}",
+                exc_info=(type(exception), exception, exception.__traceback__),
+            )
+
+    @staticmethod
+    def shutdown(wait=True):
+        if ExecutorManager.executor is not None:
+            ExecutorManager.executor.shutdown(wait=wait)
+            ExecutorManager.executor = None
@@ -1,17 +1,110 @@
+import asyncio
+import bisect
+import concurrent.futures
+import json
 import logging
-import operator
+import threading
+import time
 
-from greenbot.utils import find
+from greenbot.managers.redis import RedisManager
 
 log = logging.getLogger("greenbot")
 
 
+class HandlerStats:
+    """ Call count, error count and latency histogram of one handler """
+
+    # Upper bounds of the latency buckets in seconds, the last bucket is unbounded
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(self.buckets) + 1)
+
+    def record(self, duration, failed=False):
+        index = bisect.bisect_left(self.buckets, duration)
+        with self.lock:
+            self.count += 1
+            if failed:
+                self.errors += 1
+            self.total_time += duration
+            self.max_time = max(self.max_time, duration)
+            self.histogram[index] += 1
+
+    def percentile(self, histogram, count, max_time, q):
+        """ Upper bound of the bucket the q-th quantile falls in, the max time for the last bucket """
+        target = q * count
+        seen = 0
+        for index, bucket_count in enumerate(histogram[:-1]):
+            seen += bucket_count
+            if seen >= target:
+                return min(self.buckets[index], max_time)
+        return max_time
+
+    def get(self):
+        with self.lock:
+            count = self.count
+            errors = self.errors
+            total_time = self.total_time
+            max_time = self.max_time
+            histogram = list(self.histogram)
+
+        return {
+            "count": count,
+            "errors": errors,
+            "mean_time": total_time / count if count else 0.0,
+            "max_time": max_time,
+            "p50_time": self.percentile(histogram, count, max_time, 0.5),
+            "p95_time": self.percentile(histogram, count, max_time, 0.95),
+            "histogram": histogram,
+        }
+
+
+class Handler:
+    __slots__ = ("method", "priority", "name", "is_coroutine", "stats")
+
+    def __init__(self, method, priority):
+        self.method = method
+        self.priority = priority
+        self.name = getattr(method, "__qualname__", repr(method))
+        self.is_coroutine = asyncio.iscoroutinefunction(method)
+        self.stats = HandlerStats()
+
+
 class HandlerManager:
+    """
+    Event bus of the bot.
+
+    Handlers are kept in buckets per priority, and every event has a snapshot of its
+    handlers in call order (highest priority first) that is rebuilt when a handler is
+    added or removed, so triggering an event never sorts or locks.
+
+    Handlers can be plain functions or coroutine functions, coroutines are run on the
+    bot loop. Every call is timed, see `get_stats`.
+    """
+
+    # event => {priority: [handler, ...]}
+    buckets = {}
+    # event => priorities of the buckets, negated so they're sorted highest first
+    priorities = {}
+    # event => tuple of handlers in call order
     handlers = {}
+    lock = threading.Lock()
+
+    loop = None
+    # Seconds to wait for a coroutine handler when the event is triggered off the loop
+    async_timeout = 30
 
     @staticmethod
-    def init_handlers():
+    def init_handlers(loop=None):
+        HandlerManager.buckets = {}
+        HandlerManager.priorities = {}
         HandlerManager.handlers = {}
+        HandlerManager.loop = loop
 
         # When the discord bot is ready!
         HandlerManager.create_handler("discord_ready")
@@ -28,51 +121,180 @@ class HandlerManager:
     @staticmethod
     def create_handler(event):
         """ Create an empty list for the given event """
-        HandlerManager.handlers[event] = []
+        with HandlerManager.lock:
+            HandlerManager.buckets[event] = {}
+            HandlerManager.priorities[event] = []
+            HandlerManager.handlers[event] = ()
+
+    @staticmethod
+    def rebuild(event):
+        buckets = HandlerManager.buckets[event]
+        HandlerManager.handlers[event] = tuple(
+            handler
+            for priority in HandlerManager.priorities[event]
+            for handler in buckets[-priority]
+        )
 
     @staticmethod
     def add_handler(event, method, priority=0):
-        try:
-            HandlerManager.handlers[event].append((method, priority))
-            HandlerManager.handlers[event].sort(
-                key=operator.itemgetter(1), reverse=True
-            )
-        except KeyError:
-            # No handlers for this event found
-            log.error(f"add_handler No handler for {event} found.")
+        with HandlerManager.lock:
+            try:
+                buckets = HandlerManager.buckets[event]
+            except KeyError:
+                # No handlers for this event found
+                log.error(f"add_handler No handler for {event} found.")
+                return
+
+            bucket = buckets.get(priority, None)
+            if bucket is None:
+                bucket = buckets[priority] = []
+                bisect.insort(HandlerManager.priorities[event], -priority)
+            bucket.append(Handler(method, priority))
+            HandlerManager.rebuild(event)
 
     @staticmethod
     def method_matches(h, method):
-        return h[0] == method
+        return h.method == method
 
     @staticmethod
     def remove_handler(event, method):
-        handler = None
-        try:
-            handler = find(
-                lambda h: HandlerManager.method_matches(h, method),
-                HandlerManager.handlers[event],
-            )
-            if handler is not None:
-                HandlerManager.handlers[event].remove(handler)
-        except KeyError:
-            # No handlers for this event found
-            log.error(f"remove_handler No handler for {event} found.")
+        with HandlerManager.lock:
+            try:
+                buckets = HandlerManager.buckets[event]
+            except KeyError:
+                # No handlers for this event found
+                log.error(f"remove_handler No handler for {event} found.")
+                return
+
+            for priority, bucket in buckets.items():
+                handler = next(
+                    (h for h in bucket if HandlerManager.method_matches(h, method)),
+                    None,
+                )
+                if handler is None:
+                    continue
+
+                bucket.remove(handler)
+                if not bucket:
+                    del buckets[priority]
+                    HandlerManager.priorities[event].remove(-priority)
+                HandlerManager.rebuild(event)
+                return
 
     @staticmethod
     def trigger(event_name, stop_on_false=True, *args, **kwargs):
-        if event_name not in HandlerManager.handlers:
+        handlers = HandlerManager.handlers.get(event_name, None)
+        if handlers is None:
             log.error(f"No handler set for event {event_name}")
             return False
 
-        for handler, _ in HandlerManager.handlers[event_name]:
-            res = None
-            try:
-                res = handler(*args, **kwargs)
-            except:
-                log.exception(f"Unhandled exception from {handler} in {event_name}")
+        for handler in handlers:
+            if handler.is_coroutine:
+                res = HandlerManager.call_coroutine(event_name, handler, args, kwargs)
+            else:
+                res = HandlerManager.call(event_name, handler, args, kwargs)
 
             if res is False and stop_on_false is True:
                 # Abort if handler returns false and stop_on_false is enabled
                 return False
         return True
+
+    @staticmethod
+    def call(event_name, handler, args, kwargs):
+        failed = False
+        start = time.perf_counter()
+        try:
+            return handler.method(*args, **kwargs)
+        except:
+            failed = True
+            log.exception(f"Unhandled exception from {handler.name} in {event_name}")
+            return None
+        finally:
+            handler.stats.record(time.perf_counter() - start, failed)
+
+    @staticmethod
+    async def run_coroutine(event_name, handler, args, kwargs):
+        failed = False
+        start = time.perf_counter()
+        try:
+            return await handler.method(*args, **kwargs)
+        except asyncio.CancelledError:
+            failed = True
+            raise
+        except:
+            failed = True
+            log.exception(f"Unhandled exception from {handler.name} in {event_name}")
+            return None
+        finally:
+            handler.stats.record(time.perf_counter() - start, failed)
+
+    @staticmethod
+    def on_loop():
+        try:
+            return asyncio.get_running_loop() is HandlerManager.loop
+        except RuntimeError:
+            return False
+
+    @staticmethod
+    def call_coroutine(event_name, handler, args, kwargs):
+        loop = HandlerManager.loop
+        if loop is None:
+            log.error(f"No loop to run {handler.name} in {event_name} on")
+            return None
+
+        coro = HandlerManager.run_coroutine(event_name, handler, args, kwargs)
+        if HandlerManager.on_loop():
+            # Waiting for the result here would block the loop, so it can't stop the event
+            loop.create_task(coro)
+            return None
+
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        try:
+            return future.result(HandlerManager.async_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            log.error(
+                f"{handler.name} in {event_name} did not finish within {HandlerManager.async_timeout}s"
+            )
+            return None
+
+    @staticmethod
+    def get_stats(event_name=None):
+        """ Returns the stats of every handler (of the given event), slowest first """
+        stats = []
+        for event, handlers in list(HandlerManager.handlers.items()):
+            if event_name is not None and event != event_name:
+                continue
+            for handler in handlers:
+                stats.append(
+                    {
+                        "event": event,
+                        "handler": handler.name,
+                        "priority": handler.priority,
+                        **handler.stats.get(),
+                    }
+                )
+        stats.sort(key=lambda s: s["mean_time"], reverse=True)
+        return stats
+
+    @staticmethod
+    def redis_key(bot_name):
+        return f"{bot_name}:handler-stats"
+
+    @staticmethod
+    def publish_stats(bot_name):
+        """ Store the stats in redis, so the web interface can show them """
+        try:
+            RedisManager.get().set(
+                HandlerManager.redis_key(bot_name),
+                json.dumps(HandlerManager.get_stats()),
+            )
+        except:
+            log.exception("Unable to publish handler stats")
+
+    @staticmethod
+    def get_published_stats(bot_name, limit=20):
+        stats = RedisManager.get().get(HandlerManager.redis_key(bot_name))
+        if stats is None:
+            return []
+        return json.loads(stats)[:limit]
@@ -0,0 +1,160 @@
+import logging
+import threading
+from collections import Counter
+from collections import deque
+
+from psycopg2.extras import execute_values
+
+from greenbot import utils
+from greenbot.managers.db import DBManager
+from greenbot.managers.metrics import MetricsManager
+from greenbot.managers.schedule import ScheduleManager
+from greenbot.models.user_activity import UserActivityHourly
+
+log = logging.getLogger(__name__)
+
+messages_received = MetricsManager.counter(
+    "greenbot_messages_received_total", "Chat messages received"
+)
+messages_written = MetricsManager.counter(
+    "greenbot_messages_written_total", "Chat messages written to the database"
+)
+message_flush_duration = MetricsManager.histogram(
+    "greenbot_message_flush_duration_seconds", "Time spent writing a message batch"
+)
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer for incoming chat messages.
+
+    Messages are queued in memory and written to the database in batches,
+    either when `batch_size` messages are pending or every `flush_interval` seconds,
+    whichever comes first. The user rows the messages reference and the hourly activity
+    rollup are upserted in the same transaction, so the message foreign key is always
+    satisfied and the rollup counts match the message table.
+
+    If the queue grows beyond `max_pending` (e.g. because the database is slow or down),
+    the producer flushes inline. This slows down ingestion instead of letting the queue
+    grow without bounds.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=2, max_pending=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max(max_pending, batch_size)
+
+        self.pending = deque()
+        self.lock = threading.Lock()
+        # Only one flush may run at a time, so batches are written in order
+        self.flush_lock = threading.Lock()
+        self.flush_scheduled = False
+
+        self.flush_job = ScheduleManager.execute_every(self.flush_interval, self.flush)
+
+        MetricsManager.gauge(
+            "greenbot_messages_pending", "Chat messages waiting to be written"
+        ).set_function(lambda: len(self.pending))
+
+    def add(self, message_id, user_id, channel_id, content, user_name=""):
+        row = (
+            str(message_id),
+            str(user_id),
+            str(channel_id) if channel_id is not None else None,
+            content,
+            utils.now(),
+            user_name,
+        )
+
+        messages_received.inc()
+        with self.lock:
+            self.pending.append(row)
+            num_pending = len(self.pending)
+            schedule_flush = num_pending >= self.batch_size and not self.flush_scheduled
+            if schedule_flush:
+                self.flush_scheduled = True
+
+        if num_pending >= self.max_pending:
+            log.warning(
+                f"Message buffer is full ({num_pending} pending messages), flushing inline"
+            )
+            self.flush()
+        elif schedule_flush:
+            ScheduleManager.execute_now(self.flush)
+
+    def flush(self):
+        """ Write all pending messages to the database. Returns the number of messages written. """
+        with self.flush_lock:
+            with self.lock:
+                self.flush_scheduled = False
+                if not self.pending:
+                    return 0
+                batch = list(self.pending)
+                self.pending.clear()
+
+            try:
+                with message_flush_duration.time():
+                    self._write(batch)
+            except:
+                log.exception(f"Failed to write {len(batch)} buffered messages")
+                with self.lock:
+                    # Put the batch back in front of the queue, dropping the oldest rows if we are over capacity
+                    self.pending.extendleft(reversed(batch))
+                    while len(self.pending) > self.max_pending:
+                        self.pending.popleft()
+                return 0
+
+        messages_written.inc(len(batch))
+        return len(batch)
+
+    @staticmethod
+    def _write(batch):
+        # ON CONFLICT DO UPDATE may only touch a row once per statement, so dedupe the users first
+        users = {}
+        for message_id, user_id, channel_id, content, time_sent, user_name in batch:
+            users[user_id] = user_name
+
+        with DBManager.create_dbapi_cursor_scope() as cursor:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO "user"(discord_id, user_name, points, level) VALUES %s
+                ON CONFLICT (discord_id) DO UPDATE SET user_name = EXCLUDED.user_name
+                """,
+                [(user_id, user_name, 0, 100) for user_id, user_name in users.items()],
+                page_size=len(users),
+            )
+            inserted = execute_values(
+                cursor,
+                """
+                INSERT INTO message(message_id, user_id, channel_id, content, time_sent, credited) VALUES %s
+                ON CONFLICT DO NOTHING
+                RETURNING user_id, channel_id, time_sent
+                """,
+                [row[:5] + (False,) for row in batch],
+                page_size=len(batch),
+                fetch=True,
+            )
+
+            # Only count the messages that were actually inserted, so retried batches aren't counted twice
+            hourly_counts = Counter(
+                (user_id, channel_id or "", UserActivityHourly.truncate_hour(time_sent))
+                for user_id, channel_id, time_sent in inserted
+            )
+            if hourly_counts:
+                execute_values(
+                    cursor,
+                    """
+                    INSERT INTO user_activity_hourly(user_id, channel_id, hour, message_count, credited_count) VALUES %s
+                    ON CONFLICT (user_id, channel_id, hour) DO UPDATE
+                    SET message_count = user_activity_hourly.message_count + EXCLUDED.message_count
+                    """,
+                    [key + (count, 0) for key, count in hourly_counts.items()],
+                    page_size=len(hourly_counts),
+                )
+
+    def quit(self):
+        """ Stop the periodic flush and write everything that is still pending """
+        self.flush_job.remove()
+        num_written = self.flush()
+        log.info(f"Flushed {num_written} buffered messages")
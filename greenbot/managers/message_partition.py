@@ -0,0 +1,165 @@
+import datetime
+import logging
+
+from greenbot import utils
+from greenbot.managers.db import DBManager
+from greenbot.managers.schedule import ScheduleManager
+
+log = logging.getLogger(__name__)
+
+
+class MessagePartitionManager:
+    """
+    The message table is partitioned by month on time_sent (see migration 0002).
+
+    Once a day, partitions for the coming months are created, and partitions that are
+    older than the retention period are dropped, or detached so they can be archived.
+    Dropping a partition is instant, unlike deleting its rows one by one.
+    """
+
+    months_ahead = 2
+    # Number of full months to keep, 0 keeps all messages
+    retention_months = 0
+    # "drop" or "detach"
+    retention_mode = "detach"
+    job = None
+
+    @staticmethod
+    def init(retention_months=0, retention_mode="detach", months_ahead=2):
+        if retention_mode not in ("drop", "detach"):
+            raise ValueError(f"Unknown message retention mode: {retention_mode}")
+
+        MessagePartitionManager.retention_months = retention_months
+        MessagePartitionManager.retention_mode = retention_mode
+        MessagePartitionManager.months_ahead = months_ahead
+
+        ScheduleManager.execute_now(MessagePartitionManager.run)
+        MessagePartitionManager.job = ScheduleManager.execute_every(
+            24 * 60 * 60, MessagePartitionManager.run
+        )
+
+    @staticmethod
+    def month_start(dt, months=0):
+        """ Returns the start of the month of dt, moved by the given number of months """
+        month = dt.year * 12 + dt.month - 1 + months
+        return datetime.datetime(
+            month // 12, month % 12 + 1, 1, tzinfo=datetime.timezone.utc
+        )
+
+    @staticmethod
+    def partition_name(month_start):
+        return f"message_y{month_start.year:04d}m{month_start.month:02d}"
+
+    @staticmethod
+    def create_partition(cursor, month_start):
+        """
+        Creates the partition of the month, unless it exists.
+        Messages of that month in the default partition are moved into it, postgres
+        refuses to create the partition while they are there.
+        """
+        name = MessagePartitionManager.partition_name(month_start)
+        bounds = (month_start, MessagePartitionManager.month_start(month_start, 1))
+
+        cursor.execute("SELECT to_regclass(%s)", (name,))
+        if cursor.fetchone()[0] is not None:
+            return
+
+        # Block new rows in the default partition until the partition is attached
+        cursor.execute("LOCK TABLE message_default IN EXCLUSIVE MODE")
+        cursor.execute(
+            "SELECT EXISTS(SELECT 1 FROM message_default WHERE time_sent >= %s AND time_sent < %s)",
+            bounds,
+        )
+        if not cursor.fetchone()[0]:
+            cursor.execute(
+                f"CREATE TABLE {name} PARTITION OF message FOR VALUES FROM (%s) TO (%s)",
+                bounds,
+            )
+            return
+
+        cursor.execute(
+            f"CREATE TABLE {name} (LIKE message INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        )
+        cursor.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM message_default WHERE time_sent >= %s AND time_sent < %s
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+            """,
+            bounds,
+        )
+        num_moved = cursor.rowcount
+        cursor.execute(
+            f"ALTER TABLE message ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+            bounds,
+        )
+        log.warning(
+            f"Moved {num_moved} messages from the default partition into the new partition {name}"
+        )
+
+    @staticmethod
+    def get_partitions(cursor):
+        """ Returns a dictionary of month start => partition name of the monthly partitions """
+        cursor.execute(
+            """
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+            JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+            WHERE parent.relname = 'message'
+            """
+        )
+        partitions = {}
+        for (name,) in cursor.fetchall():
+            try:
+                month_start = datetime.datetime.strptime(
+                    name, "message_y%Ym%m"
+                ).replace(tzinfo=datetime.timezone.utc)
+            except ValueError:
+                # The default partition
+                continue
+            partitions[month_start] = name
+        return partitions
+
+    @staticmethod
+    def run():
+        try:
+            MessagePartitionManager.create_partitions()
+            if MessagePartitionManager.retention_months > 0:
+                MessagePartitionManager.remove_old_partitions()
+        except:
+            log.exception("Unable to maintain the message partitions")
+
+    @staticmethod
+    def create_partitions():
+        now = utils.now()
+        for months in range(MessagePartitionManager.months_ahead + 1):
+            month_start = MessagePartitionManager.month_start(now, months)
+            # One transaction per month, so a failing month doesn't block the others
+            try:
+                with DBManager.create_dbapi_cursor_scope() as cursor:
+                    MessagePartitionManager.create_partition(cursor, month_start)
+            except:
+                log.exception(
+                    f"Unable to create the message partition {MessagePartitionManager.partition_name(month_start)}"
+                )
+
+    @staticmethod
+    def remove_old_partitions():
+        cutoff = MessagePartitionManager.month_start(
+            utils.now(), -MessagePartitionManager.retention_months
+        )
+        with DBManager.create_dbapi_cursor_scope() as cursor:
+            partitions = MessagePartitionManager.get_partitions(cursor)
+            for month_start, name in sorted(partitions.items()):
+                if month_start >= cutoff:
+                    continue
+
+                if MessagePartitionManager.retention_mode == "drop":
+                    cursor.execute(f"DROP TABLE {name}")
+                    log.info(f"Dropped message partition {name}")
+                else:
+                    cursor.execute(f"ALTER TABLE message DETACH PARTITION {name}")
+                    cursor.execute(f"ALTER TABLE {name} RENAME TO archived_{name}")
+                    log.info(f"Detached message partition {name} as archived_{name}")
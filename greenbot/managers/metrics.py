@@ -0,0 +1,239 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+log = logging.getLogger(__name__)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labelnames, labelvalues):
+    if not labelnames:
+        return ""
+    labels = ",".join(
+        f'{name}="{escape_label_value(value)}"'
+        for name, value in zip(labelnames, labelvalues)
+    )
+    return f"{{{labels}}}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def get_key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}")
+        return tuple(str(value) for value in labels)
+
+    def samples(self):
+        """ Yields (suffix, labelnames, labelvalues, value) """
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield "", self.labelnames, labels, value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labelnames, labelvalues, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{format_labels(labelnames, labelvalues)} {format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, labels=()):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value, labels=()):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, labels=()):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set_function(self, function):
+        """ The value of the gauge is read from function() when the metrics are collected """
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+
+        try:
+            value = self.function()
+        except:
+            log.exception(f"Unable to collect {self.name}")
+            return
+        yield "", (), (), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        key = self.get_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key, None)
+            if counts is None:
+                # One count per bucket and the +Inf bucket, followed by the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, labels=()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts)) for labels, counts in self.values.items()]
+
+        labelnames = self.labelnames + ("le",)
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", labelnames, labels + (format_value(bound),), cumulative
+            yield "_sum", self.labelnames, labels, counts[-1]
+            yield "_count", self.labelnames, labels, cumulative
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = MetricsManager.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(f"Metrics request from {self.address_string()}: {format % args}")
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsManager:
+    """
+    Registry of the process metrics, served in the Prometheus text format on /metrics.
+
+    Metrics are created once with `counter`, `gauge` or `histogram`, calling them again
+    with the same name returns the existing metric.
+    """
+
+    metrics = {}
+    lock = threading.Lock()
+    server = None
+
+    @staticmethod
+    def register(cls, name, documentation, labelnames=(), **options):
+        with MetricsManager.lock:
+            metric = MetricsManager.metrics.get(name, None)
+            if metric is None:
+                metric = MetricsManager.metrics[name] = cls(
+                    name, documentation, labelnames, **options
+                )
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as a {metric.type}")
+            return metric
+
+    @staticmethod
+    def counter(name, documentation, labelnames=()):
+        return MetricsManager.register(Counter, name, documentation, labelnames)
+
+    @staticmethod
+    def gauge(name, documentation, labelnames=()):
+        return MetricsManager.register(Gauge, name, documentation, labelnames)
+
+    @staticmethod
+    def histogram(
+        name, documentation, labelnames=(), buckets=Histogram.default_buckets
+    ):
+        return MetricsManager.register(
+            Histogram, name, documentation, labelnames, buckets=buckets
+        )
+
+    @staticmethod
+    def render():
+        with MetricsManager.lock:
+            metrics = list(MetricsManager.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+    @staticmethod
+    def start_server(host="127.0.0.1", port=9100):
+        if MetricsManager.server is not None:
+            return
+
+        MetricsManager.server = MetricsServer((host, port), MetricsRequestHandler)
+        threading.Thread(
+            target=MetricsManager.server.serve_forever,
+            name="MetricsThread",
+            daemon=True,
+        ).start()
+        log.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    @staticmethod
+    def stop_server():
+        if MetricsManager.server is not None:
+            MetricsManager.server.shutdown()
+            MetricsManager.server = None
@@ -4,6 +4,7 @@ import logging
 from apscheduler.schedulers.background import BackgroundScheduler
 
 from greenbot import utils
+from greenbot.managers.metrics import MetricsManager
 
 log = logging.getLogger(__name__)
 
@@ -34,6 +35,10 @@ class ScheduleManager:
             ScheduleManager.base_scheduler = BackgroundScheduler(daemon=True)
             ScheduleManager.base_scheduler.start()
 
+            MetricsManager.gauge(
+                "greenbot_scheduler_jobs", "Jobs scheduled in APScheduler"
+            ).set_function(lambda: len(ScheduleManager.base_scheduler.get_jobs()))
+
     @staticmethod
     def execute_now(method, args=[], kwargs={}, scheduler=None):
         if scheduler is None:
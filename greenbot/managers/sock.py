@@ -1,21 +1,63 @@
+import collections
 import json
 import logging
 import threading
+import time
 
+import redis
+
+from greenbot.managers.executor import ExecutorManager
+from greenbot.managers.metrics import MetricsManager
 from greenbot.managers.redis import RedisManager
+from greenbot.managers.schedule import ScheduleManager
 
 log = logging.getLogger(__name__)
 
 
 class SocketManager:
-    def __init__(self, streamer_name, callback):
+    """
+    Listens to the redis channels of the web interface and runs their handlers.
+
+    Every topic has its own queue, drained by one task at a time on the ExecutorManager,
+    so the messages of a topic are handled in order without blocking the other topics.
+    If the connection to redis is lost, the listener reconnects and subscribes to all
+    topics again.
+
+    Batch handlers get all messages of their topic that arrived within `coalesce_window`
+    seconds as one list, so a bulk edit in the web interface is applied in one go.
+    """
+
+    # get_message raises as long as the pubsub is not subscribed to anything
+    keepalive_channel = "test"
+
+    max_reconnect_delay = 30
+
+    coalesce_window = 0.25
+
+    def __init__(self, streamer_name):
         self.handlers = {}
-        self.pubsub = RedisManager.get().pubsub()
+        self.queues = {}
+        self.draining = set()
+        self.batch_topics = set()
+        self.lock = threading.Lock()
+        self.pending_topics = set()
         self.running = True
         self.streamer_name = streamer_name
-        self.callback = callback
-
-        self.pubsub.subscribe("test")  # need this for keepalive? idk
+        self.pubsub = None
+
+        self.queue_depth = MetricsManager.gauge(
+            "greenbot_socket_queue_depth",
+            "Messages from the web interface waiting to be handled",
+            ["topic"],
+        )
+        self.messages_received = MetricsManager.counter(
+            "greenbot_socket_messages_received_total",
+            "Messages received from the web interface",
+            ["topic"],
+        )
+        self.reconnects = MetricsManager.counter(
+            "greenbot_socket_reconnects_total", "Reconnects to the redis pubsub"
+        )
 
         self.thread = threading.Thread(target=self.start, name="SocketManagerThread")
         self.thread.daemon = True
@@ -24,39 +66,121 @@ class SocketManager:
     def quit(self):
         self.running = False
 
-    def add_handler(self, topic, method):
+    def add_handler(self, topic, method, batch=False):
+        """ Handlers are called with the message data, batch handlers with a list of message data """
         topic = f"{self.streamer_name}:{topic}"
 
-        if topic not in self.handlers:
-            self.handlers[topic] = [method]
-            self.pubsub.subscribe(topic)
-        else:
-            self.handlers[topic].append(method)
+        with self.lock:
+            if batch:
+                self.batch_topics.add(topic)
+            if topic not in self.handlers:
+                self.handlers[topic] = [(method, batch)]
+                self.queues[topic] = collections.deque()
+                self.queue_depth.set(0, [topic])
+                # The pubsub is not thread safe, the listener thread subscribes
+                self.pending_topics.add(topic)
+            else:
+                self.handlers[topic].append((method, batch))
+
+    def connect(self):
+        with self.lock:
+            topics = list(self.handlers)
+            self.pending_topics.clear()
 
-    def start(self):
-        while self.running:
-            message = self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
-            if not message:
-                continue
+        self.pubsub = RedisManager.get().pubsub()
+        self.pubsub.subscribe(self.keepalive_channel, *topics)
 
-            if message["channel"] not in self.handlers:
-                continue
+    def subscribe_pending(self):
+        with self.lock:
+            topics = list(self.pending_topics)
+            self.pending_topics.clear()
+
+        if topics:
+            self.pubsub.subscribe(*topics)
+
+    def close(self):
+        if self.pubsub is None:
+            return
+        try:
+            self.pubsub.close()
+        except:
+            log.exception("Unable to close the pubsub")
+        self.pubsub = None
 
+    def start(self):
+        reconnect_delay = 1
+        while self.running:
             try:
-                parsed_data = json.loads(message["data"])
-            except json.decoder.JSONDecodeError:
+                if self.pubsub is None:
+                    self.connect()
+                    reconnect_delay = 1
+                self.subscribe_pending()
+                message = self.pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1
+                )
+            except (redis.ConnectionError, redis.TimeoutError):
                 log.exception(
-                    "Bad JSON data on %s topic: '%s'",
-                    message["channel"],
-                    message["data"],
+                    f"Lost the connection to the redis pubsub, reconnecting in {reconnect_delay} seconds"
                 )
+                self.close()
+                self.reconnects.inc()
+                time.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, self.max_reconnect_delay)
                 continue
 
-            for handler in self.handlers[message["channel"]]:
-                # invokes the handler on the bot's main thread (the IRC event loop)
-                self.callback(handler, parsed_data)
+            if message:
+                self.on_message(message)
 
-        self.pubsub.close()
+        self.close()
+
+    def on_message(self, message):
+        topic = message["channel"]
+        if topic not in self.handlers:
+            return
+
+        try:
+            parsed_data = json.loads(message["data"])
+        except json.decoder.JSONDecodeError:
+            log.exception(f"Bad JSON data on {topic} topic: '{message['data']}'")
+            return
+
+        self.messages_received.inc(labels=[topic])
+        with self.lock:
+            self.queues[topic].append(parsed_data)
+            self.queue_depth.inc(labels=[topic])
+            if topic in self.draining:
+                return
+            self.draining.add(topic)
+            coalesce = topic in self.batch_topics
+
+        if coalesce:
+            # Wait for the rest of the burst
+            ScheduleManager.execute_delayed(
+                self.coalesce_window, ExecutorManager.submit, args=[self.drain, topic]
+            )
+        else:
+            ExecutorManager.submit(self.drain, topic)
+
+    def drain(self, topic):
+        """ Handle the queued messages of `topic`, until its queue is empty """
+        while True:
+            with self.lock:
+                if not self.queues[topic]:
+                    self.draining.discard(topic)
+                    return
+                messages = list(self.queues[topic])
+                self.queues[topic].clear()
+                self.queue_depth.dec(len(messages), labels=[topic])
+                handlers = list(self.handlers[topic])
+
+            for handler, batch in handlers:
+                for data in [messages] if batch else messages:
+                    try:
+                        handler(data)
+                    except:
+                        log.exception(
+                            f"Unhandled exception in the {topic} handler {handler}"
+                        )
 
 
 class SocketClientManager:
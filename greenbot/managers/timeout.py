@@ -0,0 +1,111 @@
+import datetime
+import json
+import logging
+
+from greenbot import utils
+
+log = logging.getLogger(__name__)
+
+
+class TimeoutStore:
+    """
+    Pending timed unbans, kept in redis.
+
+    A sorted set holds the user ids scored by their unban timestamp, and a hash holds
+    the details of every timeout. Adding or removing a timeout is O(log n), and due
+    timeouts are popped in one atomic script, so concurrent bans never overwrite each
+    other and every unban is handed out once, even with several bot instances.
+    """
+
+    # Before timeouts were stored per user, they were kept in one JSON blob
+    legacy_key = "timeouts-discord"
+
+    pop_due_script = """
+    local user_ids = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+    local timeouts = {}
+    for _, user_id in ipairs(user_ids) do
+        redis.call("ZREM", KEYS[1], user_id)
+        local data = redis.call("HGET", KEYS[2], user_id)
+        redis.call("HDEL", KEYS[2], user_id)
+        table.insert(timeouts, user_id)
+        table.insert(timeouts, data or "")
+    end
+    return timeouts
+    """
+
+    def __init__(self, redis, bot_name):
+        self.redis = redis
+        self.schedule_key = f"{bot_name}:timeouts:schedule"
+        self.data_key = f"{bot_name}:timeouts:data"
+        self.pop_due_command = redis.register_script(self.pop_due_script)
+
+    def add(self, user_id, unban_date, reason, only_new=False):
+        """ With only_new, an existing timeout of the user is kept as it is """
+        user_id = str(user_id)
+        data = json.dumps(
+            {
+                "discord_id": user_id,
+                "unban_date": unban_date.isoformat(),
+                "reason": str(reason),
+            }
+        )
+        pipeline = self.redis.pipeline()
+        pipeline.zadd(self.schedule_key, {user_id: unban_date.timestamp()}, nx=only_new)
+        if only_new:
+            pipeline.hsetnx(self.data_key, user_id, data)
+        else:
+            pipeline.hset(self.data_key, user_id, data)
+        pipeline.execute()
+
+    def remove(self, user_id):
+        user_id = str(user_id)
+        pipeline = self.redis.pipeline()
+        pipeline.zrem(self.schedule_key, user_id)
+        pipeline.hdel(self.data_key, user_id)
+        pipeline.execute()
+
+    def pop_due(self, limit=100):
+        """ Removes and returns up to `limit` timeouts that are due, as a list of (user_id, data) """
+        result = self.pop_due_command(
+            keys=[self.schedule_key, self.data_key],
+            args=[utils.now().timestamp(), limit],
+        )
+        timeouts = []
+        for user_id, data in zip(result[::2], result[1::2]):
+            try:
+                data = json.loads(data) if data else {}
+            except ValueError:
+                data = {}
+            timeouts.append((user_id, data))
+        return timeouts
+
+    def migrate_legacy(self):
+        """ Move the timeouts of the old JSON blob into the sorted set """
+        blob = self.redis.get(self.legacy_key)
+        if blob is None:
+            return
+
+        try:
+            legacy_timeouts = json.loads(blob) or {}
+        except ValueError:
+            log.exception("Unable to parse the legacy timeouts, dropping them")
+            legacy_timeouts = {}
+
+        for user_id, data in legacy_timeouts.items():
+            try:
+                unban_date = data["unban_date"]
+                if ":" in unban_date[-5:]:
+                    unban_date = (
+                        f"{unban_date[:-5]}{unban_date[-5:-3]}{unban_date[-2:]}"
+                    )
+                unban_date = datetime.datetime.strptime(
+                    unban_date, "%Y-%m-%d %H:%M:%S.%f%z"
+                )
+                self.add(
+                    data.get("discord_id", user_id), unban_date, data.get("reason")
+                )
+            except (KeyError, TypeError, ValueError):
+                log.exception(f"Unable to migrate the legacy timeout of {user_id}")
+
+        self.redis.delete(self.legacy_key)
+        log.info(f"Migrated {len(legacy_timeouts)} legacy timeouts")
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+
+import aiohttp
+
+from greenbot.managers.executor import ExecutorManager
+from greenbot.utils import TTLCache
+
+log = logging.getLogger(__name__)
+
+
+class URLFetchManager:
+    """
+    Fetches the URLs of `$(urlfetch ...)` substitutions on the bot's event loop.
+
+    All requests share one keep-alive session, are bound by connect/read timeouts and
+    a maximum response size, and responses are cached per URL. Concurrent requests
+    for the same URL share one request.
+    """
+
+    loop = None
+    session = None
+    cache = TTLCache(maxsize=256, ttl=60)
+    in_flight = {}
+
+    user_agent = None
+    timeout = None
+    max_bytes = 16384
+    max_connections = 20
+
+    @staticmethod
+    def init(
+        loop,
+        user_agent,
+        connect_timeout=2,
+        read_timeout=5,
+        max_bytes=16384,
+        max_connections=20,
+        cache_size=256,
+        cache_ttl=60,
+    ):
+        URLFetchManager.loop = loop
+        URLFetchManager.user_agent = user_agent
+        URLFetchManager.timeout = aiohttp.ClientTimeout(
+            total=connect_timeout + read_timeout,
+            connect=connect_timeout,
+            sock_read=read_timeout,
+        )
+        URLFetchManager.max_bytes = max_bytes
+        URLFetchManager.max_connections = max_connections
+        URLFetchManager.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    @staticmethod
+    def get_session():
+        if URLFetchManager.session is None or URLFetchManager.session.closed:
+            URLFetchManager.session = aiohttp.ClientSession(
+                loop=URLFetchManager.loop,
+                timeout=URLFetchManager.timeout,
+                connector=aiohttp.TCPConnector(
+                    limit=URLFetchManager.max_connections, loop=URLFetchManager.loop
+                ),
+                headers={
+                    "Accept": "text/plain",
+                    "Accept-Language": "en-US, en;q=0.9, *;q=0.5",
+                    "User-Agent": URLFetchManager.user_agent,
+                },
+            )
+        return URLFetchManager.session
+
+    @staticmethod
+    async def fetch(url):
+        """ Returns the cleaned up response body of the given URL, or None if the request failed """
+        value = URLFetchManager.cache.get(url)
+        if value is not None:
+            return value
+
+        future = URLFetchManager.in_flight.get(url, None)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = URLFetchManager.loop.create_future()
+        URLFetchManager.in_flight[url] = future
+        value = None
+        try:
+            value = await URLFetchManager._request(url)
+            if value is not None:
+                URLFetchManager.cache.set(url, value)
+        except asyncio.CancelledError:
+            raise
+        except:
+            log.exception(f"Unhandled exception while fetching {url}")
+        finally:
+            del URLFetchManager.in_flight[url]
+            # Also resolved if this caller was cancelled, the other callers wait on it
+            future.set_result(value)
+
+        return value
+
+    @staticmethod
+    async def _request(url):
+        try:
+            async with URLFetchManager.get_session().get(
+                url, allow_redirects=True
+            ) as response:
+                response.raise_for_status()
+                body = bytearray()
+                async for chunk in response.content.iter_chunked(4096):
+                    body += chunk
+                    if len(body) >= URLFetchManager.max_bytes:
+                        del body[URLFetchManager.max_bytes :]
+                        break
+                text = body.decode(response.charset or "utf-8", errors="replace")
+        except (aiohttp.ClientError, asyncio.TimeoutError, LookupError) as e:
+            log.info(f"Unable to fetch {url}: {e!r}")
+            return None
+
+        return text.strip().replace("\n", "").replace("\r", "")[:400]
+
+    @staticmethod
+    async def fetch_all(urls):
+        """ Fetch all URLs concurrently, returns a dictionary of url => value (None if the request failed) """
+        urls = list(set(urls))
+        values = await asyncio.gather(*[URLFetchManager.fetch(url) for url in urls])
+        return dict(zip(urls, values))
+
+    @staticmethod
+    def run(coro):
+        """ Schedule the given coroutine on the bot loop from any thread """
+        future = asyncio.run_coroutine_threadsafe(coro, URLFetchManager.loop)
+        future.add_done_callback(lambda f: ExecutorManager.log_exception(coro, f))
+        return future
+
+    @staticmethod
+    async def close():
+        if URLFetchManager.session is not None:
+            await URLFetchManager.session.close()
+            URLFetchManager.session = None
@@ -0,0 +1,94 @@
+import logging
+
+from greenbot.managers.db import DBManager
+from greenbot.managers.sock import SocketClientManager
+from greenbot.models.user import User
+from greenbot.utils import TTLCache
+
+log = logging.getLogger(__name__)
+
+
+class CachedUser:
+    """ Read-only snapshot of a User row """
+
+    __slots__ = ("discord_id", "user_name", "points", "level")
+
+    def __init__(self, discord_id, user_name="", points=0, level=50):
+        self.discord_id = discord_id
+        self.user_name = user_name
+        self.points = points
+        self.level = level
+
+    def can_afford(self, points):
+        return not self.points < points
+
+
+class UserCache:
+    """
+    In-process cache of user levels and points, so the message and command hot paths
+    don't need a database round trip.
+
+    Whenever a user is changed, call `invalidate` after the change has been committed.
+    The invalidation is published on the `user.update` topic so other processes
+    (the web interface, other bot instances) drop their copy as well.
+    """
+
+    cache = TTLCache(maxsize=10000, ttl=300)
+
+    @staticmethod
+    def init(maxsize=10000, ttl=300, socket_manager=None):
+        UserCache.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        if socket_manager:
+            socket_manager.add_handler("user.update", UserCache.on_user_update)
+
+    @staticmethod
+    def get(discord_id):
+        discord_id = str(discord_id)
+        user = UserCache.cache.get(discord_id)
+        if user is not None:
+            return user
+
+        with DBManager.create_session_scope() as db_session:
+            db_user = (
+                db_session.query(User).filter_by(discord_id=discord_id).one_or_none()
+            )
+            if db_user is None:
+                # The user row will be created when their first message is written
+                user = CachedUser(discord_id)
+            else:
+                user = UserCache.snapshot(db_user)
+
+        UserCache.cache.set(discord_id, user)
+        return user
+
+    @staticmethod
+    def snapshot(db_user):
+        return CachedUser(
+            db_user.discord_id, db_user.user_name, db_user.points, db_user.level
+        )
+
+    @staticmethod
+    def invalidate(discord_id=None, publish=True):
+        """ Drop the given user from the cache. If no user is given, the whole cache is dropped """
+        UserCache.forget(discord_id)
+
+        if publish:
+            try:
+                SocketClientManager.send(
+                    "user.update",
+                    {"discord_id": str(discord_id) if discord_id is not None else None},
+                )
+            except:
+                log.exception("Unable to publish user cache invalidation")
+
+    @staticmethod
+    def forget(discord_id=None):
+        if discord_id is None:
+            UserCache.cache.clear()
+        else:
+            UserCache.cache.pop(str(discord_id))
+
+    @staticmethod
+    def on_user_update(data):
+        UserCache.forget(data.get("discord_id", None))
@@ -0,0 +1,59 @@
+from greenbot import utils
+from greenbot.managers.message_partition import MessagePartitionManager
+
+
+def up(cursor, bot):
+    # Partitioned tables can't be created from an existing table, so the messages are copied over
+    cursor.execute('ALTER TABLE "message" RENAME TO message_unpartitioned')
+    cursor.execute(
+        "ALTER TABLE message_unpartitioned RENAME CONSTRAINT message_pkey TO message_unpartitioned_pkey"
+    )
+
+    # The partition key must be part of the primary key
+    cursor.execute(
+        """
+    CREATE TABLE "message" (
+        message_id TEXT NOT NULL,
+        user_id TEXT NOT NULL REFERENCES "user"(discord_id),
+        channel_id TEXT,
+        content TEXT NOT NULL,
+        time_sent TIMESTAMPTZ NOT NULL,
+        credited BOOLEAN NOT NULL DEFAULT FALSE,
+        PRIMARY KEY (message_id, time_sent)
+    ) PARTITION BY RANGE (time_sent)
+    """
+    )
+    # Catches messages outside of the monthly partitions, e.g. old messages without time_sent
+    cursor.execute("CREATE TABLE message_default PARTITION OF message DEFAULT")
+
+    cursor.execute(
+        "SELECT MIN(time_sent) FROM message_unpartitioned WHERE time_sent IS NOT NULL"
+    )
+    (oldest,) = cursor.fetchone()
+    now = utils.now()
+    month_start = MessagePartitionManager.month_start(oldest or now)
+    last_month_start = MessagePartitionManager.month_start(
+        now, MessagePartitionManager.months_ahead
+    )
+    while month_start <= last_month_start:
+        MessagePartitionManager.create_partition(cursor, month_start)
+        month_start = MessagePartitionManager.month_start(month_start, 1)
+
+    cursor.execute(
+        """
+    INSERT INTO "message"(message_id, user_id, channel_id, content, time_sent, credited)
+    SELECT message_id, user_id, channel_id, content,
+        COALESCE(time_sent, 'epoch'::timestamptz), COALESCE(credited, FALSE)
+    FROM message_unpartitioned
+    """
+    )
+    cursor.execute("DROP TABLE message_unpartitioned")
+
+    # Message._get_messages_since, _get_week_counts, _get_messages_count
+    cursor.execute('CREATE INDEX ON "message"(user_id, time_sent)')
+    # Message._get_last_hour, ActivityTracker crediting the last hour
+    cursor.execute('CREATE INDEX ON "message"(time_sent) WHERE credited = FALSE')
+    # Message._get_day_count_user, _get_day_counts_of_uncredited_users
+    cursor.execute(
+        'CREATE INDEX ON "message"(user_id, time_sent) WHERE credited = TRUE'
+    )
@@ -0,0 +1,29 @@
+def up(cursor, bot):
+    cursor.execute(
+        """
+    CREATE TABLE user_activity_hourly (
+        user_id TEXT NOT NULL REFERENCES "user"(discord_id) ON DELETE CASCADE,
+        channel_id TEXT NOT NULL DEFAULT '',
+        hour TIMESTAMPTZ NOT NULL,
+        message_count INT NOT NULL DEFAULT 0,
+        credited_count INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, channel_id, hour)
+    )
+    """
+    )
+    # UserActivityHourly._get_volume
+    cursor.execute(
+        "CREATE INDEX user_activity_hourly_hour_idx ON user_activity_hourly(hour)"
+    )
+
+    # Backfill from the messages that are already stored, hours are truncated in UTC
+    cursor.execute(
+        """
+    INSERT INTO user_activity_hourly(user_id, channel_id, hour, message_count, credited_count)
+    SELECT user_id, COALESCE(channel_id, ''),
+        date_trunc('hour', time_sent AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+        COUNT(*), COUNT(*) FILTER (WHERE credited)
+    FROM "message"
+    GROUP BY 1, 2, 3
+    """
+    )
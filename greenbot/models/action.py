@@ -2,12 +2,12 @@ import collections
 import json
 import logging
 import sys
+import threading
 
 import regex as re
-import requests
 import discord
 
-from greenbot.managers.schedule import ScheduleManager
+from greenbot.managers.urlfetch import URLFetchManager
 
 log = logging.getLogger(__name__)
 
@@ -38,46 +38,302 @@ class ActionParser:
         return action
 
 
-def apply_substitutions(text, substitutions, bot, extra):
-    embed = None
-    for needle, sub in substitutions.items():
-        if sub.key and sub.argument:
-            param = sub.key
-            extra["argument"] = MessageAction.get_argument_value(
-                extra["message"], sub.argument - 1
-            )
-        elif sub.key:
-            param = sub.key
-        elif sub.argument:
-            param = MessageAction.get_argument_value(extra["message"], sub.argument - 1)
-        else:
-            param = None
-        value = sub.cb(param, extra)
-        if isinstance(value, discord.embeds.Embed):
-            text = text.replace(needle, "")
-            embed = value
-            continue
-        if value is None:
-            return None
-        try:
+def get_message_parts(extra):
+    """
+    Returns the message of the current invocation split into words.
+    The message is only split once, the result is stored in `extra`.
+    """
+
+    message_parts = extra.get("message_parts", None)
+    if message_parts is None:
+        message = extra.get("message", None)
+        message_parts = message.split(" ") if message else []
+        extra["message_parts"] = message_parts
+    return message_parts
+
+
+def get_argument(message_parts, index):
+    try:
+        return message_parts[index]
+    except IndexError:
+        return ""
+
+
+class ResponseTemplate:
+    """
+    A response string compiled into a list of segments.
+    A segment is either a literal string or a `Substitution` (argument substitutions
+    are `Substitution` objects without a callback), so the response can be rendered
+    in a single pass without searching the string again.
+    """
+
+    def __init__(self, text, bot):
+        self.text = text
+        self.segments = []
+        self.compile(bot)
+
+    def compile(self, bot):
+        substitutions = get_substitutions(self.text, bot)
+
+        spans = []
+        for sub_key in Substitution.substitution_regex.finditer(self.text):
+            sub = substitutions.get(sub_key.group(0), None)
+            if sub is None:
+                continue
             for f in sub.filters:
-                value = bot.apply_filter(value, f)
-        except:
-            log.exception("Exception caught in filter application")
+                f.cb = bot.get_filter(f.name) if bot else None
+            spans.append((sub_key.start(), sub_key.end(), sub))
+
+        argument_subs = {}
+        for sub_key in Substitution.argument_substitution_regex.finditer(self.text):
+            start, end = sub_key.span()
+            if any(start < s_end and s_start < end for s_start, s_end, _ in spans):
+                # Part of a substitution, e.g. the key of $(if:$(1),'a','b')
+                continue
+            needle = sub_key.group(0)
+            if needle not in argument_subs:
+                argument_subs[needle] = Substitution(
+                    None, needle=needle, argument=int(sub_key.group(1))
+                )
+            spans.append((start, end, argument_subs[needle]))
+
+        spans.sort(key=lambda span: span[0])
+
+        position = 0
+        for start, end, sub in spans:
+            if start > position:
+                self.segments.append(self.text[position:start])
+            self.segments.append(sub)
+            position = end
+        if position < len(self.text):
+            self.segments.append(self.text[position:])
+
+        self.has_substitutions = len(spans) > 0
+
+    def render(self, bot, extra):
+        """
+        Returns the rendered text and the embed returned by a substitution, if any.
+        Returns (None, None) if any substitution has no value.
+        """
+
+        if not self.has_substitutions:
+            return self.text, None
+
+        embed = None
+        values = {}
+        parts = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+                continue
+
+            if segment.needle in values:
+                value = values[segment.needle]
+            else:
+                value = self.evaluate(segment, extra)
+                values[segment.needle] = value
+
+            if value is None:
+                return None, None
+            if isinstance(value, discord.embeds.Embed):
+                embed = value
+                continue
+            parts.append(value)
+
+        return "".join(parts), embed
+
+    @staticmethod
+    def evaluate(sub, extra):
+        if sub.cb is None:
+            return get_argument(get_message_parts(extra), sub.argument - 1)
+
+        value = resolve_substitution(sub, extra)
+        if value is None or isinstance(value, discord.embeds.Embed):
+            return value
+        value = apply_filters(value, sub.filters)
         if value is None:
             return None
-        text = text.replace(needle, str(value))
+        return str(value)
+
+
+def resolve_substitution(sub, extra):
+    message_parts = get_message_parts(extra)
+    if sub.key and sub.argument:
+        param = sub.key
+        extra["argument"] = get_argument(message_parts, sub.argument - 1)
+    elif sub.key:
+        param = sub.key
+    elif sub.argument:
+        param = get_argument(message_parts, sub.argument - 1)
+    else:
+        param = None
+    return sub.cb(param, extra)
 
-    return text, embed
+
+def apply_filters(value, filters):
+    try:
+        for f in filters:
+            if f.cb is not None:
+                value = f.cb(value, f.arguments)
+    except:
+        log.exception("Exception caught in filter application")
+    return value
+
+
+class ActionRegistry:
+    """
+    The `$(...)` substitutions and functions that can be used in actions, built once per bot.
+
+    Modules can add their own with `register_substitution` and `register_function`.
+    Every change bumps `version`, actions compiled against an older version are
+    recompiled the next time they run.
+    """
+
+    default_substitutions = {
+        "author": "get_author_value",
+        "channel": "get_channel_value",
+        "time": "get_time_value",
+        "args": "get_args_value",
+        "strictargs": "get_strictargs_value",
+        "command": "get_command_value",
+        "member": "get_member_value",
+        "role": "get_role_value",
+        "userinfo": "get_user_info",
+        "roleinfo": "get_role_info",
+        "commands": "get_commands",
+        "commandinfo": "get_command_info",
+        "user": "get_user",
+        "currency": "get_currency",
+        "rest": "rest",
+    }
+
+    default_functions = {
+        "kick": "func_kick_member",
+        "setpoints": "func_set_balance",
+        "adjpoints": "func_adj_balance",
+        "banmember": "func_ban_member",
+        "unbanmember": "func_unban_member",
+        "level": "func_level",
+        "output": "func_output",
+        "addrole": "func_add_role_member",
+        "removerole": "func_remove_role_member",
+    }
+
+    # Registry used when no bot is available (e.g. the web interface).
+    # Every name maps to None, actions are parsed but can't be run.
+    unbound = None
+
+    def __init__(self, bot):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.substitutions = {
+            name: getattr(bot, attr, None) if bot else None
+            for name, attr in self.default_substitutions.items()
+        }
+        self.functions = {
+            name: getattr(bot, attr, None) if bot else None
+            for name, attr in self.default_functions.items()
+        }
+
+    @staticmethod
+    def get(bot):
+        if bot is None:
+            return ActionRegistry.unbound
+        return bot.action_registry
+
+    def register_substitution(self, name, cb):
+        """ cb is called with (key, extra) and returns the value to substitute """
+        self._update("substitutions", name, cb)
+
+    def unregister_substitution(self, name):
+        self._update("substitutions", name, None, remove=True)
+
+    def register_function(self, name, cb):
+        """ cb is called with (args, extra) and returns a (message, embed) tuple """
+        self._update("functions", name, cb)
+
+    def unregister_function(self, name):
+        self._update("functions", name, None, remove=True)
+
+    def _update(self, attr, name, cb, remove=False):
+        with self.lock:
+            # Copy on write, so actions compiling in other threads keep a consistent mapping
+            mapping = dict(getattr(self, attr))
+            if remove:
+                mapping.pop(name, None)
+            else:
+                mapping[name] = cb
+            setattr(self, attr, mapping)
+            self.version += 1
+
+
+ActionRegistry.unbound = ActionRegistry(None)
 
 
 class Function:
     function_regex = re.compile(r"\$\(([a-z_]+)(;\$\(\w+(;\d+)?(:\w+)?\)|;\w+)*\)")
     args_regex = re.compile(r"(;\$\(\w+(;\d)?(:\w+)?\)|;\w+)")
 
-    def __init__(self, cb, arguments=[]):
+    def __init__(self, cb, arguments=[], bot=None):
         self.cb = cb
         self.arguments = arguments
+        self.compiled_arguments = (
+            [FunctionArgument(argument, bot) for argument in arguments] if bot else []
+        )
+
+    def get_arguments(self, extra):
+        return [argument.resolve(extra) for argument in self.compiled_arguments]
+
+
+class FunctionArgument:
+    """
+    A function argument, compiled to either a `Substitution`, a message argument
+    number or a literal value.
+    """
+
+    def __init__(self, raw, bot):
+        self.raw = raw
+        self.sub = None
+        self.argument = None
+
+        if not raw or not isinstance(raw, str):
+            return
+
+        sub_key = Substitution.substitution_regex.search(raw)
+        if sub_key:
+            (
+                sub_string,
+                path,
+                argument,
+                key,
+                filters,
+                if_arguments,
+            ) = get_substitution_arguments(sub_key)
+            substitutions = ActionRegistry.get(bot).substitutions
+            if substitutions.get(path, None) is not None:
+                for f in filters:
+                    f.cb = bot.get_filter(f.name)
+                self.sub = Substitution(
+                    substitutions[path],
+                    needle=sub_string,
+                    key=key,
+                    argument=argument,
+                    filters=filters,
+                )
+                return
+
+        sub_key = Substitution.argument_substitution_regex.search(raw)
+        if sub_key:
+            self.argument = int(sub_key.group(1))
+
+    def resolve(self, extra):
+        if self.sub is not None:
+            return apply_filters(
+                resolve_substitution(self.sub, extra), self.sub.filters
+            )
+        if self.argument is not None:
+            return get_argument(get_message_parts(extra), self.argument - 1)
+        return self.raw
 
 
 class Substitution:
@@ -103,6 +359,8 @@ class SubstitutionFilter:
     def __init__(self, name, arguments):
         self.name = name
         self.arguments = arguments
+        # Resolved when the template is compiled
+        self.cb = None
 
 
 class BaseAction:
@@ -303,48 +561,35 @@ class MessageAction(BaseAction):
     def __init__(self, response, bot, functions=[]):
         self.response = response
         self.functions_raw = functions
+        self.num_urlfetch_subs = (
+            len(get_urlfetch_substitutions(self.response, all=True)) if bot else 0
+        )
+        self.compile(bot)
+
+    def compile(self, bot):
+        self.version = ActionRegistry.get(bot).version
         self.functions = (
             get_functions(self.functions_raw, bot) if self.functions_raw else []
         )
+        self.template = ResponseTemplate(self.response, bot) if bot else None
 
-        if bot:
-            self.argument_subs = get_argument_substitutions(self.response)
-            self.num_urlfetch_subs = len(
-                get_urlfetch_substitutions(self.response, all=True)
-            )
-            self.subs = get_substitutions(self.response, bot)
-        else:
-            self.argument_subs = []
-            self.num_urlfetch_subs = 0
-            self.subs = {}
+    def refresh(self, bot):
+        """ Recompile the action if substitutions or functions were registered since it was compiled """
+        if self.version != ActionRegistry.get(bot).version:
+            self.compile(bot)
 
     @staticmethod
     def get_argument_value(message, index):
         if not message:
             return ""
-        msg_parts = message.split(" ")
-        try:
-            return msg_parts[index]
-        except:
-            pass
-        return ""
+        return get_argument(message.split(" "), index)
 
     def get_response(self, bot, extra):
-        resp = self.response
+        self.refresh(bot)
+        if self.template is None:
+            return self.response, None
 
-        resp, embed = apply_substitutions(resp, self.subs, bot, extra)
-
-        if resp is None:
-            return None
-
-        for sub in self.argument_subs:
-            needle = sub.needle
-            value = str(
-                MessageAction.get_argument_value(extra["message"], sub.argument - 1)
-            )
-            resp = resp.replace(needle, value)
-            log.debug(f"Replacing {needle} with {value}")
-        return resp, embed
+        return self.template.render(bot, extra)
 
     @property
     def web_functions(self):
@@ -358,38 +603,47 @@ class MessageAction(BaseAction):
         raise NotImplementedError("Please implement the run method.")
 
 
-def urlfetch_msg(method, message, num_urlfetch_subs, bot, extra={}, args=[], kwargs={}):
+def urlfetch_msg(
+    method, message, num_urlfetch_subs, bot, extra={}, args=[], kwargs={}, embed=None
+):
+    """
+    Replaces the `$(urlfetch ...)` substitutions in `message` and passes the result to `method`.
+    The URLs are fetched concurrently on the bot loop, this does not wait for them.
+    """
+
     urlfetch_subs = get_urlfetch_substitutions(message)
 
     if len(urlfetch_subs) > num_urlfetch_subs:
         log.error(f"HIJACK ATTEMPT {message}")
         return False
 
+    if not urlfetch_subs:
+        return method(*args, message, embed, **kwargs)
+
+    URLFetchManager.run(
+        _urlfetch_send(method, message, urlfetch_subs, embed, args, kwargs)
+    )
+    return True
+
+
+async def _urlfetch_send(method, message, urlfetch_subs, embed, args, kwargs):
+    values = await URLFetchManager.fetch_all(urlfetch_subs.values())
+
     for needle, url in urlfetch_subs.items():
-        try:
-            headers = {
-                "Accept": "text/plain",
-                "Accept-Language": "en-US, en;q=0.9, *;q=0.5",
-                "User-Agent": bot.user_agent,
-            }
-            r = requests.get(url, allow_redirects=True, headers=headers)
-            r.raise_for_status()
-            value = r.text.strip().replace("\n", "").replace("\r", "")[:400]
-        except:
-            return False
+        value = values[url]
+        if value is None:
+            return
         message = message.replace(needle, value)
 
-    args.append(message)
-
-    method(*args, **kwargs)
+    method(*args, message, embed, **kwargs)
 
 
 class IfSubstitution:
-    def __call__(self, key, extra={}):
+    def __call__(self, key, extra=None):
+        if extra is None:
+            extra = {}
         if self.sub.key is None:
-            msg = MessageAction.get_argument_value(
-                extra.get("message", ""), self.sub.argument - 1
-            )
+            msg = get_argument(get_message_parts(extra), self.sub.argument - 1)
             if msg:
                 return self.get_true_response(extra)
 
@@ -402,12 +656,10 @@ class IfSubstitution:
         return self.get_false_response(extra)
 
     def get_true_response(self, extra):
-        return apply_substitutions(self.true_response, self.true_subs, self.bot, extra)
+        return self.true_template.render(self.bot, extra)[0]
 
     def get_false_response(self, extra):
-        return apply_substitutions(
-            self.false_response, self.false_subs, self.bot, extra
-        )
+        return self.false_template.render(self.bot, extra)[0]
 
     def __init__(self, key, arguments, bot):
         self.bot = bot
@@ -423,8 +675,8 @@ class IfSubstitution:
         self.true_response = arguments[0][2:-1] if arguments else "Yes"
         self.false_response = arguments[1][2:-1] if len(arguments) > 1 else "No"
 
-        self.true_subs = get_substitutions(self.true_response, bot)
-        self.false_subs = get_substitutions(self.false_response, bot)
+        self.true_template = ResponseTemplate(self.true_response, bot)
+        self.false_template = ResponseTemplate(self.false_response, bot)
 
 
 def get_substitutions(string, bot):
@@ -467,7 +719,7 @@ def get_substitutions(string, bot):
         except:
             log.exception("BabyRage")
 
-    method_mapping = method_subs(bot)
+    method_mapping = ActionRegistry.get(bot).substitutions
 
     for sub_key in Substitution.substitution_regex.finditer(string):
         (
@@ -483,7 +735,7 @@ def get_substitutions(string, bot):
             # We already matched this variable
             continue
 
-        if path in method_mapping:
+        if method_mapping.get(path, None) is not None:
             sub = Substitution(
                 method_mapping[path],
                 needle=sub_string,
@@ -498,7 +750,7 @@ def get_substitutions(string, bot):
 
 def get_functions(_functions, bot):
     functions = []
-    method_mapping = method_func(bot)
+    method_mapping = ActionRegistry.get(bot).functions
     for func_name in _functions:
         func = Function.function_regex.search(func_name)
         if not func:
@@ -508,134 +760,15 @@ def get_functions(_functions, bot):
         if function not in method_mapping:
             log.info(f"Function not in method mapping {function}")
             continue
-        functions.append(Function(method_mapping[function], arguments))
+        functions.append(Function(method_mapping[function], arguments, bot))
     return functions
 
 
-def method_func(bot):
-    method_mapping = {}
-    try:
-        method_mapping["kick"] = bot.func_kick_member if bot else None
-        method_mapping["setpoints"] = bot.func_set_balance if bot else None
-        method_mapping["adjpoints"] = bot.func_adj_balance if bot else None
-        method_mapping["banmember"] = bot.func_ban_member if bot else None
-        method_mapping["unbanmember"] = bot.func_unban_member if bot else None
-        method_mapping["level"] = bot.func_level if bot else None
-        method_mapping["output"] = bot.func_output if bot else None
-        method_mapping["addrole"] = bot.func_add_role_member if bot else None
-        method_mapping["removerole"] = bot.func_remove_role_member if bot else None
-    except AttributeError:
-        pass
-    return method_mapping
-
-
-def method_subs(bot):
-    method_mapping = {}
-    try:
-        method_mapping["author"] = bot.get_author_value if bot else None
-        method_mapping["channel"] = bot.get_channel_value if bot else None
-        method_mapping["time"] = bot.get_time_value if bot else None
-        method_mapping["args"] = bot.get_args_value if bot else None
-        method_mapping["strictargs"] = bot.get_strictargs_value if bot else None
-        method_mapping["command"] = bot.get_command_value if bot else None
-        method_mapping["member"] = bot.get_member_value if bot else None
-        method_mapping["role"] = bot.get_role_value if bot else None
-        method_mapping["userinfo"] = bot.get_user_info if bot else None
-        method_mapping["roleinfo"] = bot.get_role_info if bot else None
-        method_mapping["commands"] = bot.get_commands if bot else None
-        method_mapping["commandinfo"] = bot.get_command_info if bot else None
-        method_mapping["user"] = bot.get_user if bot else None
-        method_mapping["currency"] = bot.get_currency if bot else None
-        method_mapping["rest"] = bot.rest if bot else None
-    except AttributeError:
-        pass
-    return method_mapping
-
-
-def get_substitutions_array(array, bot, extra):
-    """
-    Returns a dictionary of `Substitution` objects thare are found in the passed `string`.
-    Will not return multiple `Substitution` objects for the same string.
-    This means "You have $(source:points) points xD $(source:points)" only returns one Substitution.
-    """
-
-    return_array = []
-    method_mapping = method_subs(bot)
-
-    for string in array:
-        if not string or not isinstance(string, str):
-            return_array.append(string)
-            continue
-        sub_key = Substitution.substitution_regex.search(string)
-        if not sub_key:
-            return_array.append(string)
-            continue
-
-        (
-            sub_string,
-            path,
-            argument,
-            key,
-            filters,
-            if_arguments,
-        ) = get_substitution_arguments(sub_key)
-
-        if path not in method_mapping:
-            return_array.append(string)
-            continue
-
-        if key and argument:
-            param = key
-            extra["argument"] = MessageAction.get_argument_value(
-                extra["message"], argument - 1
-            )
-        elif key:
-            param = key
-        elif argument:
-            param = MessageAction.get_argument_value(extra["message"], argument - 1)
-        else:
-            param = None
-        value = method_mapping[path](param, extra)
-        try:
-            for f in filters:
-                value = bot.apply_filter(value, f)
-        except:
-            log.exception("Exception caught in filter application")
-        if value is None:
-            return_array.append(None)
-        return_array.append(value)
-
-    return return_array
-
-
-def get_argument_substitutions_array(array, extra):
-    return_array = []
-    for string in array:
-        if not string or not isinstance(string, str):
-            return_array.append(string)
-            continue
-        sub_key = Substitution.argument_substitution_regex.search(string)
-        if not sub_key:
-            return_array.append(string)
-            continue
-        return_array.append(
-            str(
-                MessageAction.get_argument_value(
-                    extra["message"], int(sub_key.group(1)) - 1
-                )
-            )
-        )
-    return return_array
-
-
 def run_functions(
     functions, bot, extra, author, channel, args, num_urlfetch_subs, private_message
 ):
     for func in functions:
-        final_args = get_argument_substitutions_array(
-            get_substitutions_array(func.arguments, bot, extra), extra
-        )
-        resp, embed = func.cb(final_args, extra)
+        resp, embed = func.cb(func.get_arguments(extra), extra)
         if num_urlfetch_subs == 0:
 
             return (
@@ -644,19 +777,14 @@ def run_functions(
                 else bot.say(channel, resp, embed)
             )
 
-        return ScheduleManager.execute_now(
-            urlfetch_msg,
-            args=[],
-            kwargs={
-                "args": [author if private_message else channel],
-                "kwargs": {},
-                "method": bot.private_message if private_message else bot.say,
-                "bot": bot,
-                "extra": extra,
-                "message": resp,
-                "embed": embed,
-                "num_urlfetch_subs": num_urlfetch_subs,
-            },
+        return urlfetch_msg(
+            bot.private_message if private_message else bot.say,
+            resp,
+            num_urlfetch_subs,
+            bot,
+            extra=extra,
+            args=[author if private_message else channel],
+            embed=embed,
         )
 
 
@@ -664,6 +792,7 @@ class ReplyAction(MessageAction):
     subtype = "Reply"
 
     def run(self, bot, author, channel, message, args):
+        self.refresh(bot)
         extra = self.get_extra_data(author, channel, message, args)
         if self.functions:
             run_functions(
@@ -682,23 +811,21 @@ class ReplyAction(MessageAction):
             return False
 
         if self.num_urlfetch_subs == 0:
+            # say and private_message don't return anything, the message was sent
             if args["whisper"]:
-                return bot.private_message(author, resp, embed)
-            return bot.say(channel, resp, embed)
-
-        return ScheduleManager.execute_now(
-            urlfetch_msg,
-            args=[],
-            kwargs={
-                "args": [author if args["whisper"] else channel],
-                "kwargs": {},
-                "method": bot.private_message if args["whisper"] else bot.say,
-                "bot": bot,
-                "extra": extra,
-                "message": resp,
-                "embed": embed,
-                "num_urlfetch_subs": self.num_urlfetch_subs,
-            },
+                bot.private_message(author, resp, embed)
+            else:
+                bot.say(channel, resp, embed)
+            return True
+
+        return urlfetch_msg(
+            bot.private_message if args["whisper"] else bot.say,
+            resp,
+            self.num_urlfetch_subs,
+            bot,
+            extra=extra,
+            args=[author if args["whisper"] else channel],
+            embed=embed,
         )
 
 
@@ -706,6 +833,7 @@ class PrivateMessageAction(MessageAction):
     subtype = "Private Message"
 
     def run(self, bot, author, channel, message, args):
+        self.refresh(bot)
         extra = self.get_extra_data(author, channel, message, args)
         resp, embed = self.get_response(bot, extra)
         if self.functions:
@@ -720,23 +848,19 @@ class PrivateMessageAction(MessageAction):
                 True,
             )
 
-        if not resp and embed:
+        if not resp and not embed:
             return False
 
         if self.num_urlfetch_subs == 0:
-            return bot.private_message(author, resp, embed)
-
-        return ScheduleManager.execute_now(
-            urlfetch_msg,
-            args=[],
-            kwargs={
-                "args": [author],
-                "kwargs": {},
-                "method": bot.private_message,
-                "bot": bot,
-                "extra": extra,
-                "message": resp,
-                "embed": embed,
-                "num_urlfetch_subs": self.num_urlfetch_subs,
-            },
+            bot.private_message(author, resp, embed)
+            return True
+
+        return urlfetch_msg(
+            bot.private_message,
+            resp,
+            self.num_urlfetch_subs,
+            bot,
+            extra=extra,
+            args=[author],
+            embed=embed,
         )
@@ -1,6 +1,7 @@
 import argparse
 import logging
-import re
+import threading
+import time
 
 import sqlalchemy
 from datetime import timedelta
@@ -9,9 +10,11 @@ from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import relationship
 from unidecode import unidecode
+import regex as re
 
 from greenbot.managers.db import Base
 from greenbot.managers.db import DBManager
+from greenbot.utils import AhoCorasick
 from greenbot.utils import find
 
 log = logging.getLogger("greenbot")
@@ -44,6 +47,8 @@ class Banphrase(Base):
 
     DEFAULT_TIMEOUT_LENGTH = 300
     DEFAULT_NOTIFY = True
+    # Time limit in seconds for a single regex search
+    REGEX_TIMEOUT = 0.05
 
     def __init__(self, **options):
         self.id = None
@@ -119,7 +124,13 @@ class Banphrase(Base):
         if not self.compiled_regex:
             return False
 
-        return self.compiled_regex.search(self.format_message(message))
+        try:
+            return self.compiled_regex.search(
+                self.format_message(message), timeout=self.REGEX_TIMEOUT
+            )
+        except TimeoutError:
+            log.warning(f"Regex banphrase {self.id} timed out")
+            return False
 
     def match(self, message, user):
         """
@@ -223,6 +234,294 @@ class BanphraseData(Base):
         self.edited_by = options.get("edited_by", self.edited_by)
 
 
+class BanphraseRegexStats:
+    """
+    Runs regex banphrase searches with a time limit and keeps latency stats per banphrase.
+    """
+
+    def __init__(self, timeout=Banphrase.REGEX_TIMEOUT):
+        self.timeout = timeout
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def search(self, banphrase, message):
+        start = time.perf_counter()
+        try:
+            matched = banphrase.compiled_regex.search(message, timeout=self.timeout)
+            timed_out = False
+        except TimeoutError:
+            matched = None
+            timed_out = True
+        duration = time.perf_counter() - start
+
+        with self.lock:
+            stats = self.stats.get(banphrase.id, None)
+            if stats is None:
+                stats = self.stats[banphrase.id] = {
+                    "id": banphrase.id,
+                    "name": banphrase.name,
+                    "count": 0,
+                    "total_time": 0.0,
+                    "max_time": 0.0,
+                    "timeouts": 0,
+                }
+            stats["count"] += 1
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+            if timed_out:
+                stats["timeouts"] += 1
+
+        if timed_out:
+            log.warning(
+                f"Regex banphrase {banphrase.id} timed out after {duration:.3f}s"
+            )
+
+        return matched is not None
+
+    def forget(self, banphrase_id):
+        with self.lock:
+            self.stats.pop(banphrase_id, None)
+
+    def get_stats(self):
+        with self.lock:
+            return [
+                {**stats, "mean_time": stats["total_time"] / stats["count"],}
+                for stats in self.stats.values()
+            ]
+
+
+class BanphraseGroup:
+    """
+    The banphrases that share case sensitivity and accent removal,
+    so the message only has to be formatted once for all of them.
+    """
+
+    # Patterns that change meaning when combined into one alternation
+    uncombinable_regex = re.compile(r"\\[1-9]|\(\?P[=<]|\(\?[aiLmsux]+\)")
+
+    def __init__(self, case_sensitive, remove_accents, regex_stats):
+        self.case_sensitive = case_sensitive
+        self.remove_accents = remove_accents
+        self.regex_stats = regex_stats
+
+        self.automaton = AhoCorasick()
+        # Banphrases with an empty phrase match any message
+        self.empty = set()
+        self.exact = {}
+        self.regexes = set()
+        self.combined_regex = None
+        self.combined_regexes = []
+        self.separate_regexes = []
+        self.regex_dirty = False
+
+    def __len__(self):
+        return (
+            len(self.automaton) + len(self.empty) + len(self.exact) + len(self.regexes)
+        )
+
+    def format_message(self, message):
+        if self.case_sensitive is False:
+            message = message.lower()
+        if self.remove_accents:
+            message = unidecode(message).strip()
+
+        return message
+
+    def add(self, banphrase, operator, phrase):
+        if operator == "regex":
+            self.regexes.add(banphrase)
+            self.regex_dirty = True
+        elif operator == "exact":
+            self.exact.setdefault(phrase, set()).add(banphrase)
+        elif not phrase:
+            self.empty.add(banphrase)
+        else:
+            self.automaton.add(phrase, (operator, banphrase))
+
+    def remove(self, banphrase, operator, phrase):
+        if operator == "regex":
+            self.regexes.discard(banphrase)
+            self.regex_dirty = True
+        elif operator == "exact":
+            banphrases = self.exact.get(phrase, set())
+            banphrases.discard(banphrase)
+            if not banphrases:
+                self.exact.pop(phrase, None)
+        elif not phrase:
+            self.empty.discard(banphrase)
+        else:
+            self.automaton.remove(phrase, (operator, banphrase))
+
+    def compile_regexes(self):
+        """
+        Combine the regex banphrases into one alternation. If the alternation doesn't match,
+        none of its banphrases do, so most messages are checked with a single search.
+        """
+        self.regex_dirty = False
+        regexes = [banphrase for banphrase in self.regexes if banphrase.compiled_regex]
+        combinable = [
+            banphrase
+            for banphrase in regexes
+            if not self.uncombinable_regex.search(banphrase.phrase)
+        ]
+
+        combined_regex = None
+        if len(combinable) > 1:
+            try:
+                combined_regex = re.compile(
+                    "|".join(f"(?:{banphrase.phrase})" for banphrase in combinable),
+                    flags=0 if self.case_sensitive else re.IGNORECASE,
+                )
+            except Exception:
+                log.exception("Unable to combine regex banphrases")
+
+        if combined_regex is None:
+            combinable = []
+
+        self.separate_regexes = [
+            banphrase for banphrase in regexes if banphrase not in combinable
+        ]
+        self.combined_regexes = combinable
+        self.combined_regex = combined_regex
+
+    def match_phrases(self, message):
+        """ Yields every non-regex banphrase in this group that matches the formatted message """
+        yield from self.empty
+        yield from self.exact.get(message, ())
+
+        for start, length, values in self.automaton.iter(message):
+            for operator, banphrase in values:
+                if operator == "contains":
+                    yield banphrase
+                elif operator == "startswith":
+                    if start == 0:
+                        yield banphrase
+                elif operator == "endswith":
+                    if start + length == len(message):
+                        yield banphrase
+
+    def get_regexes(self):
+        """ Returns (combined regex, its banphrases, separate banphrases), compiled if needed """
+        if self.regex_dirty:
+            self.compile_regexes()
+        return self.combined_regex, self.combined_regexes, self.separate_regexes
+
+    def match_regexes(
+        self, message, combined_regex, combined_regexes, separate_regexes
+    ):
+        """ Yields every regex banphrase of get_regexes() that matches the formatted message """
+        candidates = list(separate_regexes)
+        if combined_regex:
+            try:
+                if combined_regex.search(message, timeout=self.regex_stats.timeout):
+                    candidates += combined_regexes
+            except TimeoutError:
+                # Find out which one is slow
+                candidates += combined_regexes
+        for banphrase in candidates:
+            if self.regex_stats.search(banphrase, message):
+                yield banphrase
+
+
+class BanphraseMatcher:
+    """
+    Matches a message against all enabled banphrases at once.
+
+    Plain phrases are matched with one Aho-Corasick automaton per group of
+    (case sensitivity, accent removal), so the cost of a check depends on the
+    message length rather than the number of banphrases.
+
+    Messages are matched on worker threads while banphrases are updated on others, so
+    the index is only read or changed with the lock held. Regexes are searched after the
+    lock is released, on the compiled regexes of that moment, which are never modified.
+    """
+
+    operators = ("contains", "startswith", "endswith", "exact", "regex")
+
+    def __init__(self, regex_stats=None):
+        self.regex_stats = regex_stats or BanphraseRegexStats()
+        self.groups = {}
+        # banphrase => (group key, operator, phrase) it was indexed with
+        self.indexed = {}
+        # Ties are won by the banphrase that was added first
+        self.order = {}
+        self.counter = 0
+        self.lock = threading.RLock()
+
+    def add(self, banphrase):
+        with self.lock:
+            self._add(banphrase)
+
+    def _add(self, banphrase):
+        self._remove(banphrase)
+
+        if banphrase.operator not in self.operators:
+            log.warning("Banphrase %s has an unknown operator", banphrase.id)
+            return
+
+        key = (bool(banphrase.case_sensitive), bool(banphrase.remove_accents))
+        group = self.groups.get(key, None)
+        if group is None:
+            group = self.groups[key] = BanphraseGroup(*key, self.regex_stats)
+
+        phrase = banphrase.get_phrase()
+        group.add(banphrase, banphrase.operator, phrase)
+        self.indexed[banphrase] = (key, banphrase.operator, phrase)
+        if banphrase not in self.order:
+            self.order[banphrase] = self.counter
+            self.counter += 1
+
+    def remove(self, banphrase):
+        with self.lock:
+            self._remove(banphrase)
+
+    def _remove(self, banphrase):
+        indexed = self.indexed.pop(banphrase, None)
+        if indexed is None:
+            return
+
+        key, operator, phrase = indexed
+        if operator == "regex":
+            self.regex_stats.forget(banphrase.id)
+        group = self.groups[key]
+        group.remove(banphrase, operator, phrase)
+        if len(group) == 0:
+            del self.groups[key]
+
+    def clear(self):
+        with self.lock:
+            self.groups = {}
+            self.indexed = {}
+            self.order = {}
+
+    def match(self, message, user):
+        """ Returns the matching banphrase with the harshest punishment, or None """
+        matches = set()
+        regex_groups = []
+        with self.lock:
+            for group in self.groups.values():
+                formatted_message = group.format_message(message)
+                matches.update(group.match_phrases(formatted_message))
+                if group.regexes:
+                    regex_groups.append((group, formatted_message, group.get_regexes()))
+
+        for group, formatted_message, regexes in regex_groups:
+            matches.update(group.match_regexes(formatted_message, *regexes))
+
+        with self.lock:
+            order = {banphrase: self.order.get(banphrase, 0) for banphrase in matches}
+
+        matched_banphrase = None
+        for banphrase in sorted(matches, key=order.get):
+            if user and banphrase.sub_immunity is True and user.subscriber is True:
+                continue
+
+            if not matched_banphrase or banphrase.greater_than(matched_banphrase):
+                matched_banphrase = banphrase
+
+        return matched_banphrase
+
+
 class BanphraseManager:
     def __init__(self, bot):
         self.bot = bot
@@ -232,68 +531,83 @@ class BanphraseManager:
 
         if self.bot:
             self.bot.socket_manager.add_handler(
-                "banphrase.update", self.on_banphrase_update
+                "banphrase.update", self.on_banphrase_update, batch=True
             )
             self.bot.socket_manager.add_handler(
-                "banphrase.remove", self.on_banphrase_remove
+                "banphrase.remove", self.on_banphrase_remove, batch=True
             )
 
-    def on_banphrase_update(self, data):
-        try:
-            banphrase_id = int(data["id"])
-        except (KeyError, ValueError):
-            log.warning("No banphrase ID found in on_banphrase_update")
-            return False
+        self.matcher = BanphraseMatcher()
 
-        updated_banphrase = find(
-            lambda banphrase: banphrase.id == banphrase_id, self.banphrases
-        )
-        if updated_banphrase:
-            with DBManager.create_session_scope(expire_on_commit=False) as db_session:
-                db_session.add(updated_banphrase)
-                db_session.refresh(updated_banphrase)
-                db_session.expunge(updated_banphrase)
-        else:
-            with DBManager.create_session_scope(expire_on_commit=False) as db_session:
-                updated_banphrase = (
-                    db_session.query(Banphrase).filter_by(id=banphrase_id).one_or_none()
-                )
-                db_session.expunge_all()
-                if updated_banphrase is not None:
-                    self.db_session.add(updated_banphrase.data)
+    @staticmethod
+    def get_banphrase_ids(messages, handler_name):
+        banphrase_ids = set()
+        for data in messages:
+            try:
+                banphrase_ids.add(int(data["id"]))
+            except (KeyError, ValueError):
+                log.warning(f"No banphrase ID found in {handler_name}")
+        return banphrase_ids
+
+    def on_banphrase_update(self, messages):
+        banphrase_ids = self.get_banphrase_ids(messages, "on_banphrase_update")
+        if not banphrase_ids:
+            return
+
+        known_banphrases = [
+            banphrase for banphrase in self.banphrases if banphrase.id in banphrase_ids
+        ]
+        with DBManager.create_session_scope(expire_on_commit=False) as db_session:
+            for banphrase in known_banphrases:
+                db_session.add(banphrase)
+            # Refreshes the known banphrases and loads the new ones in one query
+            updated_banphrases = (
+                db_session.query(Banphrase)
+                .filter(Banphrase.id.in_(banphrase_ids))
+                .populate_existing()
+                .all()
+            )
+            db_session.expunge_all()
 
-        if updated_banphrase:
-            if updated_banphrase not in self.banphrases:
+        for updated_banphrase in updated_banphrases:
+            if updated_banphrase not in known_banphrases:
+                if updated_banphrase.data is not None:
+                    self.db_session.add(updated_banphrase.data)
                 self.banphrases.append(updated_banphrase)
-            if (
-                updated_banphrase.enabled is True
-                and updated_banphrase not in self.enabled_banphrases
-            ):
-                self.enabled_banphrases.append(updated_banphrase)
+            if updated_banphrase.enabled is True:
+                if updated_banphrase not in self.enabled_banphrases:
+                    self.enabled_banphrases.append(updated_banphrase)
+                self.matcher.add(updated_banphrase)
+            else:
+                self.matcher.remove(updated_banphrase)
 
-        for banphrase in self.enabled_banphrases:
-            if banphrase.enabled is False:
-                self.enabled_banphrases.remove(banphrase)
+        self.enabled_banphrases = [
+            banphrase for banphrase in self.enabled_banphrases if banphrase.enabled
+        ]
 
-    def on_banphrase_remove(self, data):
-        try:
-            banphrase_id = int(data["id"])
-        except (KeyError, ValueError):
-            log.warning("No banphrase ID found in on_banphrase_remove")
-            return False
+    def on_banphrase_remove(self, messages):
+        banphrase_ids = self.get_banphrase_ids(messages, "on_banphrase_remove")
+        if not banphrase_ids:
+            return
 
-        removed_banphrase = find(
-            lambda banphrase: banphrase.id == banphrase_id, self.banphrases
-        )
-        if removed_banphrase:
+        removed_banphrases = [
+            banphrase for banphrase in self.banphrases if banphrase.id in banphrase_ids
+        ]
+        for removed_banphrase in removed_banphrases:
             if removed_banphrase.data and removed_banphrase.data in self.db_session:
                 self.db_session.expunge(removed_banphrase.data)
+            self.matcher.remove(removed_banphrase)
 
-            if removed_banphrase in self.enabled_banphrases:
-                self.enabled_banphrases.remove(removed_banphrase)
-
-            if removed_banphrase in self.banphrases:
-                self.banphrases.remove(removed_banphrase)
+        self.banphrases = [
+            banphrase
+            for banphrase in self.banphrases
+            if banphrase.id not in banphrase_ids
+        ]
+        self.enabled_banphrases = [
+            banphrase
+            for banphrase in self.enabled_banphrases
+            if banphrase.id not in banphrase_ids
+        ]
 
     def load(self):
         self.banphrases = self.db_session.query(Banphrase).all()
@@ -302,6 +616,9 @@ class BanphraseManager:
         self.enabled_banphrases = [
             banphrase for banphrase in self.banphrases if banphrase.enabled is True
         ]
+        self.matcher.clear()
+        for banphrase in self.enabled_banphrases:
+            self.matcher.add(banphrase)
         return self
 
     def commit(self):
@@ -323,7 +640,9 @@ class BanphraseManager:
         self.db_session.expunge(banphrase)
 
         self.banphrases.append(banphrase)
-        self.enabled_banphrases.append(banphrase)
+        if banphrase.enabled is True:
+            self.enabled_banphrases.append(banphrase)
+            self.matcher.add(banphrase)
 
         return banphrase, True
 
@@ -331,6 +650,7 @@ class BanphraseManager:
         self.banphrases.remove(banphrase)
         if banphrase in self.enabled_banphrases:
             self.enabled_banphrases.remove(banphrase)
+        self.matcher.remove(banphrase)
 
         self.db_session.expunge(banphrase.data)
         self.db_session.delete(banphrase)
@@ -372,18 +692,7 @@ class BanphraseManager:
             self.bot.whisper(user, notification_msg)
 
     def check_message(self, message, user):
-        matched_banphrase = None
-        for banphrase in self.enabled_banphrases:
-            if banphrase.match(message, user):
-                if not matched_banphrase:
-                    matched_banphrase = banphrase
-                    continue
-
-                if banphrase.greater_than(matched_banphrase):
-                    matched_banphrase = banphrase
-                    continue
-
-        return matched_banphrase or False
+        return self.matcher.match(message, user) or False
 
     def find_match(self, message, banphrase_id=None):
         match = None
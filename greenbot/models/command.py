@@ -13,8 +13,11 @@ from sqlalchemy_utc import UtcDateTime
 
 import greenbot.utils
 from greenbot.exc import FailedCommand
+from greenbot.managers.cooldown import CooldownManager
 from greenbot.managers.db import DBManager, Base
+from greenbot.managers.metrics import MetricsManager
 from greenbot.managers.schedule import ScheduleManager
+from greenbot.managers.user_cache import UserCache
 from greenbot.models.action import ActionParser
 from greenbot.models.action import RawFuncAction
 from greenbot.models.action import Substitution
@@ -22,6 +25,13 @@ from greenbot.models.user import User
 
 log = logging.getLogger(__name__)
 
+command_executions = MetricsManager.counter(
+    "greenbot_command_executions_total", "Commands executed", ["trigger"]
+)
+command_duration = MetricsManager.histogram(
+    "greenbot_command_duration_seconds", "Time spent running a command", ["trigger"]
+)
+
 
 def parse_command_for_web(alias, command, list):
     import markdown
@@ -247,9 +257,6 @@ class Command(Base):
         self.run_through_banphrases = False
         self.command = None
 
-        self.last_run = 0
-        self.last_run_by_user = {}
-
         self.data = None
         self.run_in_thread = False
         self.notify_on_error = False
@@ -287,10 +294,12 @@ class Command(Base):
     def __str__(self):
         return f"Command(!{self.command})"
 
+    @property
+    def trigger(self):
+        return self.command.split("|")[0] if self.command else "unknown"
+
     @reconstructor
     def init_on_load(self):
-        self.last_run = 0
-        self.last_run_by_user = {}
         self.extra_args = {"command": self}
         self.action = ActionParser.parse(self.action_json, command=self.command)
         self.run_in_thread = False
@@ -372,70 +381,104 @@ class Command(Base):
             # This user cannot execute the command through a whisper
             return False
 
-        cd_modifier = 0.2 if args["user_level"] >= 500 else 1.0
+        cooldowns = self.acquire_cooldowns(author, args["user_level"])
+        if cooldowns is None:
+            return False
 
-        cur_time = greenbot.utils.now().timestamp()
-        time_since_last_run = (cur_time - self.last_run) / cd_modifier
+        if self.cost > 0 and not UserCache.get(author.id).can_afford(self.cost):
+            # User does not have enough points to use the command
+            CooldownManager.release(cooldowns)
+            return False
 
-        if (
-            time_since_last_run < self.delay_all
-            and args["user_level"] < Command.BYPASS_DELAY_LEVEL
-        ):
-            log.debug(
-                f"Command was run {time_since_last_run:.2f} seconds ago, waiting..."
+        args.update(self.extra_args)
+        if self.run_in_thread:
+            log.debug(f"Running {self} in a thread")
+            ScheduleManager.execute_now(
+                self.run_action, args=[bot, author, channel, message, args, cooldowns]
             )
-            return False
+        else:
+            self.run_action(bot, author, channel, message, args, cooldowns)
 
-        time_since_last_run_user = (
-            cur_time - self.last_run_by_user.get(str(author.id), 0)
-        ) / cd_modifier
+        return True
 
-        if (
-            time_since_last_run_user < self.delay_user
-            and args["user_level"] < Command.BYPASS_DELAY_LEVEL
+    @property
+    def cooldown_key(self):
+        if self.id is not None:
+            return f"command:{self.id}"
+        if self.command:
+            return f"command:{self.trigger}"
+        # Module commands have neither, so their cooldowns are local to this process
+        return f"command:local:{id(self)}"
+
+    def acquire_cooldowns(self, author, user_level):
+        """ Returns the acquired global and per-user cooldowns, or None if the command is on cooldown """
+        # Users that bypass the delays still put the command on cooldown for everyone else
+        if user_level >= Command.BYPASS_DELAY_LEVEL:
+            cd_modifier = 0
+        elif user_level >= 500:
+            cd_modifier = 0.2
+        else:
+            cd_modifier = 1.0
+
+        cooldowns = []
+        for key, delay in (
+            (self.cooldown_key, self.delay_all),
+            (f"{self.cooldown_key}:user:{author.id}", self.delay_user),
         ):
-            log.debug(
-                f"{author.name}#{author.discriminator} ran command {time_since_last_run_user:.2f} seconds ago, waiting..."
-            )
-            return False
-        with DBManager.create_session_scope() as db_session:
-            user = User._create_or_get_by_discord_id(
-                db_session, str(author.id), str(author)
-            )
-            if self.cost > 0 and not user.can_afford(self.cost):
-                # User does not have enough points to use the command
+            if delay <= 0:
+                continue
+            cooldown = CooldownManager.acquire(key, delay * cd_modifier, delay)
+            if cooldown is None:
+                CooldownManager.release(cooldowns)
+                return None
+            cooldowns.append(cooldown)
+        return cooldowns
+
+    def run_action(self, bot, author, channel, message, args, cooldowns=[]):
+        trigger = self.trigger
+        command_executions.inc(labels=[trigger])
+        succeeded = False
+        try:
+            with command_duration.time([trigger]):
+                succeeded = self._run_action(bot, author, channel, message, args)
+        finally:
+            if not succeeded:
+                # Only successful runs put the command on cooldown
+                CooldownManager.release(cooldowns)
+
+    def _run_action(self, bot, author, channel, message, args):
+        """ Returns True if the action succeeded """
+        if self.cost <= 0:
+            # Free commands don't need to touch the user row at all
+            if not self.action.run(bot, author, channel, message, args):
                 return False
+            self.on_run()
+            return True
 
-            args.update(self.extra_args)
-            if self.run_in_thread:
-                log.debug(f"Running {self} in a thread")
-                ScheduleManager.execute_now(
-                    self.run_action, args=[bot, author, channel, message, args]
-                )
-            else:
-                self.run_action(bot, author, channel, message, args)
-
-        return True
-
-    def run_action(self, bot, author, channel, message, args):
-        cur_time = greenbot.utils.now().timestamp()
+        succeeded = False
         with DBManager.create_session_scope() as db_session:
             user = User._create_or_get_by_discord_id(
                 db_session, str(author.id), str(author)
             )
+            if not user.can_afford(self.cost):
+                # The cached points were out of date
+                return False
             with user.spend_currency_context(self.cost):
                 ret = self.action.run(bot, author, channel, message, args)
                 if not ret:
                     raise FailedCommand("return currency")
 
-                # Only spend points, and increment num_uses if the action succeded
-                if self.data is not None:
-                    self.data.num_uses += 1
-                    self.data.last_date_used = greenbot.utils.now()
+                self.on_run()
+                succeeded = True
+
+        UserCache.invalidate(author.id)
+        return succeeded
 
-                # TODO: Will this be an issue?
-                self.last_run = cur_time
-                self.last_run_by_user[args["user_level"]] = cur_time
+    def on_run(self):
+        # Only spend points, and increment num_uses if the action succeded
+        if self.data is not None:
+            self.data.num_uses += 1
+            self.data.last_date_used = greenbot.utils.now()
 
     def autogenerate_examples(self):
         if (
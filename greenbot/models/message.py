@@ -6,11 +6,13 @@ from sqlalchemy import TEXT, BOOLEAN
 from sqlalchemy import Column
 from sqlalchemy import ForeignKey
 from sqlalchemy import func
+from sqlalchemy import text
 from sqlalchemy.orm import relationship
 from sqlalchemy_utc import UtcDateTime
 
 from greenbot.exc import FailedCommand
 from greenbot.managers.db import Base
+from greenbot.models.user_activity import UserActivityHourly
 import greenbot.utils as utils
 
 from datetime import timedelta
@@ -26,7 +28,8 @@ class Message(Base):
     user_id = Column(TEXT, ForeignKey("user.discord_id", ondelete="CASCADE"))
     channel_id = Column(TEXT, nullable=True)
     content = Column(TEXT, nullable=False)
-    time_sent = Column(UtcDateTime(), nullable=True, server_default="NULL")
+    # The table is partitioned by time_sent, so it's part of the primary key
+    time_sent = Column(UtcDateTime(), primary_key=True, nullable=False)
     credited = Column(BOOLEAN, nullable=False, default=False)
     user = relationship("User")
 
@@ -55,21 +58,56 @@ class Message(Base):
             .all()
         )
 
+    @staticmethod
+    def _count_since(db_session, since, user_ids=None, credited=False):
+        """
+        Returns a dictionary of user_id => number of messages (or credited messages) sent after `since`.
+        Whole hours are summed from the user_activity_hourly rollup, only the messages of the
+        first, partial hour are counted from the message table.
+        """
+        next_hour = UserActivityHourly.truncate_hour(since) + timedelta(hours=1)
+        count_column = (
+            UserActivityHourly.credited_count
+            if credited
+            else UserActivityHourly.message_count
+        )
+        rollup = db_session.query(
+            UserActivityHourly.user_id, func.sum(count_column)
+        ).filter(UserActivityHourly.hour >= next_hour)
+        messages = (
+            db_session.query(Message.user_id, func.count(Message.message_id))
+            .filter(Message.time_sent > since)
+            .filter(Message.time_sent < next_hour)
+        )
+        if credited:
+            messages = messages.filter(Message.credited == True)
+        if user_ids is not None:
+            rollup = rollup.filter(UserActivityHourly.user_id.in_(user_ids))
+            messages = messages.filter(Message.user_id.in_(user_ids))
+
+        counts = {}
+        for query, user_id_column in (
+            (rollup, UserActivityHourly.user_id),
+            (messages, Message.user_id),
+        ):
+            for user_id, count in query.group_by(user_id_column):
+                counts[user_id] = counts.get(user_id, 0) + int(count)
+        return counts
+
     @staticmethod
     def _get_messages_count(db_session, user_id):
         return (
-            db_session.query(func.count(Message.message_id))
-            .filter(Message.user_id == str(user_id))
+            db_session.query(
+                func.coalesce(func.sum(UserActivityHourly.message_count), 0)
+            )
+            .filter(UserActivityHourly.user_id == str(user_id))
             .scalar()
         )
 
     @staticmethod
     def _get_messages_since_count(db_session, user_id, time_since):
-        return (
-            db_session.query(func.count(Message.message_id))
-            .filter(Message.user_id == str(user_id))
-            .filter(Message.time_sent > time_since)
-            .scalar()
+        return Message._count_since(db_session, time_since, [str(user_id)]).get(
+            str(user_id), 0
         )
 
     @staticmethod
@@ -83,19 +121,75 @@ class Message(Base):
 
     @staticmethod
     def _get_day_count_user(db_session, user_id):
-        return (
-            db_session.query(func.count(Message.message_id))
-            .filter(Message.credited == True)
-            .filter(Message.user_id == str(user_id))
-            .filter(Message.time_sent > utils.now() - timedelta(days=1))
-            .scalar()
-        )
+        return Message._count_since(
+            db_session, utils.now() - timedelta(days=1), [str(user_id)], credited=True
+        ).get(str(user_id), 0)
 
     @staticmethod
     def _get_week_count_user(db_session, user_id):
-        return (
-            db_session.query(func.count(Message.message_id))
-            .filter(Message.user_id == str(user_id))
-            .filter(Message.time_sent > utils.now() - timedelta(days=7))
-            .scalar()
+        return Message._get_messages_since_count(
+            db_session, user_id, utils.now() - timedelta(days=7)
+        )
+
+    @staticmethod
+    def _get_week_counts(db_session, user_ids):
+        """ Returns a dictionary of user_id => number of messages sent in the last week """
+        if not user_ids:
+            return {}
+
+        return Message._count_since(
+            db_session,
+            utils.now() - timedelta(days=7),
+            [str(user_id) for user_id in user_ids],
+        )
+
+    @staticmethod
+    def _get_day_counts_of_uncredited_users(db_session, since, channel_ids=None):
+        """
+        Returns a dictionary of user_id => number of messages credited in the last day,
+        for the users that have uncredited messages sent after `since`
+        """
+        uncredited = (
+            db_session.query(Message.user_id)
+            .filter(Message.credited == False)
+            .filter(Message.time_sent > since)
+        )
+        if channel_ids:
+            uncredited = uncredited.filter(Message.channel_id.in_(channel_ids))
+
+        return Message._count_since(
+            db_session,
+            utils.now() - timedelta(days=1),
+            uncredited.distinct().subquery(),
+            credited=True,
+        )
+
+    @staticmethod
+    def _credit_since(db_session, since, channel_ids=None):
+        """
+        Marks all uncredited messages sent after `since` as credited, and adds them to the
+        credited counts of the user_activity_hourly rollup.
+        Returns a dictionary of user_id => number of messages that were credited
+        """
+        channel_filter = "AND channel_id = ANY(:channel_ids)" if channel_ids else ""
+        rows = db_session.execute(
+            text(
+                f"""
+                WITH credited AS (
+                    UPDATE message SET credited = TRUE
+                    WHERE credited = FALSE AND time_sent > :since {channel_filter}
+                    RETURNING user_id, channel_id, time_sent
+                ), rollup AS (
+                    INSERT INTO user_activity_hourly(user_id, channel_id, hour, message_count, credited_count)
+                    SELECT user_id, COALESCE(channel_id, ''),
+                        date_trunc('hour', time_sent AT TIME ZONE 'UTC') AT TIME ZONE 'UTC', 0, COUNT(*)
+                    FROM credited GROUP BY 1, 2, 3
+                    ON CONFLICT (user_id, channel_id, hour) DO UPDATE
+                    SET credited_count = user_activity_hourly.credited_count + EXCLUDED.credited_count
+                )
+                SELECT user_id, COUNT(*) FROM credited GROUP BY user_id
+                """
+            ),
+            {"since": since, "channel_ids": list(channel_ids or [])},
         )
+        return {user_id: count for user_id, count in rows}
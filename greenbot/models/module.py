@@ -46,22 +46,32 @@ class ModuleManager:
         self.bot = bot
 
         if socket_manager:
-            socket_manager.add_handler("module.update", self.on_module_update)
+            socket_manager.add_handler(
+                "module.update", self.on_module_update, batch=True
+            )
 
     def get_module(self, module_id):
         return find(lambda m: m.ID == module_id, self.all_modules)
 
-    def on_module_update(self, data):
-        new_state = data.get("new_state", None)
-        if new_state is True:
-            self.enable_module(data["id"])
-        elif new_state is False:
-            self.disable_module(data["id"])
-        else:
-            module = self.get_module(data["id"])
-
-            if module:
-                module.load()
+    def on_module_update(self, messages):
+        # Only the last change of every module matters, a settings change is implied by enabling it
+        new_states = {}
+        for data in messages:
+            new_state = data.get("new_state", None)
+            if new_state is None and new_states.get(data["id"], None) is not None:
+                continue
+            new_states[data["id"]] = new_state
+
+        for module_id, new_state in new_states.items():
+            if new_state is True:
+                self.enable_module(module_id)
+            elif new_state is False:
+                self.disable_module(module_id)
+            else:
+                module = self.get_module(module_id)
+
+                if module:
+                    module.load()
 
     def enable_module(self, module_id):
         module = self.get_module(module_id)
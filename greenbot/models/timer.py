@@ -1,5 +1,9 @@
+import heapq
+import itertools
 import json
 import logging
+import threading
+import time
 
 from sqlalchemy import INT, BOOLEAN, TEXT
 from sqlalchemy import Column
@@ -8,7 +12,6 @@ from sqlalchemy.orm import reconstructor
 from greenbot.managers.db import Base
 from greenbot.managers.db import DBManager
 from greenbot.models.action import ActionParser
-from greenbot.utils import find
 
 log = logging.getLogger("greenbot")
 
@@ -32,8 +35,6 @@ class Timer(Base):
         self.interval_offline = 30
         self.enabled = True
 
-        self.refresh_tts()
-
         self.set(**options)
 
     def set(self, **options):
@@ -51,12 +52,6 @@ class Timer(Base):
     def init_on_load(self):
         self.action = ActionParser.parse(self.action_json)
 
-        self.refresh_tts()
-
-    def refresh_tts(self):
-        self.time_to_send_online = self.interval_online
-        self.time_to_send_offline = self.interval_offline
-
     def refresh_action(self):
         self.action = ActionParser.parse(self.action_json)
 
@@ -64,20 +59,125 @@ class Timer(Base):
         self.action.run(bot, source=None, message=None)
 
 
+class TimerQueue:
+    """
+    Timers of one mode (online or offline) in a min-heap keyed by their next fire time.
+
+    Removed or rescheduled timers are only marked as stale and skipped when they reach
+    the top of the heap. The queue has its own clock, which stands still while the queue
+    is paused, so timers of the inactive mode don't count down (like they didn't before).
+    """
+
+    def __init__(self, interval_attribute):
+        self.interval_attribute = interval_attribute
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.paused_since = None
+        self.paused_total = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, timer):
+        return timer.id in self.entries
+
+    def clock(self):
+        now = time.monotonic()
+        if self.paused_since is not None:
+            now = self.paused_since
+        return now - self.paused_total
+
+    def pause(self):
+        if self.paused_since is None:
+            self.paused_since = time.monotonic()
+
+    def resume(self):
+        if self.paused_since is not None:
+            self.paused_total += time.monotonic() - self.paused_since
+            self.paused_since = None
+
+    def get_interval(self, timer):
+        """ Returns the interval of `timer` in seconds, the interval columns are in minutes """
+        return getattr(timer, self.interval_attribute) * 60
+
+    def schedule(self, timer, delay):
+        self.remove(timer)
+        entry = [self.clock() + delay, next(self.counter), timer, True]
+        self.entries[timer.id] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, timer):
+        entry = self.entries.pop(timer.id, None)
+        if entry is None:
+            return
+        entry[-1] = False
+        # Don't let the heap fill up with stale entries when timers are edited a lot
+        if len(self.heap) > 2 * len(self.entries) + 16:
+            self.heap = [entry for entry in self.heap if entry[-1]]
+            heapq.heapify(self.heap)
+
+    def pop_due(self):
+        """ Returns the timers that are due, and schedules their next run """
+        now = self.clock()
+        due_timers = []
+        while self.heap and self.heap[0][0] <= now:
+            fire_at, _, timer, valid = heapq.heappop(self.heap)
+            if not valid:
+                continue
+            due_timers.append(timer)
+            entry = [
+                max(fire_at + self.get_interval(timer), now),
+                next(self.counter),
+                timer,
+                True,
+            ]
+            self.entries[timer.id] = entry
+            heapq.heappush(self.heap, entry)
+        return due_timers
+
+    def get_delay(self, timer):
+        entry = self.entries.get(timer.id, None)
+        if entry is None:
+            return None
+        return entry[0] - self.clock()
+
+
 class TimerManager:
+    """
+    Runs the timers of the current mode.
+
+    tick runs on the scheduler thread and the socket handlers on executor threads, so the
+    timers and their queues are only used with the lock held.
+    """
+
     def __init__(self, bot):
         self.bot = bot
 
-        self.timers = []
-        self.online_timers = []
-        self.offline_timers = []
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.online_timers = TimerQueue("interval_online")
+        self.offline_timers = TimerQueue("interval_offline")
 
-        self.bot.execute_every(60, self.tick)
+        self.bot.execute_every(1, self.tick)
 
         if self.bot:
             self.bot.socket_manager.add_handler("timer.update", self.on_timer_update)
             self.bot.socket_manager.add_handler("timer.remove", self.on_timer_remove)
 
+    def update_queues(self, timer):
+        """ Adds `timer` to the queues it belongs to, and removes it from the others """
+        for queue in (self.online_timers, self.offline_timers):
+            interval = queue.get_interval(timer)
+            if not timer.enabled or interval <= 0:
+                queue.remove(timer)
+                continue
+
+            delay = queue.get_delay(timer)
+            if delay is None or delay > interval:
+                # New timer, or the interval was shortened
+                queue.schedule(timer, interval)
+
     def on_timer_update(self, data):
         try:
             timer_id = int(data["id"])
@@ -85,7 +185,8 @@ class TimerManager:
             log.warning("No timer ID found in on_timer_update")
             return False
 
-        updated_timer = find(lambda timer: timer.id == timer_id, self.timers)
+        with self.lock:
+            updated_timer = self.timers.get(timer_id, None)
         if updated_timer:
             with DBManager.create_session_scope(expire_on_commit=False) as db_session:
                 db_session.add(updated_timer)
@@ -97,29 +198,13 @@ class TimerManager:
                 updated_timer = (
                     db_session.query(Timer).filter_by(id=timer_id).one_or_none()
                 )
+                if updated_timer:
+                    db_session.expunge(updated_timer)
 
-        # Add the updated timer to the timer lists if required
         if updated_timer:
-            if updated_timer not in self.timers:
-                self.timers.append(updated_timer)
-
-            if updated_timer not in self.online_timers:
-                if updated_timer.interval_online > 0:
-                    self.online_timers.append(updated_timer)
-                    updated_timer.refresh_tts()
-
-            if updated_timer not in self.offline_timers:
-                if updated_timer.interval_offline > 0:
-                    self.offline_timers.append(updated_timer)
-                    updated_timer.refresh_tts()
-
-        for timer in self.online_timers:
-            if timer.enabled is False or timer.interval_online <= 0:
-                self.online_timers.remove(timer)
-
-        for timer in self.offline_timers:
-            if timer.enabled is False or timer.interval_offline <= 0:
-                self.offline_timers.remove(timer)
+            with self.lock:
+                self.timers[updated_timer.id] = updated_timer
+                self.update_queues(updated_timer)
 
         return True
 
@@ -130,78 +215,62 @@ class TimerManager:
             log.warning("No timer ID found in on_timer_update")
             return False
 
-        removed_timer = find(lambda timer: timer.id == timer_id, self.timers)
-        if removed_timer:
-            if removed_timer in self.timers:
-                self.timers.remove(removed_timer)
-            if removed_timer in self.online_timers:
+        with self.lock:
+            removed_timer = self.timers.pop(timer_id, None)
+            if removed_timer:
                 self.online_timers.remove(removed_timer)
-            if removed_timer in self.offline_timers:
                 self.offline_timers.remove(removed_timer)
 
         return True
 
     def tick(self):
-        if self.bot.is_online:
-            for timer in self.online_timers:
-                timer.time_to_send_online -= 1
-            timer = find(
-                lambda timer: timer.time_to_send_online <= 0, self.online_timers
-            )
-            if timer:
-                timer.run(self.bot)
-                timer.time_to_send_online = timer.interval_online
-                self.online_timers.remove(timer)
-                self.online_timers.append(timer)
-        else:
-            for timer in self.offline_timers:
-                timer.time_to_send_offline -= 1
-            timer = find(
-                lambda timer: timer.time_to_send_offline <= 0, self.offline_timers
-            )
-            if timer:
+        is_online = self.bot.is_online
+        with self.lock:
+            if is_online:
+                self.offline_timers.pause()
+                self.online_timers.resume()
+                due_timers = self.online_timers.pop_due()
+            else:
+                self.online_timers.pause()
+                self.offline_timers.resume()
+                due_timers = self.offline_timers.pop_due()
+
+        for timer in due_timers:
+            try:
                 timer.run(self.bot)
-                timer.time_to_send_offline = timer.interval_offline
-                self.offline_timers.remove(timer)
-                self.offline_timers.append(timer)
+            except:
+                log.exception(f"Unable to run timer {timer.name}")
 
     def redistribute_timers(self):
-        for x in range(0, len(self.offline_timers)):
-            timer = self.offline_timers[x]
-            timer.time_to_send_offline = timer.interval_offline * (
-                (x + 1) / len(self.offline_timers)
-            )
-
-        for x in range(0, len(self.online_timers)):
-            timer = self.online_timers[x]
-            timer.time_to_send_online = timer.interval_online * (
-                (x + 1) / len(self.online_timers)
-            )
+        """ Spread the timers over their intervals, call with the lock held """
+        for queue in (self.online_timers, self.offline_timers):
+            timers = [
+                timer
+                for timer in self.timers.values()
+                if timer.enabled and queue.get_interval(timer) > 0
+            ]
+            for x, timer in enumerate(timers):
+                queue.schedule(
+                    timer, queue.get_interval(timer) * ((x + 1) / len(timers))
+                )
 
     def load(self):
-        self.timers = []
         with DBManager.create_session_scope(expire_on_commit=False) as db_session:
-            self.timers = (
+            timers = (
                 db_session.query(Timer)
                 .order_by(Timer.interval_online, Timer.interval_offline, Timer.name)
                 .all()
             )
             db_session.expunge_all()
 
-        self.online_timers = [
-            timer
-            for timer in self.timers
-            if timer.interval_online > 0 and timer.enabled
-        ]
-        self.offline_timers = [
-            timer
-            for timer in self.timers
-            if timer.interval_offline > 0 and timer.enabled
-        ]
-
-        self.redistribute_timers()
-
-        log.info(
-            f"Loaded {len(self.timers)} timers ({len(self.online_timers)} online/{len(self.offline_timers)} offline)"
-        )
+        with self.lock:
+            self.timers = {timer.id: timer for timer in timers}
+            self.online_timers = TimerQueue("interval_online")
+            self.offline_timers = TimerQueue("interval_offline")
+
+            self.redistribute_timers()
+
+            log.info(
+                f"Loaded {len(self.timers)} timers ({len(self.online_timers)} online/{len(self.offline_timers)} offline)"
+            )
         return self
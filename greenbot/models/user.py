@@ -4,6 +4,7 @@ from contextlib import contextmanager
 
 from sqlalchemy import INT, TEXT
 from sqlalchemy import Column
+from sqlalchemy import text
 
 from greenbot.exc import FailedCommand
 from greenbot.managers.db import Base
@@ -52,6 +53,35 @@ class User(Base):
     def _get_users_with_points(db_session, points):
         return db_session.query(User).filter(User.points >= points).all()
 
+    @staticmethod
+    def _get_ids_with_points(db_session, points):
+        return {
+            discord_id
+            for discord_id, in db_session.query(User.discord_id).filter(
+                User.points >= points
+            )
+        }
+
+    @staticmethod
+    def _add_points(db_session, points_by_user):
+        """ Add points to many users in one statement. points_by_user is a dictionary of discord_id => points """
+        if not points_by_user:
+            return
+
+        db_session.execute(
+            text(
+                """
+                UPDATE "user" SET points = "user".points + v.points
+                FROM unnest(:discord_ids, :points) AS v(discord_id, points)
+                WHERE "user".discord_id = v.discord_id
+                """
+            ),
+            {
+                "discord_ids": list(points_by_user.keys()),
+                "points": list(points_by_user.values()),
+            },
+        )
+
     @contextmanager
     def spend_currency_context(self, points):
         try:
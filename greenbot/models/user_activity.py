@@ -0,0 +1,57 @@
+import datetime
+import logging
+
+from sqlalchemy import INT, TEXT
+from sqlalchemy import Column
+from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import func
+from sqlalchemy_utc import UtcDateTime
+
+from greenbot.managers.db import Base
+
+log = logging.getLogger(__name__)
+
+
+class UserActivityHourly(Base):
+    """
+    Number of messages sent (and credited) per user, channel and hour.
+
+    The rows are incremented by the MessageBuffer when messages are written, and by
+    Message._credit_since when messages are credited (see migration 0003).
+    """
+
+    __tablename__ = "user_activity_hourly"
+    __table_args__ = (Index("user_activity_hourly_hour_idx", "hour"),)
+
+    user_id = Column(
+        TEXT, ForeignKey("user.discord_id", ondelete="CASCADE"), primary_key=True
+    )
+    # Messages without a channel are stored with an empty channel id
+    channel_id = Column(TEXT, primary_key=True, default="")
+    hour = Column(UtcDateTime(), primary_key=True)
+    message_count = Column(INT, nullable=False, default=0)
+    credited_count = Column(INT, nullable=False, default=0)
+
+    @staticmethod
+    def truncate_hour(dt):
+        return dt.astimezone(datetime.timezone.utc).replace(
+            minute=0, second=0, microsecond=0
+        )
+
+    @staticmethod
+    def _get_volume(db_session, since, channel_id=None):
+        """ Returns a list of (channel_id, hour, message count) of all channels since the hour of `since` """
+        query = db_session.query(
+            UserActivityHourly.channel_id,
+            UserActivityHourly.hour,
+            func.sum(UserActivityHourly.message_count),
+        ).filter(UserActivityHourly.hour >= UserActivityHourly.truncate_hour(since))
+        if channel_id is not None:
+            query = query.filter(UserActivityHourly.channel_id == channel_id)
+
+        return (
+            query.group_by(UserActivityHourly.channel_id, UserActivityHourly.hour)
+            .order_by(UserActivityHourly.hour, UserActivityHourly.channel_id)
+            .all()
+        )
@@ -1,11 +1,11 @@
 import logging
-
-from sqlalchemy.orm import joinedload
+from datetime import timedelta
 
 from greenbot import utils
 from greenbot.exc import InvalidPointAmount
 from greenbot.managers.db import DBManager
 from greenbot.managers.schedule import ScheduleManager
+from greenbot.managers.user_cache import UserCache
 from greenbot.models.command import Command
 from greenbot.models.command import CommandExample
 from greenbot.models.message import Message
@@ -86,42 +86,85 @@ class ActivityTracker(BaseModule):
         self.bot = bot
         self.process_messages_job = None
 
+    @staticmethod
+    def calculate_points(credited_today, num_credited, settings):
+        """
+        Points for crediting num_credited messages of a user who already had credited_today
+        messages credited in the last day. Every message is worth hourly_credit until the
+        daily maximum is almost reached, the message that reaches it is worth daily_limit,
+        and messages after that are worth nothing.
+        """
+        last_paid = settings["daily_max_msgs"] - 1
+        points = settings["hourly_credit"] * max(
+            0, min(num_credited, last_paid - credited_today)
+        )
+        if credited_today <= last_paid < credited_today + num_credited:
+            points += settings["daily_limit"]
+        return points
+
     def process_messages(self):
+        regular_role = self.bot.get_role(self.settings["regular_role_id"])
+        sub_role = self.bot.get_role(self.settings["sub_role_id"])
+        if regular_role is None or sub_role is None:
+            log.warning("ActivityTracker: the regular or sub role does not exist")
+
+        channels_to_listen_in = (
+            self.settings["channels_to_listen_in"].split(" ")
+            if len(self.settings["channels_to_listen_in"]) != 0
+            else []
+        )
+        bot_id = str(self.bot.bot_id)
+        since = utils.now() - timedelta(hours=1)
+
         with DBManager.create_session_scope() as db_session:
-            regular_role = self.bot.get_role(self.settings["regular_role_id"])
-            sub_role = self.bot.get_role(self.settings["sub_role_id"])
-            for member in regular_role.members:
-                count = Message._get_week_count_user(db_session, str(member.id))
-                if (
-                    count < self.settings["min_msgs_per_week"]
-                    or sub_role not in member.roles
-                ):
-                    self.bot.remove_role(member, regular_role)
-            db_session.commit()
-            messages = Message._get_last_hour(db_session)
-            channels_to_listen_in = self.settings["channels_to_listen_in"].split(" ") if len(self.settings["channels_to_listen_in"]) != 0 else []
-            for message in messages:
-                if message.channel_id not in channels_to_listen_in and len(channels_to_listen_in) != 0:
+            if regular_role is not None:
+                members = regular_role.members
+                week_counts = Message._get_week_counts(
+                    db_session, [member.id for member in members]
+                )
+                for member in members:
+                    if (
+                        week_counts.get(str(member.id), 0)
+                        < self.settings["min_msgs_per_week"]
+                        or sub_role not in member.roles
+                    ):
+                        self.bot.remove_role(member, regular_role)
+
+            day_counts = Message._get_day_counts_of_uncredited_users(
+                db_session, since, channels_to_listen_in
+            )
+            credited = Message._credit_since(db_session, since, channels_to_listen_in)
+            points_by_user = {}
+            for user_id, num_credited in credited.items():
+                if user_id == bot_id:
                     continue
-                count = Message._get_day_count_user(db_session, message.user_id)
-                if message.user_id != str(self.bot.bot_id):
-                    if count < self.settings["daily_max_msgs"] - 1:
-                        message.user.points += self.settings["hourly_credit"]
-                    elif count == self.settings["daily_max_msgs"] - 1:
-                        message.user.points += self.settings["daily_limit"]
-                message.credited = True
-                db_session.commit()
-            for user in User._get_users_with_points(
+                points = self.calculate_points(
+                    day_counts.get(user_id, 0), num_credited, self.settings
+                )
+                if points:
+                    points_by_user[user_id] = points
+            User._add_points(db_session, points_by_user)
+            db_session.commit()
+
+            eligible_ids = User._get_ids_with_points(
                 db_session, self.settings["min_regular_points"]
-            ):
-                member = self.bot.get_member(user.discord_id)
-                if (
-                    not member
-                    or sub_role not in member.roles
-                    or regular_role in member.roles
-                ):
-                    continue
-                self.bot.add_role(member, regular_role)
+            )
+
+        # Points of many users have changed, drop all cached users
+        UserCache.invalidate()
+        log.info(
+            f"ActivityTracker: credited {sum(credited.values())} messages of {len(credited)} users"
+        )
+
+        if regular_role is None or sub_role is None:
+            return
+
+        regular_ids = {str(member.id) for member in regular_role.members}
+        for discord_id in eligible_ids - regular_ids:
+            member = self.bot.get_member(discord_id)
+            if not member or sub_role not in member.roles:
+                continue
+            self.bot.add_role(member, regular_role)
 
     def enable(self, bot):
         if not bot:
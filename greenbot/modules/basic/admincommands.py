@@ -2,6 +2,7 @@ import logging
 
 from greenbot.managers.db import DBManager
 from greenbot.managers.adminlog import AdminLogManager
+from greenbot.managers.handler import HandlerManager
 from greenbot.models.command import Command
 from greenbot.models.command import CommandExample
 from greenbot.models.module import Module
@@ -153,6 +154,34 @@ class AdminCommandsModule(BaseModule):
                 return
             bot.say(channel, "Enabled module {module_id}")
 
+    @staticmethod
+    def cmd_handlers(bot, author, channel, message, args):
+        whisper = args["whisper"]
+        event_name = message.split(" ")[0].lower() if message else None
+        stats = HandlerManager.get_stats(event_name)[:5]
+
+        messages = split_into_chunks_with_prefix(
+            [
+                {
+                    "prefix": "Slowest handlers:",
+                    "parts": [
+                        f"{s['event']}/{s['handler']} ({s['count']} calls, "
+                        f"mean {s['mean_time'] * 1000:.1f}ms, p95 {s['p95_time'] * 1000:.1f}ms, "
+                        f"{s['errors']} errors)"
+                        for s in stats
+                    ],
+                }
+            ],
+            " ",
+            default="No handler stats available.",
+        )
+
+        for message in messages:
+            if whisper:
+                bot.private_message(author, message)
+                continue
+            bot.say(channel, message)
+
     def load_commands(self, **options):
         self.commands["module"] = Command.raw_command(
             self.cmd_module,
@@ -162,3 +191,11 @@ class AdminCommandsModule(BaseModule):
             delay_user=0,
             can_execute_with_whisper=True,
         )
+        self.commands["handlers"] = Command.raw_command(
+            self.cmd_handlers,
+            level=500,
+            description="Show the slowest event handlers",
+            delay_all=0,
+            delay_user=0,
+            can_execute_with_whisper=True,
+        )
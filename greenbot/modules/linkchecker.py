@@ -1,9 +1,12 @@
 import argparse
+import asyncio
+import codecs
 import logging
 import urllib.parse
+import weakref
+from html.parser import HTMLParser
 
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
 from datetime import timedelta
 from sqlalchemy import Column, INT, TEXT
 
@@ -13,7 +16,10 @@ import greenbot.utils
 from greenbot.managers.adminlog import AdminLogManager
 from greenbot.managers.db import Base
 from greenbot.managers.db import DBManager
+from greenbot.managers.executor import ExecutorManager
 from greenbot.managers.handler import HandlerManager
+from greenbot.managers.metrics import MetricsManager
+from greenbot.managers.redis import RedisManager
 from greenbot.models.command import Command
 from greenbot.models.command import CommandExample
 from greenbot.modules import BaseModule
@@ -21,6 +27,15 @@ from greenbot.modules import ModuleSetting
 
 log = logging.getLogger(__name__)
 
+cache_lookups = MetricsManager.counter(
+    "greenbot_linkchecker_cache_lookups_total",
+    "Link cache lookups by result (hit, redis_hit or miss)",
+    ["result"],
+)
+cache_size = MetricsManager.gauge(
+    "greenbot_linkchecker_cache_size", "Links in the local link cache"
+)
+
 
 def is_subdomain(x, y):
     """ Returns True if x is a subdomain of y, otherwise return False.
@@ -76,22 +91,376 @@ class Url:
         self.parsed = urllib.parse.urlparse(url)
 
 
-class LinkCheckerCache:
+class LinkIndex:
+    """
+    Index of links for fast "is this URL covered by any of the links" lookups.
+
+    Domains are stored in a trie of their labels in reverse order (com -> example -> www),
+    and every domain has a trie of its path segments. A lookup walks the labels of the
+    URL's domain and the segments of its path, so it doesn't depend on the number of links.
+
+    A link matches the same subdomains and subpaths as `is_subdomain` and `is_subpath`.
+    """
+
+    class Node:
+        __slots__ = ("children", "value")
+
+        def __init__(self):
+            self.children = {}
+            self.value = None
+
     def __init__(self):
-        self.cache = {}
-        return
+        self.root = self.Node()
+        self.num_links = 0
+
+    def __len__(self):
+        return self.num_links
+
+    @staticmethod
+    def split_domain(domain):
+        domain = domain.lower()
+        if domain.startswith("www."):
+            domain = domain[4:]
+        return reversed(domain.split("."))
+
+    @staticmethod
+    def split_path(path):
+        path = path.lower()
+        if path.endswith("/"):
+            path = path[:-1]
+        if path == "":
+            # The root path matches everything
+            return []
+        return path.split("/")
+
+    def add(self, domain, path, value):
+        node = self.root
+        for label in self.split_domain(domain):
+            node = node.children.setdefault(label, self.Node())
+        if node.value is None:
+            node.value = self.Node()
+
+        node = node.value
+        for segment in self.split_path(path):
+            node = node.children.setdefault(segment, self.Node())
+        if node.value is None:
+            node.value = []
+        node.value.append(value)
+        self.num_links += 1
+
+    def remove(self, domain, path, value):
+        node = self.root
+        for label in self.split_domain(domain):
+            node = node.children.get(label, None)
+            if node is None:
+                return False
+
+        node = node.value
+        for segment in self.split_path(path):
+            if node is None:
+                return False
+            node = node.children.get(segment, None)
+        if node is None or not node.value or value not in node.value:
+            return False
+
+        node.value.remove(value)
+        self.num_links -= 1
+        return True
+
+    def match(self, domain, path):
+        """ Yields the values of all links that cover the given domain and path """
+        path = path.lower()
+        if path == "":
+            path = "/"
+        segments = path.split("/")
+
+        node = self.root
+        for label in reversed(domain.lower().split(".")):
+            node = node.children.get(label, None)
+            if node is None:
+                return
+            if node.value is not None:
+                yield from self.match_path(node.value, segments)
+
+    @staticmethod
+    def match_path(node, segments):
+        if node.value:
+            yield from node.value
+        for segment in segments:
+            node = node.children.get(segment, None)
+            if node is None:
+                return
+            if node.value:
+                yield from node.value
+
+
+def run_once(action):
+    """ Wraps the action so it's only run the first time it's called """
+    done = []
+
+    def wrapper():
+        if not done:
+            done.append(True)
+            if action:
+                action()
+
+    return wrapper
+
+
+class LinkScanner:
+    """
+    Runs the HTTP requests of link checks on the bot's event loop.
+
+    All requests share one connection pool. The number of concurrent requests
+    is bounded globally and per host, and response bodies are capped.
+    """
+
+    errors = (aiohttp.ClientError, asyncio.TimeoutError, ValueError)
+
+    def __init__(
+        self,
+        loop,
+        user_agent,
+        max_requests=20,
+        max_requests_per_host=4,
+        connect_timeout=2,
+        read_timeout=1,
+        receive_timeout=3,
+        max_body_size=1024 * 1024 * 10,
+    ):
+        self.loop = loop
+        self.user_agent = user_agent
+        self.max_requests_per_host = max_requests_per_host
+        self.max_requests = max_requests
+        self.head_timeout = aiohttp.ClientTimeout(
+            total=connect_timeout + read_timeout, connect=connect_timeout
+        )
+        self.get_timeout = aiohttp.ClientTimeout(
+            total=receive_timeout, connect=connect_timeout, sock_read=read_timeout
+        )
+        self.max_body_size = max_body_size
+
+        self.session = None
+        self.semaphore = None
+        # host => semaphore, dropped once no request to the host is running
+        self.host_semaphores = weakref.WeakValueDictionary()
+
+    def submit(self, coro):
+        """ Schedule a coroutine on the bot loop from any thread """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                loop=self.loop,
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_requests,
+                    limit_per_host=self.max_requests_per_host,
+                    loop=self.loop,
+                ),
+                headers={"User-Agent": self.user_agent},
+            )
+            self.semaphore = asyncio.Semaphore(self.max_requests)
+        return self.session
+
+    def get_host_semaphore(self, url):
+        host = urllib.parse.urlparse(url).netloc.lower()
+        semaphore = self.host_semaphores.get(host, None)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_requests_per_host)
+            self.host_semaphores[host] = semaphore
+        return semaphore
+
+    async def head(self, url):
+        """ Returns the URL after redirects and the headers of the final response """
+        session = self.get_session()
+        host_semaphore = self.get_host_semaphore(url)
+        # Wait for the host first, requests queued for a slow host hold no global slot
+        async with host_semaphore, self.semaphore:
+            async with session.head(
+                url, allow_redirects=True, timeout=self.head_timeout
+            ) as response:
+                return str(response.url), response.headers
+
+    async def extract_links(self, url, extractor):
+        """
+        Stream the page into the link extractor until the extractor has seen enough.
+        Returns False if the page is larger than the maximum size.
+        """
+        session = self.get_session()
+        host_semaphore = self.get_host_semaphore(url)
+        # Wait for the host first, requests queued for a slow host hold no global slot
+        async with host_semaphore, self.semaphore:
+            async with session.get(url, timeout=self.get_timeout) as response:
+                if (response.content_length or 0) > self.max_body_size:
+                    return False
+
+                extractor.set_encoding(response.charset)
+                size = 0
+                async for chunk in response.content.iter_chunked(8192):
+                    size += len(chunk)
+                    if size > self.max_body_size:
+                        # fake content length header
+                        return False
+                    extractor.feed_bytes(chunk)
+                    if extractor.done:
+                        break
+
+        extractor.close()
+        return True
 
-    def __getitem__(self, url):
-        return self.cache[url.strip("/").lower()]
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
-    def __setitem__(self, url, safe):
-        self.cache[url.strip("/").lower()] = safe
 
-    def __contains__(self, url):
-        return url.strip("/").lower() in self.cache
+class LinkExtractor(HTMLParser):
+    """
+    Collects the links (`<a href>`) of an HTML page while it is being downloaded.
 
-    def __delitem__(self, url):
-        del self.cache[url.strip("/").lower()]
+    Only the unparsed tail of the page is kept in memory. `done` is set once `max_links`
+    accepted links were found, or a link matched `stop_on`, so the rest of the page
+    doesn't have to be downloaded.
+    """
+
+    def __init__(self, max_links=50, accept=None, stop_on=None):
+        super().__init__(convert_charrefs=True)
+        self.max_links = max_links
+        self.accept = accept
+        self.stop_on = stop_on
+        self.links = {}
+        self.done = False
+        self.decoder = None
+        self.set_encoding("utf-8")
+
+    def set_encoding(self, encoding):
+        try:
+            self.decoder = codecs.getincrementaldecoder(encoding or "utf-8")(
+                errors="replace"
+            )
+        except LookupError:
+            self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def feed_bytes(self, chunk):
+        if self.done:
+            return
+
+        try:
+            self.feed(self.decoder.decode(chunk))
+        except:
+            log.exception("Unable to parse HTML")
+            self.done = True
+
+    def close(self):
+        if not self.done:
+            try:
+                self.feed(self.decoder.decode(b"", final=True))
+                super().close()
+            except:
+                log.exception("Unable to parse HTML")
+        self.done = True
+
+    def handle_starttag(self, tag, attrs):
+        if self.done or tag != "a":
+            return
+
+        for name, url in attrs:
+            if name != "href" or not url:
+                continue
+            if url.startswith("//"):
+                url = "http:" + url
+            elif not (url.startswith("http://") or url.startswith("https://")):
+                continue
+            if url in self.links:
+                continue
+
+            link = Url(url)
+            if self.accept and not self.accept(link):
+                continue
+
+            self.links[url] = link
+            if (self.stop_on and self.stop_on(link)) or len(self.links) >= self.max_links:
+                self.done = True
+                return
+
+    def get_links(self):
+        return list(self.links.values())
+
+
+class LinkCheckerCache:
+    """
+    Verdicts of recently checked URLs, True means the URL is safe, False means it's bad.
+
+    Verdicts are kept in a bounded LRU cache, safe and bad verdicts expire after their own TTL.
+    If `redis_prefix` is set, verdicts are stored in redis as well, so other bot instances
+    and the web interface share them.
+    """
+
+    def __init__(self, maxsize=10000, safe_ttl=20, bad_ttl=600, redis_prefix=None):
+        self.cache = greenbot.utils.TTLCache(maxsize=maxsize, ttl=safe_ttl)
+        self.safe_ttl = safe_ttl
+        self.bad_ttl = bad_ttl
+        self.redis_prefix = redis_prefix
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url):
+        return url.strip("/").lower()
+
+    def get(self, url):
+        """ Returns the verdict for the URL, or None if it's not cached """
+        key = self.key(url)
+        safe = self.cache.get(key)
+        if safe is not None:
+            self.hits += 1
+            cache_lookups.inc(labels=["hit"])
+            return safe
+
+        if self.redis_prefix is not None:
+            try:
+                value = RedisManager.get().get(self.redis_prefix + key)
+            except:
+                log.exception("Unable to read the shared link cache")
+                value = None
+            if value is not None:
+                safe = value == "1"
+                self.cache.set(key, safe, self.safe_ttl if safe else self.bad_ttl)
+                self.redis_hits += 1
+                cache_lookups.inc(labels=["redis_hit"])
+                return safe
+
+        self.misses += 1
+        cache_lookups.inc(labels=["miss"])
+        return None
+
+    def set(self, url, safe):
+        key = self.key(url)
+        ttl = self.safe_ttl if safe else self.bad_ttl
+        if ttl <= 0:
+            # Caching is turned off for this verdict
+            return
+        self.cache.set(key, safe, ttl)
+
+        if self.redis_prefix is not None:
+            try:
+                RedisManager.get().setex(self.redis_prefix + key, ttl, "1" if safe else "0")
+            except:
+                log.exception("Unable to write to the shared link cache")
+
+    def __len__(self):
+        return len(self.cache)
+
+    def stats(self):
+        return {
+            "size": len(self.cache),
+            "maxsize": self.cache.maxsize,
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+        }
 
 
 class LinkCheckerLink:
@@ -179,6 +548,40 @@ class LinkCheckerModule(BaseModule):
             default=500,
             constraints={"min_value": 100, "max_value": 1000},
         ),
+        ModuleSetting(
+            key="cache_safe_ttl",
+            label="Seconds to remember that a link is safe",
+            type="number",
+            required=True,
+            placeholder="",
+            default=20,
+            constraints={"min_value": 1, "max_value": 86400},
+        ),
+        ModuleSetting(
+            key="cache_bad_ttl",
+            label="Seconds to remember that a link is bad",
+            type="number",
+            required=True,
+            placeholder="",
+            default=600,
+            constraints={"min_value": 1, "max_value": 86400},
+        ),
+        ModuleSetting(
+            key="cache_size",
+            label="Maximum number of remembered links",
+            type="number",
+            required=True,
+            placeholder="",
+            default=10000,
+            constraints={"min_value": 100, "max_value": 1000000},
+        ),
+        ModuleSetting(
+            key="shared_cache",
+            label="Share checked links with other bot instances through redis",
+            type="boolean",
+            required=True,
+            default=False,
+        ),
     ]
 
     def __init__(self, bot):
@@ -186,14 +589,16 @@ class LinkCheckerModule(BaseModule):
         self.db_session = None
         self.links = {}
 
-        self.blacklisted_links = []
-        self.whitelisted_links = []
+        self.blacklisted_links = LinkIndex()
+        self.whitelisted_links = LinkIndex()
+        self.super_whitelisted_links = LinkIndex()
+        for domain in self.super_whitelist:
+            self.super_whitelisted_links.add(domain, "/", domain)
 
-        self.cache = (
-            LinkCheckerCache()
-        )  # cache[url] = True means url is safe, False means the link is bad
+        self.cache = LinkCheckerCache()
 
         self.safe_browsing_api = None
+        self.scanner = None
 
     def enable(self, bot):
         if not bot:
@@ -202,18 +607,29 @@ class LinkCheckerModule(BaseModule):
         HandlerManager.add_handler("on_message", self.on_message, priority=100)
         HandlerManager.add_handler("on_commit", self.on_commit)
 
+        self.scanner = LinkScanner(bot.private_loop, bot.user_agent)
+        self.cache = LinkCheckerCache(
+            maxsize=self.settings["cache_size"],
+            safe_ttl=self.settings["cache_safe_ttl"],
+            bad_ttl=self.settings["cache_bad_ttl"],
+            redis_prefix=f"{bot.bot_name}:linkchecker:"
+            if self.settings["shared_cache"]
+            else None,
+        )
+        cache_size.set_function(lambda: len(self.cache))
+
         if self.db_session is not None:
             self.db_session.commit()
             self.db_session.close()
             self.db_session = None
         self.db_session = DBManager.create_session()
-        self.blacklisted_links = []
+        self.blacklisted_links = LinkIndex()
         for link in self.db_session.query(BlacklistedLink):
-            self.blacklisted_links.append(link)
+            self.blacklisted_links.add(link.domain, link.path, link)
 
-        self.whitelisted_links = []
+        self.whitelisted_links = LinkIndex()
         for link in self.db_session.query(WhitelistedLink):
-            self.whitelisted_links.append(link)
+            self.whitelisted_links.add(link.domain, link.path, link)
 
     def disable(self, bot):
         if not bot:
@@ -226,12 +642,16 @@ class LinkCheckerModule(BaseModule):
             "on_commit", self.on_commit
         )
 
+        if self.scanner is not None:
+            self.scanner.submit(self.scanner.close())
+            self.scanner = None
+
         if self.db_session is not None:
             self.db_session.commit()
             self.db_session.close()
             self.db_session = None
-            self.blacklisted_links = []
-            self.whitelisted_links = []
+            self.blacklisted_links = LinkIndex()
+            self.whitelisted_links = LinkIndex()
 
     def reload(self):
 
@@ -269,11 +689,9 @@ class LinkCheckerModule(BaseModule):
                     parsed_url = Url(url)
                     if len(parsed_url.parsed.netloc.split(".")) < 2:
                         continue
-                    whitelisted = False
-                    for whitelist in self.super_whitelist:
-                        if is_subdomain(parsed_url.parsed.netloc, whitelist):
-                            whitelisted = True
-                            break
+                    whitelisted = any(
+                        self.super_whitelisted_links.match(parsed_url.parsed.netloc, "/")
+                    )
                     if whitelisted is False and self.is_whitelisted(url):
                         whitelisted = True
                     if whitelisted is False:
@@ -294,22 +712,14 @@ class LinkCheckerModule(BaseModule):
             # First we perform a basic check
             if self.simple_check(url, action) == self.RET_FURTHER_ANALYSIS:
                 # If the basic check returns no relevant data, we queue up a proper check on the URL
-                self.bot.action_queue.submit(self.check_url, url, action)
+                self.scanner.submit(self.check_url(url, action))
 
     def on_commit(self, **rest):
         if self.db_session is not None:
             self.db_session.commit()
 
-    def delete_from_cache(self, url):
-        if url in self.cache:
-            del self.cache[url]
-
     def cache_url(self, url, safe):
-        if url in self.cache and self.cache[url] == safe:
-            return
-
-        self.cache[url] = safe
-        self.bot.execute_delayed(20, self.delete_from_cache, url)
+        self.cache.set(url, safe)
 
     def counteract_bad_url(
         self, url, action=None, want_to_cache=True, want_to_blacklist=False
@@ -347,7 +757,7 @@ class LinkCheckerModule(BaseModule):
 
         link = BlacklistedLink(domain, path, level)
         self.db_session.add(link)
-        self.blacklisted_links.append(link)
+        self.blacklisted_links.add(link.domain, link.path, link)
         self.db_session.commit()
 
     def whitelist_url(self, url, parsed_url=None):
@@ -372,7 +782,7 @@ class LinkCheckerModule(BaseModule):
 
         link = WhitelistedLink(domain, path)
         self.db_session.add(link)
-        self.whitelisted_links.append(link)
+        self.whitelisted_links.add(link.domain, link.path, link)
         self.db_session.commit()
 
     def is_blacklisted(self, url, parsed_url=None, sublink=False):
@@ -387,15 +797,13 @@ class LinkCheckerModule(BaseModule):
         if len(domain_split) < 2:
             return False
 
-        for link in self.blacklisted_links:
-            if link.is_subdomain(domain):
-                if link.is_subpath(path):
-                    if not sublink:
-                        return True
-                    elif (
-                        link.level >= 1
-                    ):  # if it's a sublink, but the blacklisting level is 0, we don't consider it blacklisted
-                        return True
+        for link in self.blacklisted_links.match(domain, path):
+            if not sublink:
+                return True
+            elif (
+                link.level >= 1
+            ):  # if it's a sublink, but the blacklisting level is 0, we don't consider it blacklisted
+                return True
 
         return False
 
@@ -411,17 +819,17 @@ class LinkCheckerModule(BaseModule):
         if len(domain_split) < 2:
             return False
 
-        for link in self.whitelisted_links:
-            if link.is_subdomain(domain):
-                if link.is_subpath(path):
-                    return True
-
-        return False
+        return any(self.whitelisted_links.match(domain, path))
 
     RET_BAD_LINK = -1
     RET_FURTHER_ANALYSIS = 0
     RET_GOOD_LINK = 1
 
+    # Seconds a link check may take, including all sublinks
+    SCAN_DEADLINE = 10
+    # Maximum number of external links checked per page
+    MAX_SUBLINKS = 50
+
     def basic_check(self, url, action, sublink=False):
         """
         Check if the url is in the cache, or if it's
@@ -430,8 +838,9 @@ class LinkCheckerModule(BaseModule):
         -1 = Link is bad
         0 = Link needs further analysis
         """
-        if url.url in self.cache:
-            if not self.cache[url.url]:  # link is bad
+        safe = self.cache.get(url.url)
+        if safe is not None:
+            if not safe:  # link is bad
                 self.counteract_bad_url(url, action, False, False)
                 return self.RET_BAD_LINK
             return self.RET_GOOD_LINK
@@ -454,189 +863,179 @@ class LinkCheckerModule(BaseModule):
 
         return self.basic_check(url, action)
 
-    def check_url(self, url, action):
+    async def check_url(self, url, action):
         url = Url(url)
         if len(url.parsed.netloc.split(".")) < 2:
             # The URL is broken, ignore it
             return
 
         try:
-            self._check_url(url, action)
+            await asyncio.wait_for(
+                self._check_url(url, run_once(action)), self.SCAN_DEADLINE
+            )
+        except asyncio.TimeoutError:
+            log.warning(
+                f"LinkChecker gave up on {url.url} after {self.SCAN_DEADLINE} seconds"
+            )
         except:
             log.exception("LinkChecker unhandled exception while _check_url")
 
-    def _check_url(self, url, action):
+    async def is_url_bad(self, url):
+        """ Ask the safe browsing API, if one is configured """
+        if not self.safe_browsing_api:
+            return False
+
+        return await ExecutorManager.run_async(
+            self.bot.private_loop, self.safe_browsing_api.is_url_bad, url.url
+        )
+
+    async def run_blocking(self, method, *args, **kwargs):
+        """ The cache and the blacklist use redis and the database, keep them off the bot loop """
+        return await ExecutorManager.run_async(
+            self.bot.private_loop, method, *args, **kwargs
+        )
+
+    async def _check_url(self, url, action):
         # XXX: The basic check is currently performed twice on links found in messages. Solve
-        res = self.basic_check(url, action)
+        res = await self.run_blocking(self.basic_check, url, action)
         if res == self.RET_GOOD_LINK:
             return
         elif res == self.RET_BAD_LINK:
             return
 
-        connection_timeout = 2
-        read_timeout = 1
         try:
-            r = requests.head(
-                url.url,
-                allow_redirects=True,
-                timeout=connection_timeout,
-                headers={"User-Agent": self.bot.user_agent},
-            )
-        except:
-            self.cache_url(url.url, True)
+            final_url, headers = await self.scanner.head(url.url)
+        except LinkScanner.errors:
+            await self.run_blocking(self.cache_url, url.url, True)
             return
 
         checkcontenttype = (
-            "content-type" in r.headers
-            and r.headers["content-type"] == "application/octet-stream"
+            "content-type" in headers
+            and headers["content-type"] == "application/octet-stream"
         )
         checkdispotype = (
-            "disposition-type" in r.headers
-            and r.headers["disposition-type"] == "attachment"
+            "disposition-type" in headers and headers["disposition-type"] == "attachment"
         )
 
         if checkcontenttype or checkdispotype:  # triggering a download not allowed
-            self.counteract_bad_url(url, action)
+            await self.run_blocking(self.counteract_bad_url, url, action)
             return
 
-        redirected_url = Url(r.url)
+        redirected_url = Url(final_url)
         if is_same_url(url, redirected_url) is False:
-            res = self.basic_check(redirected_url, action)
+            res = await self.run_blocking(self.basic_check, redirected_url, action)
             if res == self.RET_GOOD_LINK:
                 return
             elif res == self.RET_BAD_LINK:
                 return
 
-        if self.safe_browsing_api and self.safe_browsing_api.is_url_bad(
-            redirected_url.url
-        ):  # harmful url detected
+        if await self.is_url_bad(redirected_url):  # harmful url detected
             log.debug("Google Safe Browsing API lists URL")
-            self.counteract_bad_url(url, action, want_to_blacklist=False)
-            self.counteract_bad_url(redirected_url, want_to_blacklist=False)
+            await self.run_blocking(
+                self.counteract_bad_url, url, action, want_to_blacklist=False
+            )
+            await self.run_blocking(
+                self.counteract_bad_url, redirected_url, want_to_blacklist=False
+            )
             return
 
-        if "content-type" not in r.headers or not r.headers["content-type"].startswith(
+        if "content-type" not in headers or not headers["content-type"].startswith(
             "text/html"
         ):
             return  # can't analyze non-html content
-        maximum_size = 1024 * 1024 * 10  # 10 MB
-        receive_timeout = 3
 
-        html = ""
-        try:
-            response = requests.get(
-                url=url.url,
-                stream=True,
-                timeout=(connection_timeout, read_timeout),
-                headers={"User-Agent": self.bot.user_agent},
-            )
+        original_url = url
+        original_redirected_url = redirected_url
+
+        def is_external(link):
+            return not is_subdomain(link.parsed.netloc, original_url.parsed.netloc)
 
-            content_length = response.headers.get("Content-Length")
-            if (
-                content_length
-                and int(response.headers.get("Content-Length")) > maximum_size
-            ):
+        def is_known_bad(link):
+            return self.is_blacklisted(link.url, link.parsed, sublink=True)
+
+        extractor = LinkExtractor(
+            max_links=self.MAX_SUBLINKS, accept=is_external, stop_on=is_known_bad
+        )
+        try:
+            if not await self.scanner.extract_links(url.url, extractor):
                 log.error("This file is too big!")
                 return
+        except asyncio.TimeoutError:
+            log.warning(f"Timed out while checking {url.url}")
+            await self.run_blocking(self.cache_url, url.url, True)
+            return
+        except LinkScanner.errors:
+            log.exception("Unhandled exception")
+            return
 
-            size = 0
-            start = pajbot.utils.now().timestamp()
+        sublinks = extractor.get_links()
 
-            for chunk in response.iter_content(1024):
-                if pajbot.utils.now().timestamp() - start > receive_timeout:
-                    log.error("The site took too long to load")
-                    return
+        # check if the site links to anything dangerous
+        if await self.check_sublinks(sublinks, original_url, action):
+            await self.run_blocking(
+                self.counteract_bad_url, original_url, want_to_blacklist=False
+            )
+            await self.run_blocking(
+                self.counteract_bad_url, original_redirected_url, want_to_blacklist=False
+            )
+            return
 
-                size += len(chunk)
-                if size > maximum_size:
-                    log.error("This file is too big! (fake header)")
-                    return
-                html += str(chunk)
+        # if we got here, the site is clean for our standards
+        await self.run_blocking(self.cache_url, original_url.url, True)
+        await self.run_blocking(self.cache_url, original_redirected_url.url, True)
+        return
 
-        except requests.exceptions.ConnectTimeout:
-            log.warning(f"Connection timed out while checking {url.url}")
-            self.cache_url(url.url, True)
-            return
-        except requests.exceptions.ReadTimeout:
-            log.warning(f"Reading timed out while checking {url.url}")
-            self.cache_url(url.url, True)
-            return
-        except:
-            log.exception("Unhandled exception")
-            return
+    async def check_sublinks(self, sublinks, original_url, action):
+        """ Check all sublinks concurrently, returns True as soon as one of them is bad """
+        if not sublinks:
+            return False
 
+        tasks = [
+            asyncio.ensure_future(self._check_sublink(url, original_url, action))
+            for url in sublinks
+        ]
         try:
-            soup = BeautifulSoup(html, "html.parser")
-        except:
-            return
+            for task in asyncio.as_completed(tasks):
+                if await task:
+                    return True
+        finally:
+            for task in tasks:
+                task.cancel()
 
-        original_url = url
-        original_redirected_url = redirected_url
-        urls = []
-        for link in soup.find_all("a"):  # get a list of links to external sites
-            url = link.get("href")
-            if url is None:
-                continue
-            if url.startswith("//"):
-                urls.append("http:" + url)
-            elif url.startswith("http://") or url.startswith("https://"):
-                urls.append(url)
+        return False
 
-        for url in urls:  # check if the site links to anything dangerous
-            url = Url(url)
+    async def _check_sublink(self, url, original_url, action):
+        res = await self.run_blocking(self.basic_check, url, action, sublink=True)
+        if res == self.RET_BAD_LINK:
+            await self.run_blocking(self.counteract_bad_url, url)
+            return True
+        elif res == self.RET_GOOD_LINK:
+            return False
 
-            if is_subdomain(url.parsed.netloc, original_url.parsed.netloc):
-                # log.debug('Skipping because internal link')
-                continue
+        try:
+            final_url, _ = await self.scanner.head(url.url)
+        except LinkScanner.errors:
+            return False
 
-            res = self.basic_check(url, action, sublink=True)
+        redirected_url = Url(final_url)
+        if not is_same_url(url, redirected_url):
+            res = await self.run_blocking(
+                self.basic_check, redirected_url, action, sublink=True
+            )
             if res == self.RET_BAD_LINK:
-                self.counteract_bad_url(url)
-                self.counteract_bad_url(original_url, want_to_blacklist=False)
-                self.counteract_bad_url(
-                    original_redirected_url, want_to_blacklist=False
-                )
-                return
+                await self.run_blocking(self.counteract_bad_url, url)
+                return True
             elif res == self.RET_GOOD_LINK:
-                continue
-
-            try:
-                r = requests.head(
-                    url.url,
-                    allow_redirects=True,
-                    timeout=connection_timeout,
-                    headers={"User-Agent": self.bot.user_agent},
-                )
-            except:
-                continue
+                return False
 
-            redirected_url = Url(r.url)
-            if not is_same_url(url, redirected_url):
-                res = self.basic_check(redirected_url, action, sublink=True)
-                if res == self.RET_BAD_LINK:
-                    self.counteract_bad_url(url)
-                    self.counteract_bad_url(original_url, want_to_blacklist=False)
-                    self.counteract_bad_url(
-                        original_redirected_url, want_to_blacklist=False
-                    )
-                    return
-                elif res == self.RET_GOOD_LINK:
-                    continue
-
-            if self.safe_browsing_api and self.safe_browsing_api.is_url_bad(
-                redirected_url.url
-            ):  # harmful url detected
-                log.debug(f"Evil sublink {url} by google API")
-                self.counteract_bad_url(original_url, action)
-                self.counteract_bad_url(original_redirected_url)
-                self.counteract_bad_url(url)
-                self.counteract_bad_url(redirected_url)
-                return
+        if await self.is_url_bad(redirected_url):  # harmful url detected
+            log.debug(f"Evil sublink {url.url} by google API")
+            await self.run_blocking(self.counteract_bad_url, original_url, action)
+            await self.run_blocking(self.counteract_bad_url, url)
+            await self.run_blocking(self.counteract_bad_url, redirected_url)
+            return True
 
-        # if we got here, the site is clean for our standards
-        self.cache_url(original_url.url, True)
-        self.cache_url(original_redirected_url.url, True)
-        return
+        return False
 
     def load_commands(self, **options):
         self.commands["add"] = Command.multiaction_command(
@@ -793,7 +1192,7 @@ class LinkCheckerModule(BaseModule):
         link = self.db_session.query(BlacklistedLink).filter_by(id=id).one_or_none()
 
         if link:
-            self.blacklisted_links.remove(link)
+            self.blacklisted_links.remove(link.domain, link.path, link)
             self.db_session.delete(link)
             self.db_session.commit()
         else:
@@ -817,7 +1216,7 @@ class LinkCheckerModule(BaseModule):
         link = self.db_session.query(WhitelistedLink).filter_by(id=id).one_or_none()
 
         if link:
-            self.whitelisted_links.remove(link)
+            self.whitelisted_links.remove(link.domain, link.path, link)
             self.db_session.delete(link)
             self.db_session.commit()
         else:
@@ -1,29 +1,240 @@
-import logging
-
+import heapq
 import json
-import random
+import logging
+import re
+import threading
 from datetime import datetime
-
-from sqlalchemy.orm import joinedload
+from datetime import timedelta
 
 from greenbot import utils
-from greenbot.exc import InvalidPointAmount
-from greenbot.managers.db import DBManager
-from greenbot.managers.schedule import ScheduleManager
 from greenbot.managers.redis import RedisManager
+from greenbot.managers.schedule import ScheduleManager
 from greenbot.models.command import Command
-from greenbot.models.message import Message
-from greenbot.models.user import User
 from greenbot.modules import BaseModule
 from greenbot.modules import ModuleSetting
+from greenbot.utils import split_into_chunks_with_prefix
 
 log = logging.getLogger(__name__)
 
-def random_string(length=10):
-    return ''.join(random.choice(str.ascii_lowercase) for i in range(length))
 
+class ReminderStore:
+    """
+    Reminders in redis: a sorted set of reminder ids scored by their due timestamp,
+    a hash with the reminder details, and a set of reminder ids per user so the number
+    of reminders of a user is one SCARD.
+    """
+
+    # Before reminders were stored per id, they were kept in one JSON blob
+    legacy_key = "remind-me-reminders"
+
+    add_script = """
+    if redis.call("SCARD", KEYS[4]) >= tonumber(ARGV[1]) then
+        return 0
+    end
+    local reminder_id = redis.call("INCR", KEYS[1])
+    local reminder = cjson.decode(ARGV[3])
+    reminder["id"] = reminder_id
+    redis.call("ZADD", KEYS[2], ARGV[2], reminder_id)
+    redis.call("HSET", KEYS[3], reminder_id, cjson.encode(reminder))
+    redis.call("SADD", KEYS[4], reminder_id)
+    return reminder_id
+    """
+
+    # Only the caller that removes a reminder from the sorted set gets it
+    claim_script = """
+    local reminders = {}
+    for _, reminder_id in ipairs(ARGV) do
+        if redis.call("ZREM", KEYS[1], reminder_id) == 1 then
+            local reminder = redis.call("HGET", KEYS[2], reminder_id)
+            redis.call("HDEL", KEYS[2], reminder_id)
+            if reminder then
+                local user_id = cjson.decode(reminder)["user_id"]
+                redis.call("SREM", KEYS[3] .. user_id, reminder_id)
+                table.insert(reminders, reminder)
+            end
+        end
+    end
+    return reminders
+    """
+
+    def __init__(self, redis, bot_name):
+        self.redis = redis
+        self.prefix = f"{bot_name}:reminders:"
+        self.id_key = self.prefix + "next-id"
+        self.schedule_key = self.prefix + "schedule"
+        self.data_key = self.prefix + "data"
+        self.user_prefix = self.prefix + "user:"
+        self.add_command = redis.register_script(self.add_script)
+        self.claim_command = redis.register_script(self.claim_script)
+
+    def add(self, user_id, channel_id, message, due, max_reminders):
+        """ Returns the id of the new reminder, or None if the user has too many reminders """
+        reminder = {
+            "user_id": str(user_id),
+            "channel_id": str(channel_id) if channel_id else None,
+            "message": message,
+            "date_of_reminder": due.isoformat(),
+        }
+        reminder_id = self.add_command(
+            keys=[
+                self.id_key,
+                self.schedule_key,
+                self.data_key,
+                self.user_prefix + str(user_id),
+            ],
+            args=[max_reminders, due.timestamp(), json.dumps(reminder)],
+        )
+        return int(reminder_id) or None
+
+    def count(self, user_id):
+        return self.redis.scard(self.user_prefix + str(user_id))
+
+    def get_user_reminders(self, user_id):
+        reminder_ids = self.redis.smembers(self.user_prefix + str(user_id))
+        if not reminder_ids:
+            return []
+        reminders = [
+            json.loads(reminder)
+            for reminder in self.redis.hmget(self.data_key, list(reminder_ids))
+            if reminder is not None
+        ]
+        reminders.sort(key=lambda r: r["date_of_reminder"])
+        return reminders
+
+    def remove(self, user_id, reminder_ids):
+        """ Removes the given reminders of the user, returns the number of removed reminders """
+        user_key = self.user_prefix + str(user_id)
+        pipeline = self.redis.pipeline()
+        for reminder_id in reminder_ids:
+            pipeline.sismember(user_key, reminder_id)
+        owned = [
+            reminder_id
+            for reminder_id, is_member in zip(reminder_ids, pipeline.execute())
+            if is_member
+        ]
+        if not owned:
+            return 0
+
+        pipeline = self.redis.pipeline()
+        pipeline.zrem(self.schedule_key, *owned)
+        pipeline.hdel(self.data_key, *owned)
+        pipeline.srem(user_key, *owned)
+        pipeline.execute()
+        return len(owned)
+
+    def get_due(self, until, limit):
+        """ Returns up to `limit` (due timestamp, reminder id) that are due before `until` """
+        return [
+            (score, reminder_id)
+            for reminder_id, score in self.redis.zrangebyscore(
+                self.schedule_key, "-inf", until, start=0, num=limit, withscores=True
+            )
+        ]
+
+    def claim(self, reminder_ids):
+        """ Removes the given reminders, returns the ones that were still there """
+        if not reminder_ids:
+            return []
+        return [
+            json.loads(reminder)
+            for reminder in self.claim_command(
+                keys=[self.schedule_key, self.data_key, self.user_prefix],
+                args=reminder_ids,
+            )
+        ]
+
+    def migrate_legacy(self):
+        """ Move the future reminders of the old JSON blob into the sorted set """
+        blob = self.redis.get(self.legacy_key)
+        if blob is None:
+            return
+
+        try:
+            legacy_reminders = json.loads(blob) or {}
+        except ValueError:
+            log.exception("Unable to parse the legacy reminders, dropping them")
+            legacy_reminders = {}
+
+        num_migrated = 0
+        for user_id, reminders in legacy_reminders.items():
+            for reminder in reminders:
+                try:
+                    date_of_reminder = reminder["date_of_reminder"]
+                    if ":" in date_of_reminder[-5:]:
+                        date_of_reminder = f"{date_of_reminder[:-5]}{date_of_reminder[-5:-3]}{date_of_reminder[-2:]}"
+                    date_of_reminder = datetime.strptime(
+                        date_of_reminder, "%Y-%m-%d %H:%M:%S.%f%z"
+                    )
+                except (KeyError, TypeError, ValueError):
+                    log.exception(f"Unable to migrate a legacy reminder of {user_id}")
+                    continue
+                if date_of_reminder < utils.now():
+                    continue
+                # The limit may have changed since, legacy reminders are kept anyway
+                self.add(
+                    user_id,
+                    None,
+                    reminder.get("message", ""),
+                    date_of_reminder,
+                    2 ** 31,
+                )
+                num_migrated += 1
+
+        self.redis.delete(self.legacy_key)
+        log.info(f"Migrated {num_migrated} legacy reminders")
+
+
+class ReminderQueue:
+    """
+    Min-heap of the reminders that are due within the next `window` seconds.
+
+    Only that window is held in memory, it's refilled from the store when it runs out.
+    Reminders that are removed in the meantime stay in the heap and are skipped when
+    they're claimed.
+    """
+
+    def __init__(self, store, window=300, max_size=10000):
+        self.store = store
+        self.window = window
+        self.max_size = max_size
+        self.heap = []
+        self.queued = set()
+        self.window_end = 0
+        self.lock = threading.Lock()
 
-class ActivityTracker(BaseModule):
+    def push(self, due, reminder_id):
+        with self.lock:
+            if due <= self.window_end and reminder_id not in self.queued:
+                heapq.heappush(self.heap, (due, reminder_id))
+                self.queued.add(reminder_id)
+
+    def refill(self, now):
+        due_reminders = self.store.get_due(now + self.window, self.max_size)
+        with self.lock:
+            for due, reminder_id in due_reminders:
+                if reminder_id not in self.queued:
+                    heapq.heappush(self.heap, (due, reminder_id))
+                    self.queued.add(reminder_id)
+            if len(due_reminders) < self.max_size:
+                self.window_end = now + self.window
+            else:
+                # The window was cut short, refill again once the last reminder we got is due
+                self.window_end = due_reminders[-1][0]
+
+    def pop_due(self, now):
+        if now >= self.window_end:
+            self.refill(now)
+
+        reminder_ids = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, reminder_id = heapq.heappop(self.heap)
+                self.queued.discard(reminder_id)
+                reminder_ids.append(reminder_id)
+        return reminder_ids
+
+
+class RemindMe(BaseModule):
     ID = __name__.split(".")[-1]
     NAME = "RemindMe"
     DESCRIPTION = "Allows users to create reminders"
@@ -46,20 +257,117 @@ class ActivityTracker(BaseModule):
         ),
     ]
 
+    duration_regex = re.compile(r"(\d+)([wdhms])")
+    duration_units = {"w": 604800, "d": 86400, "h": 3600, "m": 60, "s": 1}
+    # Reminder texts are shortened to this in !myreminders, so a long list stays readable
+    listed_length = 200
+    # A delivered reminder and its prefix must fit in one Discord message
+    delivered_length = 1900
+
     def __init__(self, bot):
         super().__init__(bot)
         self.bot = bot
-        self.redis = RedisManager.get()
-        self.reminder_tasks = {}
+        self.store = None
+        self.queue = None
+        self.tick_job = None
+
+    @staticmethod
+    def parse_duration(text):
+        """ Parses durations like 1d12h or 30m, returns the number of seconds or None """
+        text = text.lower()
+        matches = list(RemindMe.duration_regex.finditer(text))
+        if not matches or "".join(m.group(0) for m in matches) != text:
+            return None
+        return sum(
+            int(number) * RemindMe.duration_units[unit]
+            for number, unit in (m.groups() for m in matches)
+        )
+
+    @staticmethod
+    def shorten(text, length):
+        return text if len(text) <= length else f"{text[:length - 1]}…"
+
+    @staticmethod
+    def reply(bot, author, channel, args, message):
+        if args["whisper"]:
+            bot.private_message(author, message)
+        else:
+            bot.say(channel, message)
 
     def create_reminder(self, bot, author, channel, message, args):
-        pass
+        parts = message.split(" ", 1) if message else []
+        seconds = self.parse_duration(parts[0]) if parts else None
+        if seconds is None or seconds <= 0 or len(parts) < 2 or not parts[1].strip():
+            self.reply(
+                bot,
+                author,
+                channel,
+                args,
+                "Usage: !remindme 1d12h30m what to remind you of",
+            )
+            return False
+
+        due = utils.now() + timedelta(seconds=seconds)
+        reminder_id = self.store.add(
+            author.id,
+            channel.id if channel else None,
+            parts[1].strip(),
+            due,
+            self.settings["max_reminders_per_user"],
+        )
+        if reminder_id is None:
+            self.reply(
+                bot,
+                author,
+                channel,
+                args,
+                f"You can't have more than {self.settings['max_reminders_per_user']} reminders",
+            )
+            return False
+
+        self.queue.push(due.timestamp(), str(reminder_id))
+        self.reply(
+            bot,
+            author,
+            channel,
+            args,
+            f"I will remind you in {utils.time_since(due.timestamp(), utils.now().timestamp())} (reminder {reminder_id})",
+        )
+        return True
 
     def myreminders(self, bot, author, channel, message, args):
-        pass
+        reminders = self.store.get_user_reminders(author.id)
+        now = utils.now().timestamp()
+        messages = split_into_chunks_with_prefix(
+            [
+                {
+                    "prefix": "Your reminders:",
+                    "parts": [
+                        f"{r['id']}: {self.shorten(r['message'], self.listed_length)} (in {utils.time_since(datetime.fromisoformat(r['date_of_reminder']).timestamp(), now)})"
+                        for r in reminders
+                    ],
+                }
+            ],
+            "\n",
+            default="You have no reminders",
+        )
+        for message in messages:
+            bot.private_message(author, message)
+        return True
 
     def forgetme(self, bot, author, channel, message, args):
-        pass
+        if message:
+            reminder_ids = message.split(" ")
+        else:
+            reminder_ids = [
+                str(r["id"]) for r in self.store.get_user_reminders(author.id)
+            ]
+
+        num_removed = self.store.remove(author.id, reminder_ids) if reminder_ids else 0
+        self.reply(
+            bot, author, channel, args, f"Removed {num_removed} of your reminders"
+        )
+        return True
 
     def load_commands(self, **options):
         self.commands["remindme"] = Command.raw_command(
@@ -74,52 +382,60 @@ class ActivityTracker(BaseModule):
             self.myreminders,
             delay_all=0,
             delay_user=0,
-            cost=self.settings["cost"],
-            description="Creates a reminder",
+            can_execute_with_whisper=True,
+            description="Lists your reminders",
         )
         self.commands["forgetme"] = Command.raw_command(
             self.forgetme,
             delay_all=0,
             delay_user=0,
-            can_execute_with_whisper=False,
-            description="Creates a reminder",
+            can_execute_with_whisper=True,
+            description="Removes the given reminders, or all of your reminders",
         )
 
-    def execute_reminder(self, salt, reminder):
-        self.reminder_tasks.pop(salt)
+    def tick(self):
+        try:
+            reminder_ids = self.queue.pop_due(utils.now().timestamp())
+            reminders = self.store.claim(reminder_ids)
+        except:
+            log.exception("Unable to get the due reminders")
+            return
+
+        # One message per user, no matter how many of their reminders are due
+        reminders_by_user = {}
+        for reminder in reminders:
+            reminders_by_user.setdefault(reminder["user_id"], []).append(
+                self.shorten(reminder["message"], self.delivered_length)
+            )
+
+        for user_id, user_reminders in reminders_by_user.items():
+            member = self.bot.get_member(user_id)
+            if member is None:
+                log.info(
+                    f"Unable to deliver {len(user_reminders)} reminders to {user_id}"
+                )
+                continue
+            for message in split_into_chunks_with_prefix(
+                [{"prefix": "Reminder:", "parts": user_reminders}], "\n"
+            ):
+                self.bot.private_message(member, message)
 
     def enable(self, bot):
         if not bot:
             return
+
+        self.store = ReminderStore(RedisManager.get(), bot.bot_name)
         try:
-            reminders_list = json.loads(self.redis.get("remind-me-reminders"))
-            """
-            { 
-                user_id: {
-                    "message_id": message_id,
-                    "message": message,
-                    "date_of_reminder": date_of_reminder,
-                },
-            }
-            """
+            self.store.migrate_legacy()
         except:
-            self.redis.set("remind-me-reminders", json.dumps({}))
-            reminders_list = {}
-        new_reminders_list = {}
-        for user in reminders_list:
-            user_reminders = reminders_list[user]
-            new_user_reminders = []
-            for reminder in user_reminders:
-                salt = random_string()
-                date_of_reminder = reminder["date_of_reminder"]
-                if ":" in date_of_reminder[-5:]:
-                    date_of_reminder = f"{date_of_reminder[:-5]}{date_of_reminder[-5:-3]}{date_of_reminder[-2:]}"
-                date_of_reminder = datetime.strptime(date_of_reminder, "%Y-%m-%d %H:%M:%S.%f%z")
-                if date_of_reminder < utils.now():
-                    continue
-                new_user_reminders.append(reminder)
-                self.reminder_tasks[salt] = ScheduleManager.execute_delayed((date_of_reminder-utils.now()).seconds, self.execute_reminder, args=[salt, reminder])
+            log.exception("Unable to migrate the legacy reminders")
+        self.queue = ReminderQueue(self.store)
+        self.tick_job = ScheduleManager.execute_every(1, self.tick)
 
     def disable(self, bot):
         if not bot:
             return
+
+        if self.tick_job is not None:
+            self.tick_job.remove()
+            self.tick_job = None
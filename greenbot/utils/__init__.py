@@ -12,3 +12,5 @@ from .time_method import time_method
 from .get_class_that_defined_method import get_class_that_defined_method
 from .split_into_chunks_with_prefix import split_into_chunks_with_prefix
 from .remove_none_values import remove_none_values
+from .ttl_cache import TTLCache
+from .aho_corasick import AhoCorasick
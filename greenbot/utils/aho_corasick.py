@@ -0,0 +1,90 @@
+import threading
+from collections import deque
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton, finds all occurrences of a set of words in a text in one pass.
+
+    Every word carries a set of values. Words can be added and removed at any time,
+    the automaton is rebuilt on the next search after a change.
+    """
+
+    def __init__(self):
+        self.words = {}
+        self.lock = threading.Lock()
+        self.automaton = None
+
+    def add(self, word, value):
+        if not word:
+            raise ValueError("Empty words can't be matched")
+
+        with self.lock:
+            self.words.setdefault(word, set()).add(value)
+            self.automaton = None
+
+    def remove(self, word, value):
+        with self.lock:
+            values = self.words.get(word, None)
+            if values is None or value not in values:
+                return
+            values.discard(value)
+            if not values:
+                del self.words[word]
+            self.automaton = None
+
+    def __len__(self):
+        return len(self.words)
+
+    def build(self):
+        goto = [{}]
+        fail = [0]
+        output = [()]
+
+        for word, values in self.words.items():
+            node = 0
+            for char in word:
+                next_node = goto[node].get(char, None)
+                if next_node is None:
+                    next_node = len(goto)
+                    goto[node][char] = next_node
+                    goto.append({})
+                    fail.append(0)
+                    output.append(())
+                node = next_node
+            output[node] = ((len(word), tuple(values)),)
+
+        # Breadth first, so the failure link of a node's parent is always known
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                output[child] = output[child] + output[fail[child]]
+
+        return goto, fail, output
+
+    def get_automaton(self):
+        automaton = self.automaton
+        if automaton is None:
+            with self.lock:
+                if self.automaton is None:
+                    self.automaton = self.build()
+                automaton = self.automaton
+        return automaton
+
+    def iter(self, text):
+        """ Yields (start, length, values) for every occurrence of a word in text """
+        goto, fail, output = self.get_automaton()
+
+        node = 0
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, values in output[node]:
+                yield index - length + 1, length, values
@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache where each entry expires after a time-to-live (in seconds).
+    The least recently used entry is evicted once `maxsize` entries are stored.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.data[key]
+                self.misses += 1
+                return default
+
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.data[key] = (value, expires_at)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.data.get(key, None)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
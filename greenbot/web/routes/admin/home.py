@@ -1,10 +1,16 @@
+import logging
+
 from flask import render_template
 from sqlalchemy.orm import joinedload
 
+from greenbot.bothelper import BotHelper
 from greenbot.managers.adminlog import AdminLogEntry
 from greenbot.managers.db import DBManager
+from greenbot.managers.handler import HandlerManager
 from greenbot.web.utils import requires_level
 
+log = logging.getLogger(__name__)
+
 
 def init(page):
     @page.route("/")
@@ -18,4 +24,13 @@ def init(page):
                 .limit(50)
                 .all()
             )
-            return render_template("admin/home.html", latest_logs=latest_logs)
+            try:
+                handler_stats = HandlerManager.get_published_stats(
+                    BotHelper.get_bot_name()
+                )
+            except:
+                log.exception("Unable to load handler stats")
+                handler_stats = []
+            return render_template(
+                "admin/home.html", latest_logs=latest_logs, handler_stats=handler_stats
+            )
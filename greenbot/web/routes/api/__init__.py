@@ -1,5 +1,6 @@
 from flask_restful import Api
 
+import greenbot.web.routes.api.activity
 import greenbot.web.routes.api.banphrases
 import greenbot.web.routes.api.commands
 import greenbot.web.routes.api.common
@@ -30,3 +31,6 @@ def init(app):
 
     # /modules
     greenbot.web.routes.api.modules.init(api)
+
+    # /activity
+    greenbot.web.routes.api.activity.init(api)
@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from flask_restful import Resource
+from flask_restful import reqparse
+
+import greenbot.utils
+from greenbot.managers.db import DBManager
+from greenbot.models.user_activity import UserActivityHourly
+
+
+class APIActivity(Resource):
+    def __init__(self):
+        super().__init__()
+        self.get_parser = reqparse.RequestParser()
+        self.get_parser.add_argument(
+            "hours", required=False, type=int, default=24, location="args"
+        )
+        self.get_parser.add_argument(
+            "channel_id", required=False, default=None, location="args"
+        )
+
+    def get(self, **options):
+        args = self.get_parser.parse_args()
+        # At most one week, 168 rows per channel
+        hours = min(max(1, args["hours"]), 24 * 7)
+        since = greenbot.utils.now() - timedelta(hours=hours - 1)
+
+        with DBManager.create_session_scope() as db_session:
+            volume = UserActivityHourly._get_volume(
+                db_session, since, args["channel_id"]
+            )
+            return (
+                {
+                    "hours": hours,
+                    "activity": [
+                        {
+                            "channel_id": channel_id,
+                            "hour": hour.isoformat(),
+                            "messages": int(messages),
+                        }
+                        for channel_id, hour, messages in volume
+                    ],
+                },
+                200,
+            )
+
+
+def init(api):
+    api.add_resource(APIActivity, "/activity")
@@ -1,6 +1,8 @@
 import json
 import logging
 
+from flask import Response
+from flask import request
 from flask_restful import Resource
 from flask_restful import reqparse
 from sqlalchemy.orm import joinedload
@@ -8,7 +10,9 @@ from sqlalchemy.orm import joinedload
 import greenbot.modules
 import greenbot.utils
 import greenbot.web.utils
+from greenbot.bothelper import BotHelper
 from greenbot.managers.adminlog import AdminLogManager
+from greenbot.managers.command_catalog import CommandCatalog
 from greenbot.managers.db import DBManager
 from greenbot.models.command import Command
 from greenbot.models.command import CommandData
@@ -22,6 +26,13 @@ log = logging.getLogger(__name__)
 class APICommands(Resource):
     @staticmethod
     def get():
+        # Serve the catalog the bot published as is
+        etag, body = CommandCatalog.get_api_body(BotHelper.get_bot_name())
+        if body is not None:
+            response = Response(body, mimetype="application/json")
+            response.set_etag(etag)
+            return response.make_conditional(request)
+
         commands = greenbot.web.utils.get_cached_commands()
 
         commands = list(filter(lambda c: c["id"] is not None, commands))
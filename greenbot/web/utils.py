@@ -17,11 +17,10 @@ import greenbot.managers
 from greenbot import utils
 from greenbot.managers.db import DBManager
 from greenbot.managers.redis import RedisManager
-from greenbot.models.module import ModuleManager
 from greenbot.models.user import User
 from greenbot.utils import time_method
 from greenbot.bothelper import BotHelper
-from greenbot.managers.command import CommandManager
+from greenbot.managers.command_catalog import CommandCatalog
 
 log = logging.getLogger(__name__)
 
@@ -73,18 +72,18 @@ def nocache(view):
 def get_cached_commands():
     CACHE_TIME = 30  # seconds
 
+    # Published by the bot whenever the commands change
+    bot_commands_list = CommandCatalog.get_commands(BotHelper.get_bot_name())
+    if bot_commands_list is not None:
+        return bot_commands_list
+
+    # The bot has not published a catalog yet
     redis = RedisManager.get()
     commands_key = f"{BotHelper.get_bot_name()}:cache:commands"
     commands = redis.get(commands_key)
     if commands is None:
         log.debug("Updating commands...")
-        bot_commands = CommandManager(
-            socket_manager=None, module_manager=ModuleManager(None).load(), bot=None
-        ).load(load_examples=False)
-        bot_commands_list = bot_commands.parse_for_web()
-
-        bot_commands_list.sort(key=lambda x: (x.id or -1, x.main_alias))
-        bot_commands_list = [c.jsonify() for c in bot_commands_list]
+        bot_commands_list = CommandCatalog.build()
         redis.setex(
             commands_key,
             value=json.dumps(bot_commands_list, separators=(",", ":")),